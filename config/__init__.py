@@ -1,10 +1,23 @@
 #config/__init__.py
 
-from .mqtt_config import MQTTConfig
 from .topics import Topics
 from .settings import (
     MACHINE_ID_LIST,
     MACHINE_LAYOUT,
     TIME_BUCKET_SIZE,
-    BUFFER_SIZE
+    BUFFER_SIZE,
+    PERSIST_FLUSH_COUNT,
+    PERSIST_FLUSH_INTERVAL,
+    JOURNAL_COMPACT_THRESHOLD,
+    SCHEDULE_CACHE_MAX_DAYS,
+    SCHEDULE_CACHE_MAX_BYTES,
+    SCHEDULE_CACHE_PINNED_DAYS,
+    PROPOSAL_WORKERS,
+    SCHEDULE_HISTORY_LENGTH,
+    MACHINE_BATCH_UPDATES,
+    METRICS_INTERVAL,
+    METRICS_DIR,
+    PROFILE_DIR,
+    PROFILE_MAX_DURATION,
+    PROFILE_SAMPLE_INTERVAL
 )
@@ -5,4 +5,18 @@ MACHINE_LAYOUT = [
     [11, 12, 13, 14, 15]  # Third floor
 ]
 TIME_BUCKET_SIZE = 300 # 5 minute time buckets in seconds
-BUFFER_SIZE = 3 # Set the time buffer between reservations to three time buckets (15 minutes)
\ No newline at end of file
+BUFFER_SIZE = 3 # Set the time buffer between reservations to three time buckets (15 minutes)
+PERSIST_FLUSH_COUNT = 16 # Write pending schedule changes to disk once this many have queued up
+PERSIST_FLUSH_INTERVAL = 1.0 # ...or once the oldest pending change is this many seconds old
+JOURNAL_COMPACT_THRESHOLD = 500 # Write a new day-file snapshot and truncate the journal after this many records
+SCHEDULE_CACHE_MAX_DAYS = 14 # Most day schedules held in memory at once
+SCHEDULE_CACHE_MAX_BYTES = 8 * 1024 * 1024 # Memory budget for cached day schedules
+SCHEDULE_CACHE_PINNED_DAYS = 7 # Today and this many following days are never evicted
+PROPOSAL_WORKERS = 4 # Session proposals processed concurrently by the schedule manager
+SCHEDULE_HISTORY_LENGTH = 64 # Versions of changes kept per day for delta updates; older clients get the full schedule
+MACHINE_BATCH_UPDATES = False # Send updates for several machines as one MACHINE_BATCH frame instead of one message per machine
+METRICS_INTERVAL = 30.0 # Seconds between metrics reports over MQTT and to the Prometheus text file
+METRICS_DIR = "metrics" # Each hub process writes its Prometheus text file here, for node_exporter's textfile collector
+PROFILE_DIR = "profiles" # On-demand profiling results are written here, in a directory per hub process
+PROFILE_MAX_DURATION = 300.0 # Longest profiling run in seconds, however long the admin portal asks for
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds between stack samples in the sample profiling mode
\ No newline at end of file
@@ -6,6 +6,7 @@ class Topics:
 
     MANAGER_PROPOSE_SESSION = "internal/manager/propose/session"
     MANAGER_REQUEST_SESSION = "internal/manager/request/session"
+    MANAGER_REQUEST_SCHEDULE = "internal/manager/request/schedule"
 
     MACHINE_UPDATE_INTERNAL = "internal/machine/update"
     MACHINE_ACK_INTERNAL = "internal/machine/acknowledge"
@@ -22,32 +23,48 @@ class Topics:
     ADMIN_SESSION_ACK = "internal/admin/acknowledge/session"
     ADMIN_SESSION_RESPONSE = "internal/admin/response/session"
     ADMIN_SCHEDULE_RESPONSE = "internal/admin/response/schedule"
+    ADMIN_PROFILE_RESPONSE = "internal/admin/response/profile"
+    ADMIN_PROFILE_BASE = "internal/admin/profile/{node}"  # PROFILE commands for each hub process
 
     TEST_SESSION_ACK = "internal/test/acknowledge/session"
     TEST_SESSION_RESPONSE = "internal/test/response/session"
     TEST_SCHEDULE_RESPONSE = "internal/test/response/schedule"
 
+    METRICS_BASE = "internal/metrics/{node}"  # Periodic metrics snapshot of each hub process
+
     # === External Topics ===
 
-    MACHINE_UPDATE_BASE = "external/machine/{id}/update"
-    MACHINE_ACK_BASE = "external/machine/{id}/acknowledge"
-    MACHINE_ALERT_BASE = "external/machine/{id}/alert"
+    # Topic patterns for every machine; subscribing to one routes any machine's messages with its machine_id
+    MACHINE_UPDATE_BASE = "external/machine/{machine_id}/update"
+    MACHINE_ACK_BASE = "external/machine/{machine_id}/acknowledge"
+    MACHINE_ALERT_BASE = "external/machine/{machine_id}/alert"
+    MACHINE_UPDATE_BATCH = "external/machine/update"  # MACHINE_BATCH frames for every machine, when batching is on
 
     HANDLER_TOPIC_EXTERNAL = "external/handler"
 
+    # === Internal Topic Helpers ===
+
+    @staticmethod
+    def ADMIN_PROFILE(node: str) -> str:
+        return Topics.ADMIN_PROFILE_BASE.format(node=str(node))
+
+    @staticmethod
+    def METRICS(node: str) -> str:
+        return Topics.METRICS_BASE.format(node=str(node))
+
     # === External Topic Helpers ===
 
     @staticmethod
     def MACHINE_UPDATE_EXTERNAL(machine_id: int) -> str:
-        return MACHINE_UPDATE_BASE.format(id=str(machine_id))
+        return Topics.MACHINE_UPDATE_BASE.format(machine_id=str(machine_id))
 
     @staticmethod
     def MACHINE_ACK_EXTERNAL(machine_id: int) -> str:
-        return MACHINE_ACK_BASE.format(id=str(machine_id))
+        return Topics.MACHINE_ACK_BASE.format(machine_id=str(machine_id))
 
     @staticmethod
     def MACHINE_ALERT_EXTERNAL(machine_id: int) -> str:
-        return MACHINE_ALERT_BASE.format(id=str(machine_id))
+        return Topics.MACHINE_ALERT_BASE.format(machine_id=str(machine_id))
 
     '''
     TOPIC_MAP = {
@@ -0,0 +1,131 @@
+# machine/machine_handler.py
+
+import os
+import time
+from typing import Dict, List, Optional, Type
+from pydantic import BaseModel
+from utils.messages import MACHINE, MACHINE_BATCH, ACKNOWLEDGE, PROFILE, PROFILE_REPORT
+from utils.codec import encode
+from utils.dispatch import MessageDispatcher
+from utils.enums import Node
+from utils.metrics import MetricsReporter
+from utils.profiling import start_profile
+from config.topics import Topics
+from config import MACHINE_BATCH_UPDATES, METRICS_DIR, METRICS_INTERVAL
+from config import PROFILE_DIR, PROFILE_MAX_DURATION, PROFILE_SAMPLE_INTERVAL
+from utils import get_logger
+from mqtt import MQTTClient, MQTTConfig
+
+logger = get_logger("machine_handler")
+
+mqtt_client = MQTTClient(
+    broker_host=MQTTConfig.BROKER_HOST,
+    broker_port=MQTTConfig.BROKER_PORT,
+    client_id="MachineHandler"
+)
+mqtt_client.connect()
+
+# Latest status reported for each machine
+machine_states: Dict[int, MACHINE] = {}
+
+def start():
+    logger.info("Starting machine handler...")
+    init_machine_handler()
+    reporter = MetricsReporter(mqtt_client.publish, Topics.METRICS(Node.HANDLER.value), os.path.join(METRICS_DIR, "machine_handler.prom"), METRICS_INTERVAL)
+    reporter.start()
+    try:
+        # The MQTT network loop runs in its own thread, so just keep the process alive
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping machine handler...")
+        reporter.stop()
+        mqtt_client.disconnect()
+
+def send_machine_updates(machines: List[MACHINE], binary: bool = False):
+    """
+    Record machine updates and send them to the machines, in the format they arrived in.
+    Each machine's topic coalesces, so a machine updated again before its last update went out only
+    gets the latest. With MACHINE_BATCH_UPDATES on, several updates go out as one MACHINE_BATCH frame.
+    """
+    for machine in machines:
+        machine_states[machine.machine_id] = machine
+
+    if MACHINE_BATCH_UPDATES and len(machines) > 1:
+        mqtt_client.publish(Topics.MACHINE_UPDATE_BATCH, encode(MACHINE_BATCH(machines=machines), binary))
+        logger.info(f"Sent updates for {len(machines)} machines as one batch to {Topics.MACHINE_UPDATE_BATCH}")
+        return
+
+    for machine in machines:
+        mqtt_client.publish(Topics.MACHINE_UPDATE_EXTERNAL(machine.machine_id), encode(machine, binary))
+    logger.info(f"Sent updates for machines {[machine.machine_id for machine in machines]}")
+
+def handle_machine_update(topic: str, machine: MACHINE, binary: bool = False):
+    send_machine_updates([machine], binary)
+
+def handle_machine_batch(topic: str, batch: MACHINE_BATCH, binary: bool = False):
+    send_machine_updates(batch.machines, binary)
+
+def handle_machine_report(topic: str, report: MACHINE, binary: bool = False, machine_id: Optional[str] = None):
+    """Record the status a machine reports about itself on its alert topic."""
+    if str(report.machine_id) != machine_id:
+        logger.warning(f"Ignoring report for machine {report.machine_id} sent on {topic}.")
+        return
+    machine_states[report.machine_id] = report
+    logger.warning(f"Machine {machine_id} reports {report.status.value}" + (f", ball level {report.ball_level.value}." if report.ball_level else "."))
+
+def handle_machine_ack(topic: str, ack: ACKNOWLEDGE, binary: bool = False, machine_id: Optional[str] = None):
+    """Log a machine confirming or refusing an update sent to it."""
+    if ack.success:
+        logger.info(f"Machine {machine_id} confirmed exchange {ack.exchange_id}.")
+    else:
+        logger.warning(f"Machine {machine_id} refused exchange {ack.exchange_id}: {ack.message}")
+
+def handle_profile(topic: str, command: PROFILE, binary: bool = False):
+    """Profile the machine handler as the admin portal asks, and send it the hottest functions once done."""
+    def report(result: PROFILE_REPORT):
+        result.origin_node = Node.HANDLER
+        mqtt_client.publish(Topics.ADMIN_PROFILE_RESPONSE, encode(result, binary))
+
+    if not start_profile(command, os.path.join(PROFILE_DIR, Node.HANDLER.value), report, PROFILE_MAX_DURATION, PROFILE_SAMPLE_INTERVAL):
+        logger.warning(f"Ignoring profile command {command.exchange_id}: a profile is already running.")
+        mqtt_client.publish(Topics.ADMIN_PROFILE_RESPONSE, encode(ACKNOWLEDGE(
+            success=False, message="A profile is already running", exchange_id=command.exchange_id, origin_node=Node.HANDLER
+        ), binary))
+
+def _update_model(data: dict) -> Optional[Type[BaseModel]]:
+    # Bare JSON updates are a MACHINE_BATCH if they list machines, otherwise a MACHINE
+    return MACHINE_BATCH if "machines" in data else MACHINE
+
+def _legacy_model(data: dict) -> Optional[Type[BaseModel]]:
+    # Bare JSON from machines is an ACKNOWLEDGE if it says whether it succeeded, otherwise a MACHINE
+    return ACKNOWLEDGE if "success" in data else MACHINE
+
+# Message types the handler accepts
+dispatcher = MessageDispatcher("machine_dispatch", legacy_model=_update_model)
+dispatcher.register(MACHINE, handle_machine_update)
+dispatcher.register(MACHINE_BATCH, handle_machine_batch)
+
+# Messages from the machines themselves, one subscription for the whole fleet
+machine_dispatcher = MessageDispatcher("machine_report_dispatch", legacy_model=_legacy_model)
+machine_dispatcher.register(MACHINE, handle_machine_report)
+machine_dispatcher.register(ACKNOWLEDGE, handle_machine_ack)
+
+# Commands from the admin portal
+admin_dispatcher = MessageDispatcher("machine_admin_dispatch", legacy_model=PROFILE)
+admin_dispatcher.register(PROFILE, handle_profile)
+
+
+def init_machine_handler():
+    """Initialize the machine handler and subscribe to relevant topics."""
+    logger.info("Initializing machine handler...")
+    # Machines only need their latest state, and get it on reconnecting from the retained message
+    mqtt_client.configure_topic(Topics.MACHINE_UPDATE_BASE, qos=1, retain=True, coalesce=True)
+    mqtt_client.configure_topic(Topics.MACHINE_UPDATE_BATCH, qos=1)
+    mqtt_client.subscribe(Topics.MACHINE_UPDATE_INTERNAL, dispatcher)
+    mqtt_client.subscribe(Topics.MACHINE_ALERT_BASE, machine_dispatcher)
+    mqtt_client.subscribe(Topics.MACHINE_ACK_BASE, machine_dispatcher)
+    mqtt_client.subscribe(Topics.ADMIN_PROFILE(Node.HANDLER.value), admin_dispatcher)
+
+if __name__ == "__main__":
+    start()
@@ -2,3 +2,5 @@
 
 from .mqtt_client import MQTTClient
 from .mqtt_config import MQTTConfig
+from .topic_router import TopicRouter
+from .loopback import LoopbackBroker, LoopbackClient
@@ -0,0 +1,232 @@
+import itertools
+import queue
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+import paho.mqtt.client as mqtt
+from mqtt.topic_router import TopicRouter
+from utils.logger import get_logger
+
+logger = get_logger("loopback")
+
+
+class LoopbackMessage(NamedTuple):
+    '''Message as handed to on_message, with the fields of paho's MQTTMessage the hub reads'''
+    topic: str
+    payload: bytes
+    qos: int
+    retain: bool
+    mid: int
+
+
+class LoopbackInfo(NamedTuple):
+    '''Result of publish, like paho's MQTTMessageInfo'''
+    rc: int
+    mid: int
+
+
+def _to_bytes(payload: Union[str, bytes, bytearray, int, float, None]) -> bytes:
+    # The payload types paho accepts
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode()
+    if isinstance(payload, (int, float)):
+        return str(payload).encode()
+    raise TypeError("payload must be a string, bytearray, int, float or None.")
+
+
+class LoopbackBroker:
+    """
+    MQTT broker inside the process, for running the hub and simulated clients with no network.
+
+    Topic filters match as on a real broker, wildcards included, through the same TopicRouter the
+    client uses. Retained messages are kept per topic, cleared by an empty retained payload, and
+    sent to each new matching subscription with the retain flag set. A client gets one copy of each
+    message however many of its filters match, at the lower of the publish QoS and its highest
+    matching subscription QoS. Sessions are clean: a client's subscriptions end when it disconnects.
+    Nothing is lost in memory, so QoS 1 and 2 differ from QoS 0 only in being kept while the
+    publisher is disconnected.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: TopicRouter[Dict["LoopbackClient", int]] = TopicRouter()
+        self._retained: Dict[str, Tuple[bytes, int]] = {}
+        self._mids = itertools.count(1)
+
+        # Metrics
+        self.published = 0
+        self.delivered = 0
+
+    def disconnect(self, client: "LoopbackClient"):
+        with self._lock:
+            for topic_filter, subscribers in self._subscriptions.items():
+                if subscribers.pop(client, None) is not None and not subscribers:
+                    self._subscriptions.remove(topic_filter)
+
+    def subscribe(self, client: "LoopbackClient", topic_filter: str, qos: int):
+        router: TopicRouter[bool] = TopicRouter()
+        router.add(topic_filter, True)  # Raises ValueError for an invalid filter, before anything changes
+        with self._lock:
+            subscribers = self._subscriptions.get(topic_filter)
+            if subscribers is None:
+                subscribers = {}
+                self._subscriptions.add(topic_filter, subscribers)
+            subscribers[client] = qos
+            for topic, (payload, retained_qos) in self._retained.items():
+                if router.match(topic):
+                    client._deliver(LoopbackMessage(topic, payload, min(qos, retained_qos), True, next(self._mids)))
+                    self.delivered += 1
+
+    def unsubscribe(self, client: "LoopbackClient", topic_filter: str):
+        with self._lock:
+            subscribers = self._subscriptions.get(topic_filter)
+            if subscribers is not None and subscribers.pop(client, None) is not None and not subscribers:
+                self._subscriptions.remove(topic_filter)
+
+    def publish(self, topic: str, payload: bytes, qos: int, retain: bool):
+        if not topic or "+" in topic or "#" in topic:
+            raise ValueError(f"Invalid topic {topic!r} to publish to")
+        with self._lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+
+            # One copy per client, at the highest QoS of its matching subscriptions
+            granted: Dict[LoopbackClient, int] = {}
+            for subscribers, _ in self._subscriptions.match(topic):
+                for client, subscription_qos in subscribers.items():
+                    granted[client] = max(granted.get(client, 0), subscription_qos)
+            for client, subscription_qos in granted.items():
+                client._deliver(LoopbackMessage(topic, payload, min(qos, subscription_qos), False, next(self._mids)))
+            self.delivered += len(granted)
+
+    def retained(self) -> Dict[str, bytes]:
+        with self._lock:
+            return {topic: payload for topic, (payload, _) in self._retained.items()}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "filters": len(self._subscriptions),
+                "retained": len(self._retained),
+                "published": self.published,
+                "delivered": self.delivered,
+            }
+
+
+class LoopbackClient:
+    """
+    Stand-in for paho's Client that talks to a LoopbackBroker, with the same calls, callbacks and
+    return codes the hub uses. As with paho, callbacks run on one thread started by loop_start,
+    messages delivered before then wait for it, and QoS 1 and 2 messages published while
+    disconnected are sent once connected again.
+    """
+
+    def __init__(self, client_id: str = "", broker: Optional[LoopbackBroker] = None):
+        self.client_id = client_id
+        self.broker = broker if broker is not None else default_broker
+        self.on_connect: Optional[Callable] = None
+        self.on_disconnect: Optional[Callable] = None
+        self.on_message: Optional[Callable] = None
+        self.on_publish: Optional[Callable] = None
+
+        self._connected = False
+        self._lock = threading.Lock()
+        self._mids = itertools.count(1)
+        self._pending: List[Tuple[str, bytes, int, bool, int]] = []  # QoS 1 and 2 messages published while disconnected
+        self._inbox: "queue.Queue[Optional[Tuple[str, tuple]]]" = queue.Queue()  # Callbacks for the loop thread
+        self._thread: Optional[threading.Thread] = None
+
+    def max_inflight_messages_set(self, inflight: int):
+        pass  # Every publish is confirmed at once
+
+    def connect(self, host: str = "", port: int = 0, keepalive: int = 60) -> int:
+        with self._lock:
+            self._connected = True
+            pending, self._pending = self._pending, []
+        self._callback("on_connect", {"session present": 0}, mqtt.CONNACK_ACCEPTED)
+        for topic, payload, qos, retain, mid in pending:
+            self.broker.publish(topic, payload, qos, retain)
+            self._callback("on_publish", mid)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self) -> int:
+        with self._lock:
+            if not self._connected:
+                return mqtt.MQTT_ERR_NO_CONN
+            self._connected = False
+        self.broker.disconnect(self)
+        self._callback("on_disconnect", mqtt.MQTT_ERR_SUCCESS)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def loop_start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=f"loopback-{self.client_id}", daemon=True)
+            self._thread.start()
+
+    def loop_stop(self):
+        if self._thread is not None:
+            self._inbox.put(None)
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+
+    def subscribe(self, topic: str, qos: int = 0) -> Tuple[int, Optional[int]]:
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        self.broker.subscribe(self, topic, qos)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+    def unsubscribe(self, topic: str) -> Tuple[int, Optional[int]]:
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        self.broker.unsubscribe(self, topic)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False) -> LoopbackInfo:
+        payload = _to_bytes(payload)
+        mid = next(self._mids)
+        with self._lock:
+            if not self._connected:
+                if qos > 0:
+                    self._pending.append((topic, payload, qos, retain, mid))
+                return LoopbackInfo(mqtt.MQTT_ERR_NO_CONN, mid)
+        self.broker.publish(topic, payload, qos, retain)
+        self._callback("on_publish", mid)
+        return LoopbackInfo(mqtt.MQTT_ERR_SUCCESS, mid)
+
+    # === Callback thread ===
+
+    def _callback(self, name: str, *args):
+        # Looked up when it runs, as paho does, so callbacks set after connecting still fire
+        self._inbox.put((name, args))
+
+    def _deliver(self, message: LoopbackMessage):
+        self._inbox.put(("on_message", (message,)))
+
+    def _loop(self):
+        while True:
+            task = self._inbox.get()
+            if task is None:
+                return
+            name, args = task
+            callback = getattr(self, name)
+            if callback is None:
+                continue
+            try:
+                callback(self, None, *args)
+            except Exception as e:
+                logger.exception(f"Error in {name} callback of loopback client {self.client_id}: {e}")
+
+
+# Broker shared by every loopback client in the process that is not given its own
+default_broker = LoopbackBroker()
@@ -1,63 +1,339 @@
 import asyncio
+import logging
+import threading
+import time
+from collections import deque
 import paho.mqtt.client as mqtt
-from utils.logger import get_logger
-from typing import Callable, Dict, Optional
+from utils.logger import Payload, get_logger, sample
+from utils.codec import is_binary
+from utils.enums import Overflow
+from utils.metrics import metrics, stats_collector
+from mqtt.mqtt_config import MQTTConfig
+from mqtt.topic_router import TopicRouter, broker_filter
+from mqtt.outbox import Outbox
+from mqtt.loopback import LoopbackClient
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Tuple, Union
+
+# callback(topic, payload, **params), with a keyword argument per {name} level of the subscription's pattern
+Callback = Callable[..., None]
+
+LATENCY_SAMPLES = 256  # Recent handler latencies kept per subscription for percentiles
+
+
+class Subscription:
+    """
+    Bounded queue of inbound messages for one topic pattern and the worker threads that drain it.
+
+    paho delivers every message on its network thread, so callbacks never run there: a slow handler
+    would hold up all network I/O, keep-alive PINGs included. The network thread only enqueues, and
+    up to concurrency workers run the callback. When the queue is full the overflow policy decides
+    what gives.
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        callback: Callback,
+        concurrency: int,
+        max_queue: int,
+        overflow: Overflow,
+        on_reject: Optional[Callback],
+        loop: Optional[asyncio.AbstractEventLoop],
+        logger,
+    ):
+        self.topic = topic
+        self.callback = callback
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.on_reject = on_reject  # Called on the network thread with messages turned away, to answer with a failure
+        self.loop = loop  # Loop to run coroutine callbacks on; workers use their own when None
+        self.logger = logger
+
+        self._queue: Deque[Tuple[str, Union[str, bytes], Dict[str, str], float]] = deque()
+        self._ready = threading.Condition()
+        self._workers: List[threading.Thread] = []
+        self._running = True
+        self._busy = 0
+
+        # Metrics
+        self.received = 0
+        self.handled = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.wait_time = 0.0  # Total seconds messages spent queued
+        self.handler_time = 0.0  # Total seconds spent in the callback
+        self.max_handler_time = 0.0
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+
+        for i in range(concurrency):
+            worker = threading.Thread(target=self._work, name=f"mqtt-{topic}-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    # === Network thread ===
+
+    def offer(self, topic: str, payload: Union[str, bytes], params: Dict[str, str]) -> bool:
+        """Queue a message for the workers. Returns False if it was dropped or rejected."""
+        with self._ready:
+            self.received += 1
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == Overflow.DROP_OLDEST:
+                    dropped_topic, _, _, _ = self._queue.popleft()
+                    self.dropped += 1
+                    self.logger.warning(f"Inbound queue for {self.topic} is full, dropped the oldest message on {dropped_topic}.")
+                elif self.overflow == Overflow.BLOCK:
+                    self._ready.wait_for(lambda: len(self._queue) < self.max_queue or not self._running, MQTTConfig.INBOUND_BLOCK_TIMEOUT)
+
+            if len(self._queue) < self.max_queue and self._running:
+                self._queue.append((topic, payload, params, time.monotonic()))
+                self.max_depth = max(self.max_depth, len(self._queue))
+                self._ready.notify()
+                return True
+            self.rejected += 1
+
+        self.logger.warning(f"Inbound queue for {self.topic} is full, rejected a message on {topic}.")
+        if self.on_reject is not None:
+            try:
+                self.on_reject(topic, payload)
+            except Exception as e:
+                self.logger.exception(f"Error rejecting message on topic '{topic}': {e}")
+        return False
+
+    # === Workers ===
+
+    def _work(self):
+        event_loop = None
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._queue or not self._running)
+                if not self._queue:
+                    break
+                topic, payload, params, queued_at = self._queue.popleft()
+                self._busy += 1
+                self._ready.notify_all()  # Wakes a network thread blocked on a full queue
+
+            started = time.monotonic()
+            try:
+                if asyncio.iscoroutinefunction(self.callback):
+                    if self.loop is not None:
+                        asyncio.run_coroutine_threadsafe(self.callback(topic, payload, **params), self.loop).result()
+                    else:
+                        event_loop = event_loop or asyncio.new_event_loop()
+                        event_loop.run_until_complete(self.callback(topic, payload, **params))
+                else:
+                    self.callback(topic, payload, **params)
+                succeeded = True
+            except Exception as e:
+                succeeded = False
+                self.logger.exception(f"Error in MQTT callback for topic '{topic}': {e}")
+            finished = time.monotonic()
+
+            with self._ready:
+                self._busy -= 1
+                self.handled += succeeded
+                self.failed += not succeeded
+                self.wait_time += started - queued_at
+                self.handler_time += finished - started
+                self.max_handler_time = max(self.max_handler_time, finished - started)
+                self._latencies.append(finished - started)
+                self._ready.notify_all()
+
+        if event_loop is not None:
+            event_loop.close()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Let the workers finish the queued messages, then end them."""
+        with self._ready:
+            self._running = False
+            self._ready.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self) -> dict:
+        with self._ready:
+            latencies = sorted(self._latencies)
+            done = self.handled + self.failed
+            return {
+                "depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "busy": self._busy,
+                "received": self.received,
+                "handled": self.handled,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+                "avg_wait": self.wait_time / done if done else 0.0,
+                "avg_latency": self.handler_time / done if done else 0.0,
+                "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+                "max_latency": self.max_handler_time,
+            }
+
+
+TRANSPORTS = ("tcp", "websockets", "loopback")
+
 
 class MQTTClient:
-    def __init__(self, broker_host: str, broker_port: int, client_id: str):
+    """
+    Hub connection to the MQTT broker. The transport is tcp or websockets for a real broker, or
+    loopback for the broker inside this process (mqtt.loopback), which lets the hub and simulated
+    clients run together with no network. It defaults to MQTTConfig.TRANSPORT.
+    """
+
+    def __init__(
+        self,
+        broker_host: str,
+        broker_port: int,
+        client_id: str,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+        transport: Optional[str] = None,
+    ):
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.client_id = client_id
-        self.client = mqtt.Client(self.client_id)
+        self.transport = transport or MQTTConfig.TRANSPORT
+        if self.transport not in TRANSPORTS:
+            raise ValueError(f"Unknown MQTT transport {self.transport!r}, expected one of {', '.join(TRANSPORTS)}")
+        if self.transport == "loopback":
+            self.client = LoopbackClient(self.client_id)
+        else:
+            self.client = mqtt.Client(self.client_id, transport=self.transport)
         self.logger = get_logger(self.client_id)
-        self._callbacks: Dict[str, Callable[[str, str], None]] = {}
-        self._loop = asyncio.get_event_loop()
+        self._subscriptions: TopicRouter[Subscription] = TopicRouter()
+        self._loop = loop  # Running event loop for async callbacks, if the owner has one
+        self.client.max_inflight_messages_set(MQTTConfig.OUTBOUND_MAX_INFLIGHT)
+        self.outbox = Outbox(self.client, MQTTConfig.OUTBOUND_MAX_INFLIGHT, self.logger)
+        labels = {"client": client_id}
+        metrics.collect_from("mqtt_inbound", stats_collector(lambda: self.stats()["subscriptions"], labels, group="topic"), "Inbound queue of each subscription")
+        metrics.collect_from("mqtt_outbound", stats_collector(self.outbox.stats, labels), "Outbound queue")
 
     def connect(self):
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
 
-        self.logger.info(f"Connecting to MQTT broker at {self.broker_host}:{self.broker_port}...")
+        if self.transport == "loopback":
+            self.logger.info("Connecting to the in-process loopback broker...")
+        else:
+            self.logger.info(f"Connecting to MQTT broker at {self.broker_host}:{self.broker_port}...")
         self.client.connect(self.broker_host, self.broker_port)
         self.client.loop_start()
 
-    def subscribe(self, topic: str, callback: Callable[[str, str], None]):
-        """Subscribe and register a callback for a specific topic."""
-        self.client.subscribe(topic)
-        self._callbacks[topic] = callback
+    def disconnect(self, timeout: Optional[float] = None):
+        """Stop receiving, let queued messages finish and their replies go out, then close the connection."""
+        for _, subscription in self._subscriptions.items():
+            subscription.stop(timeout)
+        self.outbox.stop(timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def subscribe(
+        self,
+        topic: str,
+        callback: Callback,
+        concurrency: int = 1,
+        max_queue: Optional[int] = None,
+        overflow: Optional[Overflow] = None,
+        on_reject: Optional[Callback] = None,
+    ):
+        """
+        Subscribe and register a callback for a topic pattern.
+        Patterns may use the MQTT wildcards + and #, and {name} levels, which match like + and are passed
+        to the callback as keyword arguments, e.g. external/machine/{machine_id}/alert. A message goes
+        to every subscription whose pattern matches it.
+        Callbacks get JSON payloads as text and binary codec payloads as bytes, and run on up to
+        concurrency worker threads, so with the default of one a subscription's messages are handled in order.
+        max_queue and overflow default to MQTTConfig. on_reject is called with messages the REJECT
+        policy turns away, on the network thread, so it must be quick.
+        """
+        previous = self._subscriptions.get(topic)
+        if previous is not None:
+            previous.stop()
+        self._subscriptions.add(topic, Subscription(
+            topic,
+            callback,
+            concurrency=concurrency,
+            max_queue=max_queue if max_queue is not None else MQTTConfig.INBOUND_QUEUE_SIZE,
+            overflow=Overflow(overflow if overflow is not None else MQTTConfig.INBOUND_OVERFLOW),
+            on_reject=on_reject,
+            loop=self._loop,
+            logger=self.logger,
+        ))
+        self.client.subscribe(broker_filter(topic))
         self.logger.info(f"Subscribed to topic: {topic}")
 
-    def publish(self, topic: str, payload: str):
-        """Publish a message to a topic."""
-        self.client.publish(topic, payload)
-        self.logger.info(f"Published message to topic {topic}: {payload}")
+    def unsubscribe(self, topic: str, timeout: Optional[float] = None):
+        """Stop receiving a topic pattern, after its queued messages are handled."""
+        subscription = self._subscriptions.remove(topic)
+        if subscription is None:
+            return
+        if not any(broker_filter(pattern) == broker_filter(topic) for pattern, _ in self._subscriptions.items()):
+            self.client.unsubscribe(broker_filter(topic))
+        subscription.stop(timeout)
+        self.logger.info(f"Unsubscribed from topic: {topic}")
+
+    def publish(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+        key: Optional[Hashable] = None,
+    ):
+        """
+        Queue a message for a topic. QoS and retain default to the topic's configure_topic settings.
+        Giving a key, or configuring the topic to coalesce, lets a newer message replace one still queued.
+        """
+        self.outbox.put(topic, payload, qos, retain, key)
+
+    def configure_topic(self, pattern: str, qos: int = 0, retain: bool = False, coalesce: bool = False):
+        """Set the QoS, retain flag and coalescing of messages published to topics matching the pattern."""
+        self.outbox.configure(pattern, qos, retain, coalesce)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every published message has been handed to the connection."""
+        return self.outbox.flush(timeout)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Queue depth, drops and handler latency (in seconds) for each subscription, and queue depth,
+        coalescing and in-flight messages of the outbox.
+        """
+        return {
+            "subscriptions": {topic: subscription.stats() for topic, subscription in self._subscriptions.items()},
+            "outbox": self.outbox.stats(),
+        }
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             self.logger.info("MQTT connected successfully.")
+            self.outbox.reset_inflight()
         else:
             self.logger.error(f"MQTT connection failed. Return code: {rc}")
 
     def _on_disconnect(self, client, userdata, rc):
         self.logger.info("MQTT disconnected.")
 
+    def _on_publish(self, client, userdata, mid):
+        self.outbox.confirmed()
+
     def _on_message(self, client, userdata, message):
         topic = message.topic
-        payload = message.payload.decode()
+        try:
+            payload = message.payload if is_binary(message.payload) else message.payload.decode()
+        except UnicodeDecodeError:
+            payload = message.payload  # Left for the callback to reject; raising here would stop paho's network loop
 
-        self.logger.info(f"Received message on topic {topic}: {payload}")
+        # Logged lazily and truncated: this runs on the network thread for every message
+        if self.logger.isEnabledFor(logging.DEBUG) and sample("mqtt.received"):
+            self.logger.debug("Received message on topic %s: %s", topic, Payload(payload))
 
-        callback = self._callbacks.get(topic)
-        if callback:
-            try:
-                if asyncio.iscoroutinefunction(callback):
-                    # Run async callback in the event loop
-                    self._loop.call_soon_threadsafe(asyncio.create_task, callback(topic, payload))
-                else:
-                    # Run sync callback immediately
-                    callback(topic, payload)
-            except Exception as e:
-                self.logger.exception(f"Error in MQTT callback for topic '{topic}': {e}")
-        else:
+        matches = self._subscriptions.match(topic)
+        for subscription, params in matches:
+            # Only queue here; the subscription's workers run the callback
+            subscription.offer(topic, payload, params)
+        if not matches:
             self.logger.warning(f"No callback registered for topic: {topic}")
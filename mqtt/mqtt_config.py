@@ -8,3 +8,14 @@ class MQTTConfig:
     # Default to the static IP of the Raspberry Pi's Ethernet port
     BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "192.168.4.1")
     BROKER_PORT = int(os.getenv("MQTT_BROKER_PORT", 1883))  # Default to port 1883
+
+    # tcp or websockets for the broker above, or loopback for a broker inside the process, e.g. for load tests without a network
+    TRANSPORT = os.getenv("MQTT_TRANSPORT", "tcp")
+
+    # Inbound messages wait in a bounded queue per subscription while worker threads run the callbacks
+    INBOUND_QUEUE_SIZE = int(os.getenv("MQTT_INBOUND_QUEUE_SIZE", 256))  # Most messages waiting per subscription
+    INBOUND_OVERFLOW = os.getenv("MQTT_INBOUND_OVERFLOW", "drop_oldest")  # What to do when a queue is full (see utils.enums.Overflow)
+    INBOUND_BLOCK_TIMEOUT = float(os.getenv("MQTT_INBOUND_BLOCK_TIMEOUT", 0.5))  # Longest the block policy holds up the network thread, in seconds
+
+    # Outbound messages are queued and sent by one thread, with a limit on those not yet confirmed
+    OUTBOUND_MAX_INFLIGHT = int(os.getenv("MQTT_OUTBOUND_MAX_INFLIGHT", 20))  # Messages handed to the broker connection and not yet confirmed
\ No newline at end of file
@@ -0,0 +1,164 @@
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, NamedTuple, Optional, Tuple, Union
+import paho.mqtt.client as mqtt
+from mqtt.topic_router import TopicRouter
+from utils.logger import Payload, sample
+
+
+class TopicOptions(NamedTuple):
+    qos: int = 0
+    retain: bool = False
+    coalesce: bool = False  # A message still waiting to be sent is replaced by a newer one for the same topic
+
+
+DEFAULT_OPTIONS = TopicOptions()
+
+
+class Outbox:
+    """
+    Outbound message queue drained by one sender thread.
+
+    Publishing only queues, so callers never wait on the network. Messages for topics configured to
+    coalesce, or published with a key, replace a still-queued message with the same topic and key in
+    its place in the queue: when every bay changes state at once, a bay that changes again before
+    its first update went out is sent once, with its latest state. QoS and retain come from the first
+    configured pattern matching the topic unless given. At most max_inflight messages are handed to
+    paho and not yet confirmed by on_publish; the sender waits for confirmations beyond that.
+    """
+
+    def __init__(self, client: mqtt.Client, max_inflight: int, logger):
+        self.client = client
+        self.max_inflight = max_inflight
+        self.logger = logger
+
+        self._options: TopicRouter[TopicOptions] = TopicRouter()
+        self._resolved: Dict[str, TopicOptions] = {}  # Options of topics seen so far
+        self._queue: "OrderedDict[Hashable, Tuple[str, Union[str, bytes], int, bool]]" = OrderedDict()
+        self._sequence = itertools.count()  # Keys for messages that never coalesce
+        self._ready = threading.Condition()
+        self._inflight = 0
+        self._running = True
+
+        # Metrics
+        self.queued = 0
+        self.published = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.max_depth = 0
+
+        self._sender = threading.Thread(target=self._send, name="mqtt-outbox", daemon=True)
+        self._sender.start()
+
+    def configure(self, pattern: str, qos: int = 0, retain: bool = False, coalesce: bool = False):
+        """Set the QoS, retain flag and coalescing of every topic matching the pattern."""
+        with self._ready:
+            self._options.add(pattern, TopicOptions(qos, retain, coalesce))
+            self._resolved.clear()
+
+    def options(self, topic: str) -> TopicOptions:
+        options = self._resolved.get(topic)
+        if options is None:
+            matches = self._options.match(topic)
+            options = matches[0][0] if matches else DEFAULT_OPTIONS
+            self._resolved[topic] = options
+        return options
+
+    def put(
+        self,
+        topic: str,
+        payload: Union[str, bytes],
+        qos: Optional[int] = None,
+        retain: Optional[bool] = None,
+        key: Optional[Hashable] = None,
+    ):
+        """Queue a message. A key coalesces it with queued messages on the same topic with the same key."""
+        with self._ready:
+            options = self.options(topic)
+            if key is None and options.coalesce:
+                key = topic
+            entry = (topic, payload, options.qos if qos is None else qos, options.retain if retain is None else retain)
+
+            self.queued += 1
+            queue_key = (topic, key) if key is not None else next(self._sequence)
+            if queue_key in self._queue:
+                self.coalesced += 1
+            self._queue[queue_key] = entry  # Replacing keeps the older message's place
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._ready.notify_all()
+
+    # === Sender thread ===
+
+    def _send(self):
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: (self._queue and self._inflight < self.max_inflight) or not self._running)
+                if not self._queue:
+                    return
+                if self._inflight >= self.max_inflight:
+                    # Stopping with confirmations outstanding; send what is left anyway
+                    self._inflight = 0
+                _, (topic, payload, qos, retain) = self._queue.popitem(last=False)
+                self._inflight += 1
+                self._ready.notify_all()
+
+            try:
+                info = self.client.publish(topic, payload, qos=qos, retain=retain)
+                rc = info.rc
+            except Exception as e:
+                self.logger.exception(f"Failed to publish to topic {topic}: {e}")
+                rc = mqtt.MQTT_ERR_UNKNOWN
+
+            with self._ready:
+                if rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.published += 1
+                    if self.logger.isEnabledFor(logging.DEBUG) and sample("mqtt.published"):
+                        self.logger.debug("Published message to topic %s: %s", topic, Payload(payload))
+                elif qos > 0 and rc == mqtt.MQTT_ERR_NO_CONN:
+                    # paho keeps QoS 1 and 2 messages and sends them once reconnected
+                    self.published += 1
+                    self.logger.warning(f"Not connected, message to topic {topic} will be sent on reconnect.")
+                else:
+                    # Nothing will confirm this message, so free its slot now
+                    self.failed += 1
+                    self._inflight = max(self._inflight - 1, 0)
+                    self.logger.error(f"Failed to publish to topic {topic}: {mqtt.error_string(rc)}")
+                self._ready.notify_all()
+
+    def confirmed(self):
+        """Called from paho's on_publish when a message has left (QoS 0) or been acknowledged (QoS 1 and 2)."""
+        with self._ready:
+            self._inflight = max(self._inflight - 1, 0)
+            self._ready.notify_all()
+
+    def reset_inflight(self):
+        """Forget outstanding confirmations, e.g. after reconnecting with a clean session."""
+        with self._ready:
+            self._inflight = 0
+            self._ready.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued message has been handed to paho. Returns False on timeout."""
+        with self._ready:
+            return self._ready.wait_for(lambda: not self._queue, timeout)
+
+    def stop(self, timeout: Optional[float] = None):
+        """Send what is queued, then end the sender thread."""
+        with self._ready:
+            self._running = False
+            self._ready.notify_all()
+        self._sender.join(timeout)
+
+    def stats(self) -> dict:
+        with self._ready:
+            return {
+                "depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "in_flight": self._inflight,
+                "queued": self.queued,
+                "published": self.published,
+                "coalesced": self.coalesced,
+                "failed": self.failed,
+            }
@@ -0,0 +1,113 @@
+import re
+from typing import Dict, Generic, List, Optional, Tuple, TypeVar
+
+Value = TypeVar("Value")
+
+# A level written as {name} matches any one level, like +, and hands it to the callback as name
+_PARAM = re.compile(r"^\{(\w+)\}$")
+
+
+def broker_filter(pattern: str) -> str:
+    """The MQTT topic filter to subscribe with for a pattern, with {name} levels turned into +."""
+    return "/".join("+" if _PARAM.match(level) else level for level in pattern.split("/"))
+
+def _parse(pattern: str) -> Tuple[List[str], Dict[int, str]]:
+    # Split a pattern into trie keys and the names of its {name} levels by position
+    keys, names = [], {}
+    levels = pattern.split("/")
+    for i, level in enumerate(levels):
+        param = _PARAM.match(level)
+        if param:
+            names[i] = param.group(1)
+            level = "+"
+        elif "#" in level and (level != "#" or i != len(levels) - 1):
+            raise ValueError(f"Invalid topic pattern {pattern!r}: # must be the whole last level")
+        elif "+" in level and level != "+":
+            raise ValueError(f"Invalid topic pattern {pattern!r}: + must be a whole level")
+        keys.append(level)
+    return keys, names
+
+
+class _Node:
+    __slots__ = ("children", "entries")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.entries: Dict[str, Tuple[object, Dict[int, str]]] = {}  # pattern -> (value, parameter names)
+
+
+class TopicRouter(Generic[Value]):
+    """
+    Routes topics to the values registered under MQTT topic patterns, backed by a trie of topic levels.
+
+    Patterns may use + for one level, # for the rest of the topic and {name} for one level whose value
+    is returned as a parameter, e.g. external/machine/{machine_id}/update. Matching walks the trie
+    once per topic level, so its cost depends on the depth of the topic and not on how many patterns
+    or machines there are. As in MQTT, wildcards do not match topics starting with $.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._patterns: Dict[str, Value] = {}
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def __contains__(self, pattern: str) -> bool:
+        return pattern in self._patterns
+
+    def get(self, pattern: str) -> Optional[Value]:
+        return self._patterns.get(pattern)
+
+    def items(self) -> List[Tuple[str, Value]]:
+        return list(self._patterns.items())
+
+    def add(self, pattern: str, value: Value):
+        """Register a value under a pattern, replacing any value already registered under it."""
+        keys, names = _parse(pattern)
+        node = self._root
+        for key in keys:
+            node = node.children.setdefault(key, _Node())
+        node.entries[pattern] = (value, names)
+        self._patterns[pattern] = value
+
+    def remove(self, pattern: str) -> Optional[Value]:
+        """Unregister a pattern, pruning trie levels left empty. Returns its value, if it had one."""
+        if pattern not in self._patterns:
+            return None
+        keys, _ = _parse(pattern)
+        path = [self._root]
+        for key in keys:
+            path.append(path[-1].children[key])
+        del path[-1].entries[pattern]
+        for depth in range(len(keys), 0, -1):
+            node = path[depth]
+            if node.entries or node.children:
+                break
+            del path[depth - 1].children[keys[depth - 1]]
+        return self._patterns.pop(pattern)
+
+    def match(self, topic: str) -> List[Tuple[Value, Dict[str, str]]]:
+        """Every value whose pattern matches the topic, with the parameters taken from the topic."""
+        levels = topic.split("/")
+        matched = []
+        wildcards = not topic.startswith("$")
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if wildcards or depth > 0:
+                # # matches the remaining levels, including none at all
+                rest = node.children.get("#")
+                if rest is not None:
+                    matched.extend(rest.entries.values())
+            if depth == len(levels):
+                matched.extend(node.entries.values())
+                continue
+            child = node.children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            if wildcards or depth > 0:
+                child = node.children.get("+")
+                if child is not None:
+                    stack.append((child, depth + 1))
+        return [(value, {name: levels[i] for i, name in names.items()}) for value, names in matched]
@@ -0,0 +1,72 @@
+# schedule/availability_index.py
+
+from typing import Dict, Iterable, List, Optional, Union
+
+# Translation table turning a status column into ASCII '1' for AVAILABLE cells and '0' otherwise
+def _free_table(available_code: int) -> bytes:
+    return bytes(ord("1") if code == available_code else ord("0") for code in range(256))
+
+
+class AvailabilityIndex:
+    """
+    One integer bitmask of free time buckets per machine for a single day.
+    Bit i of a machine's mask is set when that machine is AVAILABLE in bucket i,
+    so window checks are a mask-and-compare instead of a loop over buckets.
+    """
+
+    def __init__(self, num_buckets: int, machine_ids: Iterable[int], masks: Optional[Dict[int, int]] = None):
+        self.num_buckets = num_buckets
+        self.full_mask = (1 << num_buckets) - 1
+        if masks is None:
+            masks = {mid: self.full_mask for mid in machine_ids}
+        self._masks: Dict[int, int] = masks
+
+    @classmethod
+    def from_columns(cls, status, num_buckets: int, machine_ids: List[int], available_code: int) -> "AvailabilityIndex":
+        """Build the index from a machine-major status column."""
+        table = _free_table(available_code)
+        masks = {}
+        for i, machine_id in enumerate(machine_ids):
+            base = i * num_buckets
+            bits = bytes(status[base:base + num_buckets]).translate(table)
+            masks[machine_id] = int(bits[::-1], 2) if bits else 0  # Reverse so bucket 0 is the lowest bit
+        return cls(num_buckets, machine_ids, masks)
+
+    @staticmethod
+    def window_mask(start: int, end: int) -> int:
+        """Mask with the bits for buckets [start, end) set."""
+        return ((1 << (end - start)) - 1) << start
+
+    def has_machine(self, machine_id: int) -> bool:
+        return machine_id in self._masks
+
+    def free_mask(self, machine_id: int) -> int:
+        return self._masks[machine_id]
+
+    def combined_mask(self, machine_ids: Iterable[int]) -> int:
+        """Buckets where every listed machine is free."""
+        combined = self.full_mask
+        for machine_id in machine_ids:
+            combined &= self._masks[machine_id]
+        return combined
+
+    def is_free(self, machine_ids: Union[int, List[int]], start: int, end: int) -> bool:
+        """Returns True if every listed machine is free for buckets [start, end)."""
+        if isinstance(machine_ids, int):
+            machine_ids = [machine_ids]
+        window = self.window_mask(start, end)
+        return self.combined_mask(machine_ids) & window == window
+
+    def mark(self, machine_ids: Union[int, List[int]], start: int, end: int, free: bool):
+        """Set buckets [start, end) of the listed machines to free or taken."""
+        if isinstance(machine_ids, int):
+            machine_ids = [machine_ids]
+        window = self.window_mask(start, end)
+        for machine_id in machine_ids:
+            if free:
+                self._masks[machine_id] |= window
+            else:
+                self._masks[machine_id] &= ~window
+
+    def copy(self) -> "AvailabilityIndex":
+        return AvailabilityIndex(self.num_buckets, self._masks.keys(), dict(self._masks))
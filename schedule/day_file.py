@@ -0,0 +1,177 @@
+# schedule/day_file.py
+
+import mmap
+import os
+import struct
+from array import array
+from typing import Optional
+
+from schedule.schedule_grid import ScheduleGrid
+
+# Binary day-file layout (little endian, every section aligned to 8 bytes):
+#
+#     header            magic, version, bucket size, bucket count, machine count, day start, date
+#     machine ids       int32[num_machines]
+#     status            uint8[num_machines * num_buckets]
+#     session ids       int64[num_machines * num_buckets]
+#     scheduled until   float64[num_machines * num_buckets]
+#
+# Columns are machine-major, matching ScheduleGrid, so they can be copied straight into a grid.
+
+MAGIC = b"DHSC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIId16s")
+
+# (attribute, typecode, item size) for each fixed-width column in file order
+COLUMNS = (
+    ("status", "B", 1),
+    ("session_ids", "q", 8),
+    ("scheduled_until", "d", 8),
+)
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class DayFileError(Exception):
+    '''Raised when a day file is missing, truncated or written by an unknown format version'''
+
+
+class DayFile:
+    """
+    A memory-mapped binary schedule for one day.
+
+    read() copies the columns straight out of the mapping into a ScheduleGrid of its own, so loading
+    costs no parsing, and the grid is unaffected when the file is written later.
+    write_changes() then copies only the machine blocks that differ into the mapping and flushes
+    them, which turns a booking into a few in-place page writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "r+b")
+        try:
+            self._shared = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        except ValueError as e:
+            self._file.close()
+            raise DayFileError(f"{path} is empty") from e
+
+        if len(self._shared) < HEADER.size:
+            self.close()
+            raise DayFileError(f"{path} is too short to hold a day-file header")
+
+        magic, version, _, bucket_size, num_buckets, num_machines, day_start, date = HEADER.unpack_from(self._shared, 0)
+        if magic != MAGIC:
+            self.close()
+            raise DayFileError(f"{path} is not a schedule day file")
+        if version != VERSION:
+            self.close()
+            raise DayFileError(f"{path} uses day-file version {version}, expected {VERSION}")
+
+        self.date = date.rstrip(b"\0").decode()
+        self.bucket_size = bucket_size
+        self.num_buckets = num_buckets
+        self.day_start = day_start
+
+        ids_offset = _align(HEADER.size)
+        self.machine_ids = list(struct.unpack_from(f"<{num_machines}i", self._shared, ids_offset))
+
+        # Byte ranges of each column
+        self._ranges = {}
+        offset = _align(ids_offset + 4 * num_machines)
+        cells = num_buckets * num_machines
+        for attribute, _, size in COLUMNS:
+            self._ranges[attribute] = (offset, offset + cells * size)
+            offset = _align(offset + cells * size)
+
+        if len(self._shared) < offset:
+            self.close()
+            raise DayFileError(f"{path} is truncated")
+
+    @staticmethod
+    def write(path: str, grid: ScheduleGrid):
+        """Write a complete day file for the grid, replacing any existing file atomically."""
+        ids_offset = _align(HEADER.size)
+
+        buffer = bytearray(_align(ids_offset + 4 * len(grid.machine_ids)))
+        HEADER.pack_into(
+            buffer, 0, MAGIC, VERSION, 0, grid.bucket_size, grid.num_buckets,
+            len(grid.machine_ids), grid.day_start, grid.date.encode()
+        )
+        struct.pack_into(f"<{len(grid.machine_ids)}i", buffer, ids_offset, *grid.machine_ids)
+        for attribute, _, _ in COLUMNS:
+            buffer += memoryview(getattr(grid, attribute)).cast("B")
+            buffer += bytes(_align(len(buffer)) - len(buffer))
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(buffer)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+
+    def read(self) -> ScheduleGrid:
+        """
+        Grid holding its own copy of the file's columns. Published snapshots must not change, and
+        a view of the mapping would, as write_changes() rewrites the same pages.
+        """
+        columns = {}
+        with memoryview(self._shared) as mapped:
+            for attribute, typecode, _ in COLUMNS:
+                start, end = self._ranges[attribute]
+                column = array(typecode)
+                with mapped[start:end] as section:
+                    column.frombytes(section)
+                columns[attribute] = column
+        return ScheduleGrid(
+            date=self.date,
+            day_start=self.day_start,
+            bucket_size=self.bucket_size,
+            num_buckets=self.num_buckets,
+            machine_ids=self.machine_ids,
+            **columns,
+        )
+
+    def matches(self, grid: ScheduleGrid) -> bool:
+        """Returns True if the grid has the same shape as this file and can be written in place."""
+        return (
+            grid.num_buckets == self.num_buckets
+            and grid.bucket_size == self.bucket_size
+            and grid.machine_ids == self.machine_ids
+        )
+
+    def write_changes(self, grid: ScheduleGrid) -> int:
+        """
+        Copy every machine block that differs from the file into the shared mapping and flush it.
+        Returns the number of blocks written.
+        """
+        written = 0
+        for attribute, _, size in COLUMNS:
+            start, _ = self._ranges[attribute]
+            source = memoryview(getattr(grid, attribute)).cast("B")
+            target = memoryview(self._shared)
+            block = self.num_buckets * size
+            for i in range(len(self.machine_ids)):
+                lo = i * block
+                if source[lo:lo + block] != target[start + lo:start + lo + block]:
+                    target[start + lo:start + lo + block] = source[lo:lo + block]
+                    written += 1
+            target.release()
+            source.release()
+
+        if written:
+            self._shared.flush()
+        return written
+
+    def close(self):
+        """Release the mapping."""
+        self._shared.close()
+        self._file.close()
+
+
+def open_day_file(path: str) -> Optional[DayFile]:
+    """Open a day file, returning None if it does not exist."""
+    if not os.path.exists(path):
+        return None
+    return DayFile(path)
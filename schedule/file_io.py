@@ -2,102 +2,175 @@
 
 import os
 import json
-from datetime import datetime, timedelta
-from typing import List
+import argparse
+from typing import Dict, List, Optional
 
+from config import TIME_BUCKET_SIZE
 from utils.logger import get_logger
-from messages import MACHINE
-from utils.enums import Status
+from utils.metrics import timed
+from schedule.schedule_grid import ScheduleGrid
+from schedule.day_file import DayFile
+from schedule.journal import ScheduleJournal
+from schedule.time_index import buckets_in_day, day_bounds
 
 logger = get_logger("file_io")
 
 # Constants
 SCHEDULE_PATH = "data/master_schedule.json"
-TIME_BUCKET_SIZE = 5 * 60  # 5 minutes in seconds
+SCHEDULES_DIR = "schedules"
 
 # You may want to pass this in from the main script, or define a default set for testing
 machine_id_list: List[int] = [1,2,3,4,5,6,7,8,9,10]
 
-def generate_blank_schedule(date: str, machines: List[int]) -> List[list]:
+# Day files currently mapped into memory, keyed by date
+_day_files: Dict[str, DayFile] = {}
+
+def generate_blank_schedule(date: str, machines: Optional[List[int]] = None) -> ScheduleGrid:
     """
     Generate a blank schedule for a given date.
-    Each time bucket contains a timestamp and one MACHINE object per machine.
+    Every machine starts AVAILABLE in every time bucket.
     """
-    start_of_day = datetime.strptime(date, "%Y-%m-%d")
-    intervals_per_day = (24 * 60 * 60) // TIME_BUCKET_SIZE
-
-    schedule = []
-    for i in range(intervals_per_day):
-        timestamp = int((start_of_day + timedelta(seconds=TIME_BUCKET_SIZE * i)).timestamp())
-        time_bucket = [timestamp]
-
-        for machine_id in machines:
-            machine = MACHINE(
-                machine_id=machine_id,
-                status=Status.AVAILABLE,
-            )
-            time_bucket.append(machine)
-
-        schedule.append(time_bucket)
+    if machines is None:
+        machines = machine_id_list
+
+    # Days run midnight to midnight, so daylight saving changes give them more or fewer buckets
+    schedule = ScheduleGrid(
+        date=date,
+        day_start=day_bounds(date)[0],
+        bucket_size=TIME_BUCKET_SIZE,
+        num_buckets=buckets_in_day(date),
+        machine_ids=machines,
+    )
 
     logger.info(f"Generated blank schedule for {date} with {len(machines)} machines.")
     return schedule
 
-def save_schedule_to_disk(date: str, schedule: List[list]) -> bool:
-    """Serialize the schedule and write to disk."""
-
-    # Ensure the schedules directory exists
-    schedules_dir = "schedules"
-    os.makedirs(schedules_dir, exist_ok=True)
+def _schedule_path(date: str, extension: str) -> str:
+    # Ensure the schedules directory exists and construct the full file path
+    os.makedirs(SCHEDULES_DIR, exist_ok=True)
+    return os.path.join(SCHEDULES_DIR, f"{date}_schedule.{extension}")
 
-    # Construct the full file path
-    filename = os.path.join(schedules_dir, f"{date}_schedule.json")
+@timed("schedule_write_seconds", "Time to write a day schedule to disk")
+def save_schedule_to_disk(date: str, schedule: ScheduleGrid) -> bool:
+    """
+    Write the schedule to its binary day file.
+    If the day file is already mapped, only the machine blocks that changed are written in place.
+    """
+    filename = _schedule_path(date, "bin")
 
     try:
-        # Convert MACHINE objects to dictionaries for JSON storage
-        raw_schedule = []
-        for time_bucket in schedule:
-            timestamp = time_bucket[0]
-            machines = [m.model_dump() for m in time_bucket[1:]]
-            raw_schedule.append([timestamp] + machines)
-        
-        # Save the JSON data
-        with open(filename, "w") as file:
-            json.dump(raw_schedule, file, indent=4)  # Use indent=4 for readability
+        day_file = _day_files.get(date)
+        if day_file is not None and day_file.matches(schedule):
+            written = day_file.write_changes(schedule)
+            logger.info(f"Master schedule for {date} updated in place in {filename} ({written} blocks written).")
+            return True
+
+        # No mapped file with the same shape, so write the whole day and map the new file
+        if day_file is not None:
+            day_file.close()
+        DayFile.write(filename, schedule)
+        _day_files[date] = DayFile(filename)
 
         logger.info(f"Master schedule for {date} saved successfully to {filename}.")
         return True
-    
+
     except Exception as e:
         logger.error(f"Failed to save master schedule for {date} to {filename}: {e}")
         return False
 
-def load_schedule_from_disk(date: str) -> List[list]:
-    """Load the schedule from disk and reconstruct MACHINE models."""
+def load_schedule_from_disk(date: str) -> ScheduleGrid:
+    """Read the schedule from its mapped day file, migrating or generating it if needed."""
 
-    # Construct the full file path
-    schedules_dir = "schedules"
-    filename = os.path.join(schedules_dir, f"{date}_schedule.json")
+    filename = _schedule_path(date, "bin")
 
     # Check if schedule already exists
     if os.path.exists(filename):
         try:
-            with open(filename, "r") as file:
-                # Load the raw JSON data
-                raw_schedule = json.load(file)
-                schedule = []
-                for time_bucket in raw_schedule:
-                    timestamp = time_bucket[0]
-                    machines = [MACHINE(**m) if isinstance(m, dict) else m for m in time_bucket[1:]]
-                    schedule.append([timestamp] + machines)
-                logger.info(f"Master schedule for {date} loaded successfully from {filename}.")
-                return schedule
+            day_file = _day_files.get(date)
+            if day_file is None:
+                day_file = DayFile(filename)
+                _day_files[date] = day_file
+            schedule = day_file.read()
+            logger.info(f"Master schedule for {date} loaded successfully from {filename}.")
+            return schedule
         except Exception as e:
             logger.error(f"Failed to load master schedule for {date} from {filename}: {e}")
             raise
-    # Create blank schedule and save if schedule doesn't exist
-    else:
-        logger.warning(f"Master schedule for {date} not found in {filename}. Generating a blank schedule.")
-        schedule = generate_blank_schedule(date)
+
+    # Convert a schedule saved in the old JSON format
+    if os.path.exists(_schedule_path(date, "json")):
+        logger.warning(f"Master schedule for {date} only exists as JSON. Converting to {filename}.")
+        schedule = import_schedule_json(date)
         save_schedule_to_disk(date, schedule)
         return schedule
+
+    # Create blank schedule and save if schedule doesn't exist
+    logger.warning(f"Master schedule for {date} not found in {filename}. Generating a blank schedule.")
+    schedule = generate_blank_schedule(date)
+    save_schedule_to_disk(date, schedule)
+    return schedule
+
+def release_day_file(date: str):
+    """Unmap a day file that is no longer cached."""
+    day_file = _day_files.pop(date, None)
+    if day_file is not None:
+        day_file.close()
+
+def open_journal(date: str) -> ScheduleJournal:
+    """Open the mutation journal that sits alongside the schedule's day file."""
+    return ScheduleJournal(_schedule_path(date, "journal"))
+
+def export_schedule_json(schedule: ScheduleGrid, filename: Optional[str] = None) -> bool:
+    """
+    Write the schedule as JSON rows of machine dictionaries, for debugging or external tools.
+    The day file lags the journal, so export the master schedule rather than what is on disk.
+    """
+    date = schedule.date
+    if filename is None:
+        filename = _schedule_path(date, "json")
+
+    try:
+        # Convert the grid to rows of machine dictionaries for JSON storage
+        raw_schedule = schedule.to_rows()
+
+        # Save the JSON data
+        with open(filename, "w") as file:
+            json.dump(raw_schedule, file, indent=4)  # Use indent=4 for readability
+
+        logger.info(f"Master schedule for {date} exported to {filename}.")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to export master schedule for {date} to {filename}: {e}")
+        return False
+
+def import_schedule_json(date: str, filename: Optional[str] = None) -> ScheduleGrid:
+    """Read a schedule from JSON rows of machine dictionaries."""
+    if filename is None:
+        filename = _schedule_path(date, "json")
+
+    try:
+        with open(filename, "r") as file:
+            # Load the raw JSON data
+            raw_schedule = json.load(file)
+            schedule = ScheduleGrid.from_rows(date, raw_schedule, TIME_BUCKET_SIZE)
+            logger.info(f"Master schedule for {date} imported from {filename}.")
+            return schedule
+    except Exception as e:
+        logger.error(f"Failed to import master schedule for {date} from {filename}: {e}")
+        raise
+
+if __name__ == "__main__":
+    # Conversion tool: python -m schedule.file_io export|import <date> [json file]
+    parser = argparse.ArgumentParser(description="Convert schedules between binary day files and JSON.")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("date", help="Schedule date as YYYY-MM-DD")
+    parser.add_argument("filename", nargs="?", help="JSON file (defaults to the schedules directory)")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        # Imported here, as the master schedule imports this module
+        from schedule.master_schedule import export_master_schedule
+        export_master_schedule(args.date, args.filename)
+    else:
+        save_schedule_to_disk(args.date, import_schedule_json(args.date, args.filename))
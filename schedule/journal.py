@@ -0,0 +1,139 @@
+# schedule/journal.py
+
+import json
+import os
+import threading
+from typing import Iterator, List, Optional
+
+from schedule.schedule_grid import ScheduleGrid
+from utils.enums import Status
+from utils.logger import get_logger
+
+logger = get_logger("journal")
+
+# Mutation types recorded in the journal
+OP_ADD = "add"
+OP_CANCEL = "cancel"
+OP_STATUS = "status"
+
+
+def add_record(machine_ids: List[int], start: int, end: int, session_id: int, status: Status = Status.RESERVED, scheduled_until: Optional[float] = None) -> dict:
+    """Book buckets [start, end) of the machines for a session."""
+    return {"op": OP_ADD, "machine_ids": machine_ids, "start": start, "end": end, "session_id": session_id, "status": status.value, "scheduled_until": scheduled_until}
+
+def cancel_record(session_id: int) -> dict:
+    """Free every cell booked by a session."""
+    return {"op": OP_CANCEL, "session_id": session_id}
+
+def status_record(machine_ids: List[int], start: int, end: int, status: Status) -> dict:
+    """Change the status of buckets [start, end) of the machines, keeping their session details."""
+    return {"op": OP_STATUS, "machine_ids": machine_ids, "start": start, "end": end, "status": status.value}
+
+def apply_mutation(schedule: ScheduleGrid, record: dict):
+    """
+    Apply a journal record to a schedule. Every record writes absolute values, so replaying a record
+    that is already reflected in the snapshot leaves the schedule unchanged.
+    """
+    op = record["op"]
+    if op == OP_ADD:
+        schedule.set_cells(
+            machine_ids=record["machine_ids"],
+            start=record["start"],
+            end=record["end"],
+            status=Status(record["status"]),
+            session_id=record["session_id"],
+            scheduled_until=record["scheduled_until"]
+        )
+    elif op == OP_CANCEL:
+        schedule.clear_session(record["session_id"])
+    elif op == OP_STATUS:
+        schedule.set_status(record["machine_ids"], record["start"], record["end"], Status(record["status"]))
+    else:
+        raise ValueError(f"Unknown journal operation: {op}")
+
+
+class ScheduleJournal:
+    """
+    Append-only log of the mutations applied to one day since its last day-file snapshot.
+    Records are JSON lines. append() only buffers them in memory; sync() writes everything buffered
+    as a single write followed by one fsync, which the persistence worker does in the background.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a+b")
+        self._count = self._recover()
+        self._pending: List[bytes] = []  # Encoded records not yet written
+        self._lock = threading.Lock()  # Guards _pending and _count
+        self._io_lock = threading.Lock()  # Serializes writes to the file
+
+    def _recover(self) -> int:
+        # Cut off a torn final record left by a crash mid-append so new records start on a clean line
+        self._file.seek(0)
+        count = 0
+        valid_length = 0
+        for line in self._file:
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            count += 1
+            valid_length += len(line)
+
+        if valid_length < self._file.seek(0, os.SEEK_END):
+            logger.warning(f"Truncating incomplete record at the end of {self.path}.")
+            self._file.truncate(valid_length)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        return count
+
+    def __len__(self) -> int:
+        # Number of records since the last compaction, written or not
+        return self._count
+
+    @property
+    def pending(self) -> int:
+        # Number of records buffered but not yet written
+        return len(self._pending)
+
+    def records(self) -> Iterator[dict]:
+        """Read back every record since the last compaction."""
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+
+    def append(self, records: List[dict]):
+        """Buffer records for the next sync()."""
+        encoded = [json.dumps(record, separators=(",", ":")).encode() + b"\n" for record in records]
+        with self._lock:
+            self._pending.extend(encoded)
+            self._count += len(encoded)
+
+    def sync(self) -> int:
+        """Write every buffered record and fsync. Returns the number of records written."""
+        with self._io_lock:
+            with self._lock:
+                data, self._pending = self._pending, []
+            if not data or self._file.closed:
+                return 0
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(b"".join(data))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return len(data)
+
+    def reset(self):
+        """Drop every record, written or buffered, once they are captured in a new snapshot."""
+        with self._io_lock:
+            with self._lock:
+                self._pending = []
+                self._count = 0
+            self._file.truncate(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
@@ -1,16 +1,27 @@
 # schedule/manager.py
 
-import json
-from pydantic import ValidationError
-from typing import Callable
-from scheduler import check_availability, add_session
-from utils.messages import SESSION, Acknowledge  # SESSION is the incoming session proposal
+import os
+import time
+from datetime import datetime
+from typing import Optional, Type, Union
+from pydantic import BaseModel
+from schedule.scheduler import add_sessions
+from schedule.master_schedule import clear_past_schedules, close_schedules, get_master_schedule, get_schedule_changes
+from schedule.wire_format import negotiate_encoding, schedule_message, delta_message
+from utils.messages import SESSION, SESSION_BATCH, ACKNOWLEDGE  # SESSION and SESSION_BATCH are incoming session proposals
+from utils.messages import REQUEST, PROFILE, PROFILE_REPORT
+from utils.enums import Request, Node, Overflow
+from utils.codec import encode, is_binary
+from utils.dispatch import MessageDispatcher
+from utils.metrics import MetricsReporter, timed
+from utils.profiling import start_profile
 from config.topics import Topics
-from schedule.master_schedule import clear_dirty_flag
+from config import METRICS_DIR, METRICS_INTERVAL, PROPOSAL_WORKERS
+from config import PROFILE_DIR, PROFILE_MAX_DURATION, PROFILE_SAMPLE_INTERVAL
 from utils import get_logger
 from mqtt import MQTTClient, MQTTConfig
 
-logger = getLogger("manager")
+logger = get_logger("manager")
 
 mqtt_client = MQTTClient(
     broker_host=MQTTConfig.BROKER_HOST,
@@ -19,50 +30,180 @@ mqtt_client = MQTTClient(
 )
 mqtt_client.connect()
 
+# Where each node expects schedule responses
+SCHEDULE_RESPONSE_TOPICS = {
+    Node.KIOSK: Topics.KIOSK_SCHEDULE_RESPONSE,
+    Node.RESERVATION: Topics.RESERVATION_SCHEDULE_RESPONSE,
+    Node.ADMIN: Topics.ADMIN_SCHEDULE_RESPONSE,
+}
+
 def start():
     logger.info("Starting schedule manager...")
-    mqtt_client.loop_forever()
-
-def handle_session_proposal(payload: dict):
-    """Handle an incoming session proposal from an external source."""
+    init_schedule_manager()
+    reporter = MetricsReporter(mqtt_client.publish, Topics.METRICS(Node.MANAGER.value), os.path.join(METRICS_DIR, "manager.prom"), METRICS_INTERVAL)
+    reporter.start()
     try:
-        session = SESSION(**payload)
-    except ValidationError as e:
-        logger.error(f"Invalid session proposal format: {e}")
-        response = ACKNOWLEDGE(success=False, message="Invalid session format")
-        mqtt_client.publish(Topics.TEST_SESSION_RESPONSE, response.model_dump())
-        return
+        # The MQTT network loop runs in its own thread, so just keep the process alive,
+        # clearing days that have passed from memory on startup and after every midnight
+        cleared_on = None
+        while True:
+            today = datetime.now().strftime("%Y-%m-%d")
+            if today != cleared_on:
+                clear_past_schedules()
+                cleared_on = today
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping schedule manager...")
+        reporter.stop()
+        stop_schedule_manager()
+
+def _respond(response: ACKNOWLEDGE, binary: bool = False):
+    # Answer in the format the request came in
+    mqtt_client.publish(Topics.TEST_SESSION_RESPONSE, encode(response, binary))
+
+def _proposal_model(data: dict) -> Optional[Type[BaseModel]]:
+    # Bare JSON proposals are a SESSION_BATCH if they list sessions, otherwise a SESSION
+    return SESSION_BATCH if "sessions" in data else SESSION
+
+def _reject_busy(topic: str, payload: Union[str, bytes]):
+    # Called on the network thread when the proposal queue is full, so answer without parsing the proposal
+    _respond(ACKNOWLEDGE(success=False, message="Manager is busy, try again"), is_binary(payload))
 
-    # Check availability
-    is_available = check_availability(
-        machine_ids=session.machine_ids,
-        start_time=session.start_time,
-        duration=session.duration
-    )
-
-    if not is_available:
-        logger.info(f"Session proposal rejected due to unavailability: {session}")
-        response = ACKNOWLEDGE(success=False, message="Requested time or machines are unavailable", session_id=session.session_id, exchange_id=session.exchange_id)
-        mqtt_client.publish(Topics.TEST_SESSION_RESPONSE, response.model_dump())
+@timed("proposal_seconds", "Time to answer a session proposal, from parsed message to queued reply")
+def handle_session_proposal(topic: str, proposal: Union[SESSION, SESSION_BATCH], binary: bool = False):
+    """
+    Handle an incoming session proposal from an external source.
+    The proposal is either a single SESSION or a SESSION_BATCH, whose sessions are booked all or nothing
+    and answered with one ACKNOWLEDGE carrying a result per session.
+    """
+    batch = proposal if isinstance(proposal, SESSION_BATCH) else None
+    sessions = batch.sessions if batch is not None else [proposal]
+
+    success, results = add_sessions(sessions)
+
+    if batch is None:
+        # Single proposal, answered the same way as before batches existed
+        session, result = sessions[0], results[0]
+        if success:
+            logger.info(f"Session successfully added: {session}")
+        else:
+            logger.info(f"Session proposal rejected: {result.message}: {session}")
+        _respond(ACKNOWLEDGE(success=success, message=result.message, session_id=session.session_id, exchange_id=session.exchange_id), binary)
         return
 
-    # Attempt to add the session
-    success = add_session(session)
+    rejected = sum(not result.success for result in results)
     if success:
-        logger.info(f"Session successfully added: {session}")
-        clear_dirty_flag()  # Reset schedule change flag if used
-        response = Acknowledge(success=True, message="Session added successfully", session_id=session.session_id, exchange_id=session.exchange_id)
+        logger.info(f"Batch of {len(sessions)} sessions successfully added.")
+        message = f"Added {len(sessions)} sessions"
+    else:
+        logger.info(f"Batch of {len(sessions)} sessions rejected, {rejected} could not be booked.")
+        message = f"Batch rejected: {rejected} of {len(sessions)} sessions could not be booked"
+
+    _respond(ACKNOWLEDGE(
+        success=success,
+        message=message,
+        exchange_id=batch.exchange_id,
+        results=[
+            ACKNOWLEDGE(success=result.success, message=result.message, session_id=result.session_id, exchange_id=batch.exchange_id)
+            for result in results
+        ]
+    ), binary)
+
+def handle_schedule_request(topic: str, request: REQUEST, binary: bool = False):
+    """
+    Answer a schedule request. Requesters that send the version and generation they already hold get a
+    SCHEDULE_DELTA with only the cells that changed since, and everyone else gets the full SCHEDULE.
+    Both are sent in the first of the requester's accept_encodings we support, or as JSON rows, and
+    binary requests are answered in the binary codec.
+    """
+    response_topic = SCHEDULE_RESPONSE_TOPICS.get(request.origin_node, Topics.TEST_SCHEDULE_RESPONSE)
+    if request.date is None:
+        logger.error(f"Schedule request {request.exchange_id} has no date.")
+        mqtt_client.publish(response_topic, encode(ACKNOWLEDGE(success=False, message="Schedule requests need a date", exchange_id=request.exchange_id), binary))
+        return
+
+    if request.since_version is not None and request.generation is not None:
+        schedule, changed = get_schedule_changes(request.date, request.since_version, request.generation)
+    else:
+        schedule, changed = get_master_schedule(request.date), None
+
+    encoding = negotiate_encoding(request.accept_encodings)
+    if changed is not None:
+        response = delta_message(
+            schedule, request.since_version, changed, encoding,
+            exchange_id=request.exchange_id,
+            origin_node=Node.MANAGER,
+            destination_node=request.origin_node
+        )
+        logger.debug(f"Sending {len(changed)} changed cells of {request.date} (v{request.since_version} to v{schedule.version}) as {encoding.value}.")
     else:
-        logger.warning(f"Failed to add session despite availability: {session}")
-        response = Acknowledge(success=False, message="Failed to add session", session_id=session.session_id, exchange_id=session.exchange_id)
+        response = schedule_message(
+            schedule, encoding,
+            exchange_id=request.exchange_id,
+            origin_node=Node.MANAGER,
+            destination_node=request.origin_node
+        )
+        logger.debug(f"Sending full schedule for {request.date} (v{schedule.version}) as {encoding.value}.")
+
+    mqtt_client.publish(response_topic, encode(response, binary))
+
+# Handler for each kind of REQUEST the manager serves
+REQUEST_HANDLERS = {
+    Request.SCHEDULE: handle_schedule_request,
+}
+
+def handle_request(topic: str, request: REQUEST, binary: bool = False):
+    handler = REQUEST_HANDLERS.get(request.request_type)
+    if handler is None:
+        logger.warning(f"Ignoring {request.request_type.value} request {request.exchange_id}: not served by the manager.")
+        return
+    handler(topic, request, binary)
+
+def handle_profile(topic: str, command: PROFILE, binary: bool = False):
+    """Profile the manager as the admin portal asks, and send it the hottest functions once done."""
+    def report(result: PROFILE_REPORT):
+        result.origin_node = Node.MANAGER
+        mqtt_client.publish(Topics.ADMIN_PROFILE_RESPONSE, encode(result, binary))
+
+    if not start_profile(command, os.path.join(PROFILE_DIR, Node.MANAGER.value), report, PROFILE_MAX_DURATION, PROFILE_SAMPLE_INTERVAL):
+        logger.warning(f"Ignoring profile command {command.exchange_id}: a profile is already running.")
+        mqtt_client.publish(Topics.ADMIN_PROFILE_RESPONSE, encode(ACKNOWLEDGE(
+            success=False, message="A profile is already running", exchange_id=command.exchange_id, origin_node=Node.MANAGER
+        ), binary))
 
-    mqtt_client.publish(Topics.TEST_SESSION_RESPONSE, response.model_dump())
+# Session proposals; each topic has its own dispatcher, so nothing is booked except through the
+# proposal queue and its overflow policy
+dispatcher = MessageDispatcher("manager_dispatch", legacy_model=_proposal_model)
+dispatcher.register(SESSION, handle_session_proposal)
+dispatcher.register(SESSION_BATCH, handle_session_proposal)
+
+# Requests for information, which never change the schedule
+request_dispatcher = MessageDispatcher("manager_request_dispatch", legacy_model=REQUEST)
+request_dispatcher.register(REQUEST, handle_request)
+
+# Commands from the admin portal, kept apart from the booking traffic
+admin_dispatcher = MessageDispatcher("manager_admin_dispatch", legacy_model=PROFILE)
+admin_dispatcher.register(PROFILE, handle_profile)
 
 
 def init_schedule_manager():
     """Initialize the schedule manager and subscribe to relevant topics."""
     logger.info("Initializing schedule manager...")
-    mqtt_client.subscribe(Topics.MANAGER_PROPOSE_SESSION, handle_session_proposal)
+    # Messages are handled on the client's worker threads, never on its network thread. Proposals for
+    # different days run in parallel, while those for the same day queue on that day's schedule lock.
+    # Proposals that do not fit in the queue are refused outright rather than dropped unanswered.
+    mqtt_client.subscribe(Topics.MANAGER_PROPOSE_SESSION, dispatcher, concurrency=PROPOSAL_WORKERS, overflow=Overflow.REJECT, on_reject=_reject_busy)
+    mqtt_client.subscribe(Topics.MANAGER_REQUEST_SCHEDULE, request_dispatcher, concurrency=PROPOSAL_WORKERS)
+    mqtt_client.subscribe(Topics.ADMIN_PROFILE(Node.MANAGER.value), admin_dispatcher)
+
+def stop_schedule_manager():
+    """Stop taking messages, wait for the bookings already made to reach disk, then disconnect."""
+    # Let queued proposals finish first, so nothing is booked after the schedules are flushed
+    mqtt_client.unsubscribe(Topics.MANAGER_PROPOSE_SESSION)
+    mqtt_client.unsubscribe(Topics.MANAGER_REQUEST_SCHEDULE)
+    if not close_schedules():
+        logger.error("Schedule changes could not all be written to disk before shutdown.")
+    mqtt_client.disconnect()
 
 if __name__ == "__main__":
-    start()
\ No newline at end of file
+    start()
@@ -1,59 +1,332 @@
 # schedule/master_schedule.py
 
+import atexit
+import time
+from collections import deque
 from threading import Lock
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
 from utils.logger import get_logger
+from utils.metrics import metrics, stats_collector
 
-from schedule.file_io import load_schedule_from_disk, save_schedule_to_disk
+from config import JOURNAL_COMPACT_THRESHOLD, PERSIST_FLUSH_COUNT, PERSIST_FLUSH_INTERVAL
+from config import SCHEDULE_CACHE_MAX_DAYS, SCHEDULE_CACHE_MAX_BYTES, SCHEDULE_CACHE_PINNED_DAYS, SCHEDULE_HISTORY_LENGTH
+from schedule.file_io import load_schedule_from_disk, save_schedule_to_disk, open_journal, release_day_file, export_schedule_json
+from schedule.schedule_cache import ScheduleCache
+from schedule.persistence import PersistenceWorker
+from schedule.journal import ScheduleJournal, apply_mutation
+from schedule.session_store import sync_session_store
+from schedule.schedule_grid import ScheduleGrid
 
 logger = get_logger("master_schedule")
 
-# Shared master schedule dictionary and lock
-master_schedule: Dict[str, List[list]] = {}
-_schedule_lock = Lock()
+_journals: Dict[str, ScheduleJournal] = {}
+_needs_snapshot: Set[str] = set()  # Days replaced wholesale that must be written as a new snapshot
+_history: Dict[str, Deque[Tuple[int, List[Tuple[int, int]]]]] = {}  # Recent (version, changed cells) per day, guarded by _cache_lock
 _today_changed = False
+_last_generation = 0
 
-def get_master_schedule(date: str) -> List[list]:
-    with _schedule_lock:
+# Writes to a day hold that day's lock, so days are updated, loaded and compacted independently.
+# _cache_lock only guards the shared cache structure and is held briefly, always after any date lock.
+# Disk I/O never happens under it: days are written back under their own lock when evicted.
+_date_locks: Dict[str, Lock] = {}
+_date_locks_guard = Lock()
+_cache_lock = Lock()
+_flag_lock = Lock()
+_generation_lock = Lock()
+
+def _date_lock(date: str) -> Lock:
+    lock = _date_locks.get(date)
+    if lock is None:
+        with _date_locks_guard:
+            lock = _date_locks.setdefault(date, Lock())
+    return lock
+
+def _new_generation() -> int:
+    # Millisecond clock, but never repeated: a day evicted and reloaded within a millisecond must not
+    # get its old generation back, or a version from before the reload would look current
+    global _last_generation
+    with _generation_lock:
+        _last_generation = max(time.time_ns() // 1_000_000, _last_generation + 1)
+        return _last_generation
+
+def _load_schedule(date: str) -> ScheduleGrid:
+    # Map the latest snapshot and replay the journal tail on top of it. Must hold the date's lock.
+    logger.info("Date does not exist in master schedule. Pulling from disk")
+    schedule = load_schedule_from_disk(date)
+    try:
+        journal = open_journal(date)
+        for record in journal.records():
+            apply_mutation(schedule, record)
+    except Exception:
+        # The day never reaches the cache, so eviction would not unmap its file
+        release_day_file(date)
+        raise
+    if len(journal):
+        logger.info(f"Replayed {len(journal)} journal records for {date}.")
+        master_schedule.mark_dirty(date)
+    _journals[date] = journal
+    # Versions restart with every load, so clients holding an older generation get the full schedule
+    schedule.generation = _new_generation()
+    with _cache_lock:
+        _history[date] = deque(maxlen=SCHEDULE_HISTORY_LENGTH)
+    return schedule.freeze()
+
+def _compact(date: str):
+    # Write the in-memory schedule as the new snapshot, then drop the journal records it now contains.
+    # Must hold the date's lock; the cache takes it itself before writing back an evicted day.
+    journal = _journals[date]
+    journal.sync()
+    if not save_schedule_to_disk(date, master_schedule.peek(date)):
+        raise IOError(f"Failed to write snapshot for {date}")
+    journal.reset()
+    logger.debug(f"Compacted schedule journal for {date}.")
+
+def _release(date: str):
+    # Close the journal and unmap the day file of an evicted day
+    journal = _journals.pop(date, None)
+    if journal is not None:
+        journal.close()
+    with _cache_lock:
+        _history.pop(date, None)
+    release_day_file(date)
+
+# Shared master schedule cache and lock
+master_schedule = ScheduleCache(
+    load=_load_schedule,
+    write_back=_compact,
+    release=_release,
+    max_days=SCHEDULE_CACHE_MAX_DAYS,
+    max_bytes=SCHEDULE_CACHE_MAX_BYTES,
+    pinned_days=SCHEDULE_CACHE_PINNED_DAYS,
+    locks=_date_lock,
+    guard=_cache_lock,
+)
+
+def _persist_dates(dates: List[str]):
+    # Runs on the persistence worker: one journal write per dirty day, compacting the ones that grew large.
+    # The session store goes first, so a crash in between leaves it ahead of the schedules, never behind
+    sync_session_store()
+    for date in dates:
+        journal = _journals.get(date)
+        if journal is None:
+            continue  # Evicted since it was queued, which already wrote it back
+        journal.sync()
+
+        if len(journal) >= JOURNAL_COMPACT_THRESHOLD or date in _needs_snapshot:
+            # Only writers of this day wait for the snapshot
+            with _date_lock(date):
+                if date in master_schedule:
+                    master_schedule.flush(date)
+                _needs_snapshot.discard(date)
+
+# Background writer for schedule changes
+_persistence = PersistenceWorker(
+    flush_dates=_persist_dates,
+    flush_interval=PERSIST_FLUSH_INTERVAL,
+    flush_count=PERSIST_FLUSH_COUNT,
+)
+atexit.register(_persistence.stop)
+
+def _flag_change(date: str):
+    global _today_changed
+    # Raise the update flag if schedule changed is today
+    today_date = datetime.now().strftime("%Y-%m-%d")
+    if today_date == date:
+        with _flag_lock:
+            _today_changed = True
+        logger.debug("Master schedule updated for today. Flag set.")
+    else:
+        logger.debug("Master schedule updated.")
+
+def _publish(date: str, schedule: ScheduleGrid, previous: Optional[ScheduleGrid]):
+    # Swap in a new frozen version of the day. Readers holding the previous version are unaffected. Must hold _cache_lock.
+    history = _history.setdefault(date, deque(maxlen=SCHEDULE_HISTORY_LENGTH))
+    if previous is not None and previous.generation == schedule.generation:
+        schedule.version = previous.version + 1
+        history.append((schedule.version, schedule.diff(previous)))
+    else:
+        # A day that was not loaded yet, or replaced by one from another generation, starts a new history
+        schedule.version = 0
+        schedule.generation = _new_generation()
+        history.clear()
+    master_schedule.put(date, schedule.freeze())
+
+def _current(date: str) -> ScheduleGrid:
+    # Latest version of the day, loading it on a miss. Must hold the date's lock, which keeps the
+    # disk read out of _cache_lock and stops the day being evicted until the caller is done.
+    schedule = master_schedule.peek(date)
+    if schedule is None:
+        schedule = _load_schedule(date)
+        with _cache_lock:
+            master_schedule.add_loaded(date, schedule)
+    return schedule
+
+def get_master_schedule(date: str) -> ScheduleGrid:
+    """
+    Return the current immutable snapshot of the day without taking any lock unless it has to be loaded,
+    in which case only readers and writers of the same day wait. Call copy() on the result for an editable schedule.
+    """
+    schedule = master_schedule.lookup(date)
+    if schedule is None:
+        with _date_lock(date):
+            schedule = _current(date)
+        master_schedule.enforce_budget(keep=date)
+    return schedule
+
+def get_schedule_changes(date: str, since_version: int, generation: int) -> Tuple[ScheduleGrid, Optional[List[Tuple[int, int]]]]:
+    """
+    Return the current snapshot of the day and the (bucket, machine_id) cells changed since the given
+    version. The cells are None when the version is from another generation or older than the kept
+    history, in which case the caller has to send the full schedule.
+    """
+    schedule = get_master_schedule(date)
+    with _cache_lock:
+        # Read the snapshot and its history together so they describe the same version
+        schedule = master_schedule.peek(date) or schedule
+        history = list(_history.get(date, ()))
+
+    if generation != schedule.generation or since_version > schedule.version:
+        return schedule, None
+    if since_version == schedule.version:
+        return schedule, []
+
+    newer = [(version, cells) for version, cells in history if since_version < version <= schedule.version]
+    if not newer or newer[0][0] != since_version + 1:
+        return schedule, None  # History no longer reaches back to the client's version
+
+    changed = set()
+    for _, cells in newer:
+        changed.update(cells)
+    return schedule, sorted(changed)
+
+class ScheduleConflict(Exception):
+    '''Raised when a day changed after the snapshot a batch of mutations was checked against'''
+
+
+def apply_batch(changes: Dict[str, List[dict]], expected_versions: Optional[Dict[str, Tuple[int, int]]] = None,
+                on_commit: Optional[Callable[[], None]] = None) -> bool:
+    """
+    Apply mutations to several days at once, all or nothing, with one journal append per day.
+    If expected_versions is given, every day must still be at the (generation, version) the caller
+    checked the mutations against, otherwise ScheduleConflict is raised and nothing is applied.
+    Versions restart when a day is reloaded, so the generation is needed to tell them apart.
+    Only the locks of the days involved are taken, so batches for other days run concurrently.
+    on_commit runs once the batch is published, before the persistence worker is told about it, so
+    whatever it records (the session store) is written out by the same flush as the journals.
+    The journals are written by the persistence worker shortly after; call flush_schedules() to wait for it.
+    """
+    # Lock days in date order so overlapping batches cannot deadlock
+    locks = [_date_lock(date) for date in sorted(changes)]
+    for lock in locks:
+        lock.acquire()
+    try:
         try:
-            # If schedule currently loaded
-            return master_schedule[date].copy()
-        except:
-            # Otherwise load schedule
-            logger.info("Date does not exist in master schedule. Pulling from disk")
-            master_schedule[date] = load_schedule_from_disk(date)
-            return master_schedule[date].copy()
-
-def update_master_schedule(date: str, new_schedule: List[list]):
-    global master_schedule, _today_changed
-    with _schedule_lock:
+            current = {date: _current(date) for date in changes}
+        except Exception as e:
+            logger.error(f"Master schedule failed to load: {e}")
+            return False
+
+        if expected_versions is not None:
+            stale = [date for date in changes if (current[date].generation, current[date].version) != expected_versions.get(date)]
+            if stale:
+                raise ScheduleConflict(f"Schedules changed since they were checked: {stale}")
+
+        try:
+            # Apply the changes to private copies so readers never see a half-applied batch
+            updated = {}
+            for date, records in changes.items():
+                schedule = current[date].copy()
+                for record in records:
+                    apply_mutation(schedule, record)
+                updated[date] = schedule
+
+            # Journal every day before publishing any, so the in-memory schedule never gets ahead of the log
+            for date, records in changes.items():
+                _journals[date].append(records)
+            with _cache_lock:
+                for date in changes:
+                    _publish(date, updated[date], current[date])
+                    master_schedule.mark_dirty(date)
+            if on_commit is not None:
+                try:
+                    on_commit()
+                except Exception as e:
+                    # The schedule already holds the batch, so it still counts as committed
+                    logger.error(f"Failed to record a committed batch outside the schedule: {e}")
+            for date, records in changes.items():
+                _persistence.mark_dirty(date, len(records))
+                _flag_change(date)
+            return True
+
+        except Exception as e:
+            logger.error(f"Master schedule failed to update: {e}")
+            return False
+    finally:
+        for lock in locks:
+            lock.release()
+        # Days loaded or grown by the batch may push others out, which writes them back under their own locks
+        master_schedule.enforce_budget()
+
+def apply_mutations(date: str, records: List[dict], expected_version: Optional[Tuple[int, int]] = None,
+                    on_commit: Optional[Callable[[], None]] = None) -> bool:
+    """Append schedule mutations to the date's journal and apply them to the in-memory schedule."""
+    return apply_batch({date: records}, None if expected_version is None else {date: expected_version}, on_commit)
+
+def update_master_schedule(date: str, new_schedule: ScheduleGrid):
+    """Replace a whole day. The persistence worker writes it as the new snapshot."""
+    with _date_lock(date):
         try:
-            # Save the new schedule to the shared dict and to appropriate file on disk
-            master_schedule[date] = new_schedule
-            save_schedule_to_disk(date, new_schedule)
-            
-            # Raise the update flag if schedule changed is today
-            today_date = datetime.now().strftime("%Y-%m-%d")
-            if today_date == date:
-                _today_changed = True
-                logger.debug("Master schedule updated for today. Flag set.")
-            else:
-                logger.debug("Master schedule updated.")
-            
+            # Save the new schedule to the shared cache and to appropriate file on disk
+            if date not in _journals:
+                _journals[date] = open_journal(date)
+            with _cache_lock:
+                _publish(date, new_schedule, master_schedule.peek(date))
+                master_schedule.mark_dirty(date)
+            _needs_snapshot.add(date)
+            _persistence.mark_dirty(date)
+            _flag_change(date)
+
         except:
             logger.error("Master schedule failed to update.")
+    master_schedule.enforce_budget(keep=date)
+
+def flush_schedules(timeout: Optional[float] = None) -> bool:
+    """Durability barrier: wait until every change made so far is on disk. Returns False on timeout."""
+    return _persistence.flush(timeout)
+
+def close_schedules(timeout: Optional[float] = None) -> bool:
+    """For shutdown: wait until every change is on disk, then stop the persistence worker. Returns False on timeout."""
+    flushed = flush_schedules(timeout)
+    _persistence.stop(timeout)
+    return flushed
+
+def get_persistence_stats() -> Dict[str, float]:
+    return _persistence.stats()
 
 def get_schedule_flag() -> bool:
-    with _schedule_lock:
+    with _flag_lock:
         return _today_changed
 
 def clear_schedule_flag():
     global _today_changed
-    with _schedule_lock:
+    with _flag_lock:
         _today_changed = False
         logger.debug("Machines updated to match schedule. Update flag cleared.")
 
+def export_master_schedule(date: str, filename: Optional[str] = None) -> bool:
+    """Export a day as JSON, including changes still only in its journal."""
+    return export_schedule_json(get_master_schedule(date), filename)
+
 def clear_past_schedules():
-    ### This function should run periodically, maybe every day or so and pop master_schedule entries with a date that has already passed.
-    pass
\ No newline at end of file
+    """Write back and evict every cached day that has already passed. Run periodically, e.g. once a day."""
+    evicted = master_schedule.evict_past()
+    if evicted:
+        logger.info(f"Cleared {len(evicted)} past schedules from memory: {evicted}")
+
+def get_cache_stats() -> Dict[str, int]:
+    with _cache_lock:
+        return master_schedule.stats()
+
+metrics.collect_from("schedule_cache", stats_collector(get_cache_stats), "Day schedules held in memory")
+metrics.collect_from("schedule_persistence", stats_collector(get_persistence_stats), "Schedule changes waiting to be written to disk")
@@ -0,0 +1,154 @@
+# schedule/persistence.py
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from utils.logger import get_logger
+
+logger = get_logger("persistence")
+
+
+class PersistenceWorker:
+    """
+    Background write-behind for schedule changes.
+
+    Writers call mark_dirty() and return immediately. The worker coalesces dirty dates and hands them to
+    flush_dates in one batch once flush_count changes are pending or flush_interval seconds have passed
+    since the oldest unflushed change, so a burst of bookings costs one write per date.
+    flush() is a durability barrier: it returns once every change marked before the call is on disk.
+    """
+
+    def __init__(self, flush_dates: Callable[[List[str]], None], flush_interval: float = 1.0, flush_count: int = 16):
+        self._flush_dates = flush_dates
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+        # Pending work
+        self._dirty: Set[str] = set()
+        self._pending = 0  # Changes since the last flush
+        self._oldest_change: Optional[float] = None
+        self._flush_requested = False
+
+        # Barrier bookkeeping: every change gets a ticket, each flush completes all tickets issued before it started
+        self._issued = 0
+        self._completed = 0
+
+        # Metrics
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="schedule-persistence", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Flush everything that is pending and stop the worker."""
+        with self._condition:
+            if self._thread is None:
+                return
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def mark_dirty(self, date: str, changes: int = 1):
+        """Queue a date for writing. Starts the worker on first use."""
+        if self._thread is None:
+            self.start()
+        with self._condition:
+            self._dirty.add(date)
+            self._pending += changes
+            self._issued += 1
+            if self._oldest_change is None:
+                self._oldest_change = time.monotonic()
+            if self._pending >= self.flush_count:
+                self._condition.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Write every queued date now and wait for it. Returns False if the timeout expired first."""
+        with self._condition:
+            target = self._issued
+            if self._completed >= target:
+                return True
+            if self._thread is None:
+                self.start()
+            self._flush_requested = True
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: self._completed >= target, timeout)
+
+    def stats(self) -> Dict[str, float]:
+        with self._condition:
+            return {
+                "queue_depth": len(self._dirty),
+                "pending_changes": self._pending,
+                "flushes": self.flushes,
+                "failures": self.failures,
+                "last_flush_latency": self.last_flush_latency,
+                "max_flush_latency": self.max_flush_latency,
+            }
+
+    def _ready(self) -> bool:
+        # Must hold _condition
+        if not self._dirty:
+            return self._stopping
+        if self._stopping or self._flush_requested or self._pending >= self.flush_count:
+            return True
+        return time.monotonic() - self._oldest_change >= self.flush_interval
+
+    def _timeout(self) -> Optional[float]:
+        # How long to sleep before the oldest change reaches the flush interval
+        if self._oldest_change is None:
+            return None
+        return max(0.0, self.flush_interval - (time.monotonic() - self._oldest_change))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._ready():
+                    self._condition.wait(self._timeout())
+                if self._stopping and not self._dirty:
+                    return
+
+                # Take the whole batch so writers can keep queueing while it is written
+                dates = sorted(self._dirty)
+                target = self._issued
+                self._dirty.clear()
+                self._pending = 0
+                self._oldest_change = None
+                self._flush_requested = False
+
+            started = time.monotonic()
+            try:
+                self._flush_dates(dates)
+                failed = False
+            except Exception as e:
+                failed = True
+                logger.error(f"Failed to persist schedules for {dates}: {e}")
+            latency = time.monotonic() - started
+
+            with self._condition:
+                if failed:
+                    # Requeue the dates and retry after the next interval
+                    self.failures += 1
+                    self._dirty.update(dates)
+                    self._oldest_change = time.monotonic()
+                    if self._stopping:
+                        return
+                else:
+                    self.flushes += 1
+                    self.last_flush_latency = latency
+                    self.max_flush_latency = max(self.max_flush_latency, latency)
+                    self._completed = max(self._completed, target)
+                    self._condition.notify_all()
+                    logger.debug(f"Persisted schedules for {dates} in {latency * 1000:.1f} ms.")
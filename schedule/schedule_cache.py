@@ -0,0 +1,213 @@
+# schedule/schedule_cache.py
+
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from schedule.schedule_grid import ScheduleGrid
+from utils.logger import get_logger
+
+logger = get_logger("schedule_cache")
+
+
+class ScheduleCache:
+    """
+    Bounded cache of day schedules.
+
+    Today and the next pinned_days days are never evicted. Past days go first when the cache is over
+    its day or memory budget, then the least recently used future days. Dirty days are written back
+    before they are evicted.
+
+    lookup() is safe to call without a lock because a cached schedule is replaced by swapping a
+    single dict entry. get(), add_loaded(), put() and the write-back calls must be serialized by the
+    caller, and never iterate the dict directly so concurrent lookups cannot break it.
+    If locks is given it returns the lock guarding writes to a day. Eviction skips days whose lock is
+    held elsewhere and holds it while writing the day back, so a day is never evicted mid-update.
+    Eviction takes guard, the caller's lock over the cache, only to drop the entry, so evict(),
+    evict_past() and enforce_budget() are called without it and a slow write back only holds up
+    writers of the day being evicted. put() and add_loaded() leave the budget to enforce_budget(),
+    which callers run once their update is complete.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[str], ScheduleGrid],
+        write_back: Callable[[str], None],
+        release: Optional[Callable[[str], None]] = None,
+        max_days: int = 14,
+        max_bytes: Optional[int] = None,
+        pinned_days: int = 7,
+        locks: Optional[Callable[[str], Lock]] = None,
+        guard: Optional[Lock] = None,
+    ):
+        self._load = load  # Loads a day that is not cached
+        self._write_back = write_back  # Persists a dirty day
+        self._release = release  # Frees any other resources held for a day after eviction
+        self.max_days = max_days
+        self.max_bytes = max_bytes
+        self.pinned_days = pinned_days
+        self._locks = locks
+        self._guard = guard if guard is not None else nullcontext()
+
+        self._days: "OrderedDict[str, ScheduleGrid]" = OrderedDict()  # Least recently used first
+        self._dirty: Set[str] = set()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.write_backs = 0
+
+    # === Lookup ===
+
+    def __contains__(self, date: str) -> bool:
+        return date in self._days
+
+    def __len__(self) -> int:
+        return len(self._days)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._days))
+
+    def lookup(self, date: str) -> Optional[ScheduleGrid]:
+        """Lock-free read of a cached day. Returns None on a miss without loading anything."""
+        schedule = self._days.get(date)
+        if schedule is not None:
+            self.hits += 1
+            try:
+                self._days.move_to_end(date)
+            except KeyError:
+                pass  # Evicted by a writer in the meantime; the snapshot we hold is still valid
+        return schedule
+
+    def get(self, date: str) -> ScheduleGrid:
+        """Return the day's schedule, loading it and enforcing the budget on a miss."""
+        schedule = self._days.get(date)
+        if schedule is not None:
+            self.hits += 1
+            self._days.move_to_end(date)
+            return schedule
+
+        schedule = self._load(date)
+        self.add_loaded(date, schedule)
+        self.enforce_budget(keep=date)
+        return schedule
+
+    def add_loaded(self, date: str, schedule: ScheduleGrid):
+        """Insert a day the caller loaded itself after a miss, e.g. to keep disk reads out of a shared lock."""
+        self.misses += 1
+        self._days[date] = schedule
+
+    def peek(self, date: str) -> Optional[ScheduleGrid]:
+        """Return the day's schedule if cached, without loading it or touching the counters."""
+        return self._days.get(date)
+
+    def put(self, date: str, schedule: ScheduleGrid):
+        """Insert or replace a day's schedule."""
+        self._days[date] = schedule
+        self._days.move_to_end(date)
+
+    # === Write back ===
+
+    def mark_dirty(self, date: str):
+        self._dirty.add(date)
+
+    def is_dirty(self, date: str) -> bool:
+        return date in self._dirty
+
+    def flush(self, date: str):
+        """Write a dirty day back to disk."""
+        if date in self._dirty:
+            self._write_back(date)
+            self._dirty.discard(date)
+            self.write_backs += 1
+
+    def flush_all(self):
+        for date in list(self._dirty):
+            self.flush(date)
+
+    # === Eviction ===
+
+    def is_pinned(self, date: str, today: Optional[str] = None) -> bool:
+        """Today and the following pinned_days days stay cached."""
+        today = today or datetime.now().strftime("%Y-%m-%d")
+        last_pinned = (datetime.strptime(today, "%Y-%m-%d") + timedelta(days=self.pinned_days)).strftime("%Y-%m-%d")
+        return today <= date <= last_pinned
+
+    def evict(self, date: str) -> bool:
+        """
+        Write back and drop a day. Returns False if the day is not cached, is being updated, or could
+        not be written back, in which case it stays cached and dirty for a later attempt.
+        """
+        if date not in self._days:
+            return False
+        lock = self._locks(date) if self._locks is not None else None
+        if lock is not None and not lock.acquire(blocking=False):
+            logger.debug(f"Skipped evicting schedule for {date} while it is being updated.")
+            return False
+        try:
+            try:
+                self.flush(date)
+            except Exception as e:
+                logger.error(f"Failed to write back schedule for {date}, keeping it cached: {e}")
+                return False
+            with self._guard:
+                self._days.pop(date, None)
+            if self._release is not None:
+                self._release(date)
+        finally:
+            if lock is not None:
+                lock.release()
+        self.evictions += 1
+        logger.debug(f"Evicted schedule for {date} from the cache.")
+        return True
+
+    def evict_past(self, today: Optional[str] = None) -> List[str]:
+        """Evict every day before today. Returns the evicted dates."""
+        today = today or datetime.now().strftime("%Y-%m-%d")
+        with self._guard:
+            past = [date for date in list(self._days) if date < today]
+        return [date for date in past if self.evict(date)]
+
+    def nbytes(self) -> int:
+        return sum(schedule.nbytes for schedule in list(self._days.values()))
+
+    def _over_budget(self) -> bool:
+        if len(self._days) > self.max_days:
+            return True
+        return self.max_bytes is not None and self.nbytes() > self.max_bytes
+
+    def enforce_budget(self, keep: Optional[str] = None):
+        """Evict days until the cache is within its budget, sparing keep, today and the pinned days."""
+        if not self._over_budget():
+            return
+
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._guard:
+            dates = list(self._days)
+        # Past days first, then the least recently used unpinned days
+        candidates = [date for date in dates if date < today and date != keep]
+        candidates += [date for date in dates if date >= today and date != keep and not self.is_pinned(date, today)]
+
+        for date in candidates:
+            if not self._over_budget():
+                return
+            self.evict(date)
+
+        if self._over_budget():
+            logger.warning(f"Schedule cache holds {len(self._days)} days, over its budget, because they are pinned, in use or failed to write back.")
+
+    # === Metrics ===
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "days": len(self._days),
+            "bytes": self.nbytes(),
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "write_backs": self.write_backs,
+        }
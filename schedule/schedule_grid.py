@@ -0,0 +1,302 @@
+# schedule/schedule_grid.py
+
+import time
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from utils.enums import Status
+from utils.messages import MACHINE, trusted
+from schedule.availability_index import AvailabilityIndex
+from schedule.time_index import bucket_of
+
+# Status values are stored as one byte per cell using their position in the Status enum
+STATUS_CODES: List[Status] = list(Status)
+STATUS_TO_CODE: Dict[Status, int] = {status: code for code, status in enumerate(STATUS_CODES)}
+AVAILABLE_CODE = STATUS_TO_CODE[Status.AVAILABLE]
+
+# Sentinels for empty cells
+NO_SESSION = -1
+NOT_SCHEDULED = -1.0
+
+# Every MACHINE field in declaration order; the ones a grid cell does not hold stay None
+_MACHINE_FIELDS = dict.fromkeys(MACHINE.model_fields)
+
+
+def _copy_column(typecode: str, column) -> array:
+    copied = array(typecode)
+    copied.frombytes(memoryview(column).cast("B"))
+    return copied
+
+
+class ScheduleGrid:
+    """
+    Compact schedule for a single day.
+
+    Cells are addressed by [bucket, machine] but stored machine-major in three flat columns
+    (status code, session ID and scheduled_until) so that a machine's time window is one
+    contiguous slice. Columns are arrays the grid owns, so a frozen snapshot never changes.
+    MACHINE objects are only built on demand for callers that need them.
+
+    Published schedules are frozen snapshots tagged with a version. Writers copy() a snapshot,
+    change the copy and publish it as a new version, so readers never need a lock. Versions restart
+    whenever the day is loaded again, which starts a new generation.
+    """
+
+    def __init__(
+        self,
+        date: str,
+        day_start: float,
+        bucket_size: int,
+        num_buckets: int,
+        machine_ids: Iterable[int],
+        status: Optional[array] = None,
+        session_ids: Optional[array] = None,
+        scheduled_until: Optional[array] = None,
+        index: Optional[AvailabilityIndex] = None,
+    ):
+        self.date = date
+        self.day_start = day_start  # Epoch time of the first time bucket
+        self.bucket_size = bucket_size  # Length of a time bucket in seconds
+        self.num_buckets = num_buckets
+        self.machine_ids: List[int] = list(machine_ids)
+        self._machine_index: Dict[int, int] = {mid: i for i, mid in enumerate(self.machine_ids)}
+
+        cells = num_buckets * len(self.machine_ids)
+        self.status = status if status is not None else array("B", [AVAILABLE_CODE]) * cells
+        self.session_ids = session_ids if session_ids is not None else array("q", [NO_SESSION]) * cells
+        self.scheduled_until = scheduled_until if scheduled_until is not None else array("d", [NOT_SCHEDULED]) * cells
+
+        # Bitmask of free buckets per machine, kept in sync by set_cells
+        if index is None:
+            index = AvailabilityIndex.from_columns(self.status, num_buckets, self.machine_ids, AVAILABLE_CODE)
+        self.index = index
+
+        self.version = 0  # Bumped every time a changed copy of the day is published
+        self.generation = 0  # Set when the day is loaded; versions are only comparable within one generation
+        self.frozen = False
+
+    # === Addressing ===
+
+    def __len__(self) -> int:
+        return self.num_buckets
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the cell columns."""
+        return sum(memoryview(column).nbytes for column in (self.status, self.session_ids, self.scheduled_until))
+
+    def has_machine(self, machine_id: int) -> bool:
+        return machine_id in self._machine_index
+
+    def timestamp(self, bucket: int) -> int:
+        """Epoch time at the start of the given time bucket."""
+        return int(self.day_start + bucket * self.bucket_size)
+
+    def bucket_index(self, timestamp: float) -> Optional[int]:
+        """Returns the index of the time bucket containing the given epoch time, or None if outside the day."""
+        index = bucket_of(timestamp, self.day_start, self.bucket_size)
+        if 0 <= index < self.num_buckets:
+            return index
+        return None
+
+    def _offset(self, bucket: int, machine_id: int) -> int:
+        return self._machine_index[machine_id] * self.num_buckets + bucket
+
+    # === Cell access ===
+
+    def status_at(self, bucket: int, machine_id: int) -> Status:
+        return STATUS_CODES[self.status[self._offset(bucket, machine_id)]]
+
+    def session_at(self, bucket: int, machine_id: int) -> Optional[int]:
+        session_id = self.session_ids[self._offset(bucket, machine_id)]
+        return None if session_id == NO_SESSION else session_id
+
+    def _cell_fields(self, bucket: int, machine_id: int, timestamp: float) -> dict:
+        # The cell as MACHINE.model_dump() would give it
+        offset = self._offset(bucket, machine_id)
+        session_id = self.session_ids[offset]
+        scheduled_until = self.scheduled_until[offset]
+        fields = _MACHINE_FIELDS.copy()
+        fields["machine_id"] = machine_id
+        fields["session_id"] = None if session_id == NO_SESSION else session_id
+        fields["status"] = STATUS_CODES[self.status[offset]]
+        fields["scheduled_until"] = None if scheduled_until == NOT_SCHEDULED else scheduled_until
+        fields["timestamp"] = timestamp
+        return fields
+
+    def cell(self, bucket: int, machine_id: int, timestamp: Optional[float] = None) -> MACHINE:
+        """
+        Build a MACHINE view of a single cell.
+        Cells come from the grid, never from outside the hub, so the model is built without validation.
+        """
+        return trusted(MACHINE, self._cell_fields(bucket, machine_id, time.time() if timestamp is None else timestamp))
+
+    def bucket(self, bucket: int) -> list:
+        """Build the legacy [timestamp, MACHINE, MACHINE, ...] row for a time bucket."""
+        now = time.time()
+        return [self.timestamp(bucket)] + [self.cell(bucket, mid, now) for mid in self.machine_ids]
+
+    def __getitem__(self, bucket: int) -> list:
+        if bucket < 0:
+            bucket += self.num_buckets
+        if not 0 <= bucket < self.num_buckets:
+            raise IndexError("time bucket index out of range")
+        return self.bucket(bucket)
+
+    def __iter__(self) -> Iterator[list]:
+        for bucket in range(self.num_buckets):
+            yield self.bucket(bucket)
+
+    # === Queries ===
+
+    def is_available(self, machine_ids: Union[int, List[int]], start: int, end: int) -> bool:
+        """
+        Returns True if every listed machine is AVAILABLE for buckets [start, end).
+        Unknown machines and windows outside the day are never available.
+        """
+        if isinstance(machine_ids, int):
+            machine_ids = [machine_ids]
+        if start < 0 or end > self.num_buckets or start > end:
+            return False
+        if not all(mid in self._machine_index for mid in machine_ids):
+            return False
+        return self.index.is_free(machine_ids, start, end)
+
+    # === Mutation ===
+
+    def freeze(self) -> "ScheduleGrid":
+        """Mark the grid as a published snapshot that can no longer be changed."""
+        self.frozen = True
+        return self
+
+    def _check_mutable(self):
+        if self.frozen:
+            raise TypeError(f"Schedule snapshot for {self.date} (version {self.version}) is frozen; copy() it to make changes")
+
+    def set_cells(
+        self,
+        machine_ids: Union[int, List[int]],
+        start: int,
+        end: int,
+        status: Status,
+        session_id: Optional[int] = None,
+        scheduled_until: Optional[float] = None,
+    ):
+        """Overwrite buckets [start, end) of the listed machines with the given values."""
+        self._check_mutable()
+        if isinstance(machine_ids, int):
+            machine_ids = [machine_ids]
+        length = end - start
+        status_run = array("B", [STATUS_TO_CODE[status]]) * length
+        session_run = array("q", [NO_SESSION if session_id is None else session_id]) * length
+        until_run = array("d", [NOT_SCHEDULED if scheduled_until is None else scheduled_until]) * length
+
+        for machine_id in machine_ids:
+            base = self._machine_index[machine_id] * self.num_buckets
+            self.status[base + start:base + end] = status_run
+            self.session_ids[base + start:base + end] = session_run
+            self.scheduled_until[base + start:base + end] = until_run
+
+        self.index.mark(machine_ids, start, end, free=status == Status.AVAILABLE)
+
+    def set_status(self, machine_ids: Union[int, List[int]], start: int, end: int, status: Status):
+        """Change the status of buckets [start, end) of the listed machines, keeping their session details."""
+        self._check_mutable()
+        if isinstance(machine_ids, int):
+            machine_ids = [machine_ids]
+        status_run = array("B", [STATUS_TO_CODE[status]]) * (end - start)
+
+        for machine_id in machine_ids:
+            base = self._machine_index[machine_id] * self.num_buckets
+            self.status[base + start:base + end] = status_run
+
+        self.index.mark(machine_ids, start, end, free=status == Status.AVAILABLE)
+
+    def clear_session(self, session_id: int) -> List[int]:
+        """Make every cell booked by the session AVAILABLE again. Returns the machines that were cleared."""
+        self._check_mutable()
+        cleared = []
+        for machine_id in self.machine_ids:
+            base = self._machine_index[machine_id] * self.num_buckets
+            buckets = [b for b, sid in enumerate(self.session_ids[base:base + self.num_buckets]) if sid == session_id]
+            if buckets:
+                self.set_cells(machine_id, buckets[0], buckets[-1] + 1, Status.AVAILABLE)
+                cleared.append(machine_id)
+        return cleared
+
+    def copy(self) -> "ScheduleGrid":
+        """Mutable copy of the grid, keeping its version."""
+        copied = ScheduleGrid(
+            date=self.date,
+            day_start=self.day_start,
+            bucket_size=self.bucket_size,
+            num_buckets=self.num_buckets,
+            machine_ids=self.machine_ids,
+            status=_copy_column("B", self.status),
+            session_ids=_copy_column("q", self.session_ids),
+            scheduled_until=_copy_column("d", self.scheduled_until),
+            index=self.index.copy(),
+        )
+        copied.version = self.version
+        copied.generation = self.generation
+        return copied
+
+    def diff(self, other: "ScheduleGrid") -> List[Tuple[int, int]]:
+        """(bucket, machine_id) of every cell that differs from another grid of the same shape."""
+        changed = []
+        columns = [(memoryview(mine).cast("B"), memoryview(theirs).cast("B"), memoryview(mine).itemsize)
+                   for mine, theirs in ((self.status, other.status), (self.session_ids, other.session_ids), (self.scheduled_until, other.scheduled_until))]
+        for i, machine_id in enumerate(self.machine_ids):
+            lo, hi = i * self.num_buckets, (i + 1) * self.num_buckets
+            # Compare whole machine blocks first, which skips the untouched machines
+            if all(mine[lo * size:hi * size] == theirs[lo * size:hi * size] for mine, theirs, size in columns):
+                continue
+            for offset in range(lo, hi):
+                if (self.status[offset] != other.status[offset]
+                        or self.session_ids[offset] != other.session_ids[offset]
+                        or self.scheduled_until[offset] != other.scheduled_until[offset]):
+                    changed.append((offset - lo, machine_id))
+        return changed
+
+    # === Conversion ===
+
+    def to_rows(self) -> List[list]:
+        """Serialize to the legacy JSON layout of [timestamp, machine dict, ...] rows."""
+        now = time.time()
+        return [
+            [self.timestamp(bucket)] + [self._cell_fields(bucket, mid, now) for mid in self.machine_ids]
+            for bucket in range(self.num_buckets)
+        ]
+
+    def cells_to_rows(self, cells: Iterable[Tuple[int, int]]) -> List[list]:
+        """Serialize only the given (bucket, machine_id) cells as [timestamp, machine dict, ...] rows."""
+        by_bucket: Dict[int, List[int]] = {}
+        for bucket, machine_id in cells:
+            by_bucket.setdefault(bucket, []).append(machine_id)
+        now = time.time()
+        return [
+            [self.timestamp(bucket)] + [self._cell_fields(bucket, mid, now) for mid in sorted(by_bucket[bucket])]
+            for bucket in sorted(by_bucket)
+        ]
+
+    @classmethod
+    def from_rows(cls, date: str, rows: List[list], bucket_size: int) -> "ScheduleGrid":
+        """Build a grid from the legacy [timestamp, machine dict or MACHINE, ...] row layout."""
+        if not rows:
+            raise ValueError(f"Schedule for {date} has no time buckets")
+
+        machine_ids = [m["machine_id"] if isinstance(m, dict) else m.machine_id for m in rows[0][1:]]
+        grid = cls(date, rows[0][0], bucket_size, len(rows), machine_ids)
+        for bucket, time_bucket in enumerate(rows):
+            for m in time_bucket[1:]:
+                fields = m if isinstance(m, dict) else m.model_dump()
+                offset = grid._offset(bucket, fields["machine_id"])
+                grid.status[offset] = STATUS_TO_CODE[Status(fields["status"])]
+                if fields.get("session_id") is not None:
+                    grid.session_ids[offset] = fields["session_id"]
+                if fields.get("scheduled_until") is not None:
+                    grid.scheduled_until[offset] = fields["scheduled_until"]
+
+        # Cells were written directly, so rebuild the free-bucket index from the status column
+        grid.index = AvailabilityIndex.from_columns(grid.status, grid.num_buckets, grid.machine_ids, AVAILABLE_CODE)
+        return grid
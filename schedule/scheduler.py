@@ -1,14 +1,20 @@
 # schedule/scheduler.py
 
-from datetime import datetime
-from typing import List, Optional, Union
+from itertools import islice
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Union
 from utils import Status
 from utils import get_logger
+from utils.metrics import timed
 #from utils import session_id_generator, exchange_id_generator
-from config import TIME_BUCKET_SIZE, BUFFER_SIZE
+from config import BUFFER_SIZE
 from config import MACHINE_LAYOUT
-from schedule.master_schedule import get_master_schedule
-from messages import SESSION
+from schedule.master_schedule import ScheduleConflict, get_master_schedule, apply_batch, apply_mutations
+from schedule.journal import add_record, apply_mutation, cancel_record
+from schedule.schedule_grid import ScheduleGrid
+from schedule.session_store import get_session_store, session_date
+from schedule.slot_search import search_slots
+from schedule.time_index import TimeValue, bucket_of, date_of, duration_buckets, to_epoch
+from utils.messages import SESSION
 
 logger = get_logger("scheduler")
 
@@ -38,133 +44,177 @@ def are_adjacent(machine_ids: Union[int, List[int]]) -> bool:
             continue
     return False
 
-def check_availability(machine_ids: Union[int, List[int]], start_time: datetime, duration: int, schedule: Optional[List[List]] = None) -> bool:
+@timed("check_availability_seconds", "Time to check a machine range against a schedule")
+def check_availability(machine_ids: Union[int, List[int]], start_time: TimeValue, duration: int, schedule: Optional[ScheduleGrid] = None) -> bool:
     if isinstance(machine_ids, int):
         machine_ids = [machine_ids]
-        
-    duration_idx = int(duration / TIME_BUCKET_SIZE) # Converts duration from seconds into number of time buckets
-    date = datetime.now().strftime("%Y-%m-%d")
 
     if schedule is None:
-        schedule = get_master_schedule(date)
+        schedule = get_master_schedule(date_of(start_time))
 
     # Find index of the start time bucket
-    start_idx = next(
-        (i for i, bucket in enumerate(schedule) if abs((bucket[0] - start_time).total_seconds()) < TIME_BUCKET_SIZE.total_seconds()/2),  # Returns the closest bucket index to the start time
-        None
-    )
+    start_idx = schedule.bucket_index(to_epoch(start_time))
     if start_idx is None:
-        return False  # Start time doesn't align with any known time bucket
+        return False  # Start time is outside the schedule's day
 
     total_buckets = len(schedule)
+    end_idx = start_idx + duration_buckets(duration, schedule.bucket_size)
+    if end_idx > total_buckets:
+        return False  # Reservation outside of the schedule
 
-    # Check reservation window
-    for offset in range(duration):
-        index = start_idx + offset
-        if index < 0 or index >= total_buckets:
-            return False  # Reservation outside of the schedule
-        bucket = schedule[index][1:]
-        if not all(m.status == Status.AVAILABLE and m.machine_id in machine_ids for m in bucket if m.machine_id in machine_ids):  # Checks if all machines are available in time block
-            return False
+    # Check reservation window plus the buffers on either side, which are clipped at the edges of the schedule
+    window_start = max(0, start_idx - BUFFER_SIZE)
+    window_end = min(total_buckets, end_idx + BUFFER_SIZE)
+    return schedule.is_available(machine_ids, window_start, window_end)
 
-    # Check buffer before
-    for b in range(1, BUFFER_SIZE + 1):
-        index = start_idx - b
-        if index < 0 or index >= total_buckets:
-            continue  # Buffer not needed because reservation is at the beginning of the schedule
-        bucket = schedule[index][1:]
-        if not all(m.status == Status.AVAILABLE and m.machine_id in machine_ids for m in bucket if m.machine_id in machine_ids):  # Checks if all machines are available in time block
-            return False
+@timed("get_availability_seconds", "Time to list free machine groups for a day")
+def get_availability(date: str, number_of_machines: int, start_time: Optional[TimeValue] = None, duration: int = 3600, limit: Optional[int] = None) -> Union[List[SESSION], bool]:
+    schedule = get_master_schedule(date)
+    duration_idx = duration_buckets(duration, schedule.bucket_size)
 
-    # Check buffer after
-    for b in range(1, BUFFER_SIZE + 1):
-        index = start_idx + duration + b - 1
-        if index < 0 or index >= total_buckets:
-            continue  # Buffer not needed because reservation is at the end of the schedule
-        bucket = schedule[index][1:]
-        if not all(m.status == Status.AVAILABLE and m.machine_id in machine_ids for m in bucket if m.machine_id in machine_ids):  # Checks if all machines are available in time block
-            return False
+    # Rank options by proximity to the preferred start time if one is given, otherwise by time
+    preferred_idx = None
+    if start_time:
+        preferred_idx = bucket_of(start_time, schedule.day_start, schedule.bucket_size)
 
-    return True
+    # Find every adjacent group of machines free for the full duration and buffers in one pass over the bitmasks
+    slots = search_slots(schedule.index, MACHINE_LAYOUT, number_of_machines, duration_idx, BUFFER_SIZE, preferred_idx)
 
-def get_availability(date: str, number_of_machines: int, start_time: Optional[datetime] = None, duration: int = 3600) -> Union[List[SESSION], bool]:
-    schedule = get_master_schedule(date)
     options = []
-    duration_idx = int(duration / TIME_BUCKET_SIZE)  # Converts duration from seconds to number of time buckets
+    for slot in islice(slots, limit):
+        # Construct a session object for the valid group
+        session = SESSION(
+            machine_id=slot.machine_ids,
+            session_id=12345,  # Replace with actual session ID generation logic
+            status=Status.RESERVED,
+            start_time=schedule.timestamp(slot.start_bucket),
+            duration=duration
+        )
+        options.append(session)
+
+    return options if options else False
 
-    for idx in range(len(schedule) - duration_idx):  # Iterate through schedule where session could fit
-        candidate_bucket = schedule[idx]
-        machines = candidate_bucket[1:]  # Strip timestamp from time bucket
+class SessionResult(NamedTuple):
+    '''Outcome of one session in a proposal'''
+    session_id: int
+    success: bool
+    message: str
 
-        # Try every contiguous group of available machines
-        for start_pos in range(len(machines) - number_of_machines + 1):
-            group = machines[start_pos:start_pos + number_of_machines]
 
-            # Ensure all machines in the group are AVAILABLE at the proposed start time
-            if not all(m.status == Status.AVAILABLE for m in group):
-                continue
+BATCH_ATTEMPTS = 3  # Times a batch is re-checked when another writer changes one of its days first
 
-            machine_ids = [m.machine_id for m in group]
+def _reserve(session: SESSION, schedule: ScheduleGrid) -> Optional[dict]:
+    # Journal record booking the session, or None if its machines are not free for the requested time
+    if not check_availability(
+        machine_ids=session.machine_id,
+        start_time=session.start_time,
+        duration=session.duration,
+        schedule=schedule
+    ):
+        return None
+
+    # Get the range of time buckets this session occupies
+    start_idx = schedule.bucket_index(session.start_time)
+    end_idx = start_idx + duration_buckets(session.duration, schedule.bucket_size)
+
+    return add_record(
+        machine_ids=session.machine_id,
+        start=start_idx,
+        end=end_idx,
+        session_id=session.session_id,
+        status=Status.RESERVED,
+        scheduled_until=(session.start_time + session.duration) if session.duration else None
+    )
 
-            # Check if all machines in the group are available for full duration and buffer
-            if not check_availability(
-                machine_ids=machine_ids,
-                start_time=candidate_bucket[0],
-                duration=duration,
-                schedule=schedule
-            ):
-                continue  # Skip this group if any machine is not available in any bucket
+@timed("add_sessions_seconds", "Time to check and book a batch of sessions")
+def add_sessions(sessions: List[SESSION]) -> Tuple[bool, List[SessionResult]]:
+    """
+    Book every session or none of them.
+    Each day involved is read once as a snapshot, and every session is checked against it and against the
+    sessions before it in the batch. The batch is then committed in a single update with one journal
+    append per day. Returns whether the batch was booked and a result for each session, in order.
+    """
+    store = get_session_store()
+
+    for _ in range(BATCH_ATTEMPTS):
+        working: Dict[str, ScheduleGrid] = {}  # Private copy of each day with the batch applied so far
+        versions: Dict[str, Tuple[int, int]] = {}  # (generation, version) of each day the batch was checked against
+        changes: Dict[str, List[dict]] = {}
+        booked: Set[int] = set()
+        results: List[SessionResult] = []
+
+        for session in sessions:
+            date = date_of(session.start_time)
+            if date not in working:
+                snapshot = get_master_schedule(date)
+                versions[date] = (snapshot.generation, snapshot.version)
+                working[date] = snapshot.copy()
+
+            if session.session_id in booked or session.session_id in store:
+                results.append(SessionResult(session.session_id, False, "Session ID is already in use"))
+                continue
 
-            # Ensure selected machines are adjacent (i.e., suitable group)
-            if not are_adjacent(machine_ids):
+            record = _reserve(session, working[date])
+            if record is None:
+                results.append(SessionResult(session.session_id, False, "Requested time or machines are unavailable"))
                 continue
 
-            # Construct a session object for the valid group
-            session = SESSION(
-                machine_ids=machine_ids,
-                session_id=12345,  # Replace with actual session ID generation logic
-                status=Status.RESERVED,
-                start_time=candidate_bucket[0],
-                duration=duration
-            )
-            options.append(session)
-
-    # If a preferred start time is given, sort sessions by proximity to that time
-    if start_time:
-        options.sort(key=lambda s: abs((s.start_time - start_time).total_seconds()))
+            # Later sessions in the batch are checked against this booking
+            apply_mutation(working[date], record)
+            changes.setdefault(date, []).append(record)
+            booked.add(session.session_id)
+            results.append(SessionResult(session.session_id, True, "Session added successfully"))
 
-    return options if options else False
+        rejected = sum(not result.success for result in results)
+        if rejected:
+            logger.warning(f"Cannot add batch of {len(sessions)} sessions: {rejected} not available.")
+            return False, results
 
-def add_session(session: SESSION) -> bool:
-    schedule = get_master_schedule(session.date)  # Load the schedule for the given date
+        try:
+            committed = apply_batch(changes, versions, on_commit=lambda: store.add_many(sessions))
+        except ScheduleConflict as e:
+            logger.debug(f"Re-checking batch of {len(sessions)} sessions: {e}")
+            continue
 
-    # Use check_availability to validate the requested session time
-    if not check_availability(
-        machine_ids=session.machine_ids,
-        start_time=session.start_time,
-        duration=session.duration,
-        schedule=schedule
-    ):
-        logger.warning(f"Cannot add session {session.session_id}: machines not available for requested time.")
+        if not committed:
+            logger.error(f"Failed to record batch of {len(sessions)} sessions in the master schedule.")
+            return False, [SessionResult(session.session_id, False, "Failed to add session") for session in sessions]
+
+        logger.info(f"Added {len(sessions)} sessions across {sorted(changes)}")
+        return True, results
+
+    logger.warning(f"Gave up on batch of {len(sessions)} sessions after {BATCH_ATTEMPTS} conflicting updates.")
+    return False, [SessionResult(session.session_id, False, "Schedule changed while booking, try again") for session in sessions]
+
+def add_session(session: SESSION) -> bool:
+    success, results = add_sessions([session])
+    if success:
+        logger.info(f"Session {session.session_id} added for machines {session.machine_id} on {date_of(session.start_time)}")
+    else:
+        logger.warning(f"Cannot add session {session.session_id}: {results[0].message}")
+    return success
+
+def cancel_session(date: str, session_id: int) -> bool:
+    # The session store answers in constant time; scanning the grid only covers sessions booked before it existed
+    stored = get_session_store().get(session_id)
+    if stored is not None:
+        if session_date(stored) != date:
+            logger.warning(f"Cannot cancel session {session_id}: it is booked on {session_date(stored)}, not {date}.")
+            return False
+    elif session_id not in get_master_schedule(date).session_ids:
+        logger.warning(f"Cannot cancel session {session_id}: not found in the {date} schedule.")
         return False
 
-    # Get the list of time bucket indices this session occupies
-    bucket_indices = get_time_bucket_range(schedule, session.start_time, session.end_time)
-    if not bucket_indices:
-        logger.error("Could not find valid time buckets for the session.")
+    if not apply_mutations(date, [cancel_record(session_id)], on_commit=lambda: get_session_store().remove(session_id)):
+        logger.error(f"Failed to record cancellation of session {session_id} in the master schedule.")
         return False
 
-    # Reserve the machines by updating their status and attaching the session ID
-    for idx in bucket_indices:
-        time_bucket = schedule[idx]
-        for i, machine in enumerate(time_bucket[1:], start=1):
-            if machine.machine_id in session.machine_ids:
-                time_bucket[i].status = Status.RESERVED
-                time_bucket[i].session_id = session.session_id
-                time_bucket[i].timestamp = time.time()
-
-    # Save the updated schedule
-    update_master_schedule(session.date, schedule)
-    logger.info(f"Session {session.session_id} added for machines {session.machine_ids} on {session.date}")
+    logger.info(f"Session {session_id} cancelled on {date}")
     return True
 
+def get_session(session_id: int) -> Optional[SESSION]:
+    return get_session_store().get(session_id)
+
+def get_machine_sessions(machine_id: int, start_time: TimeValue, end_time: TimeValue) -> List[SESSION]:
+    """Every session on the machine overlapping the time range, in start order."""
+    return get_session_store().for_machine(machine_id, to_epoch(start_time), to_epoch(end_time))
@@ -0,0 +1,205 @@
+# schedule/session_store.py
+
+import json
+import os
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from schedule.time_index import date_of
+from utils.logger import get_logger
+from utils.messages import SESSION
+
+logger = get_logger("session_store")
+
+SESSION_STORE_PATH = os.path.join("schedules", "sessions.jsonl")
+COMPACT_RATIO = 2  # Rewrite the log once it holds this many records per live session
+
+
+def session_date(session: SESSION) -> str:
+    return date_of(session.start_time)
+
+def session_end(session: SESSION) -> float:
+    return session.start_time + (session.duration or 0)
+
+
+class SessionStore:
+    """
+    Every known session, indexed by session_id, by machine and by date.
+
+    Lookups by ID are a dict access. Each machine keeps its sessions sorted by start time so range
+    queries bisect straight to the first candidate instead of scanning the history. Changes are
+    appended to a JSON-lines log, which is rewritten from the live sessions once it grows too stale.
+    Appends reach the disk on sync(), which the schedule persistence worker calls before it writes
+    the schedule journals, so after a crash the store is never behind the schedules.
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+        self._by_id: Dict[int, SESSION] = {}
+        self._by_machine: Dict[int, List[Tuple[float, int]]] = defaultdict(list)  # Sorted (start_time, session_id)
+        self._longest: Dict[int, float] = defaultdict(float)  # Longest session per machine, bounds range queries
+        self._by_date: Dict[str, Set[int]] = defaultdict(set)
+
+        self._log_records = 0
+        self._dirty = False  # Appended to since the last sync
+        self._load()
+        self._log = open(self.path, "a")
+
+    # === Persistence ===
+
+    def _load(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as file:
+            valid_length = 0
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                if record["op"] == "put":
+                    self._index(SESSION(**record["session"]))
+                else:
+                    self._unindex(record["session_id"])
+                self._log_records += 1
+                valid_length += len(line)
+
+            # Cut off a torn final record left by a crash mid-append so new records start on a clean line
+            if valid_length < file.seek(0, os.SEEK_END):
+                logger.warning(f"Truncating incomplete record at the end of {self.path}.")
+                file.truncate(valid_length)
+                file.flush()
+                os.fsync(file.fileno())
+        logger.info(f"Loaded {len(self._by_id)} sessions from {self.path}.")
+
+    def _append(self, records: List[dict]):
+        self._log.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+        self._log.flush()
+        self._dirty = True
+        self._log_records += len(records)
+        if self._log_records > COMPACT_RATIO * max(len(self._by_id), 1) + 100:
+            self._compact()
+
+    def _compact(self):
+        # Rewrite the log with one record per live session
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            for session in self._by_id.values():
+                file.write(json.dumps({"op": "put", "session": session.model_dump(mode="json")}, separators=(",", ":")) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self._log.close()
+        os.replace(temp_path, self.path)
+        self._log = open(self.path, "a")
+        self._log_records = len(self._by_id)
+        self._dirty = False  # The rewritten log was synced before it replaced the old one
+        logger.debug(f"Compacted session log to {self._log_records} records.")
+
+    # === Indexes ===
+
+    def _index(self, session: SESSION):
+        self._unindex(session.session_id)
+        self._by_id[session.session_id] = session
+        for machine_id in session.machine_id:
+            insort(self._by_machine[machine_id], (session.start_time, session.session_id))
+            self._longest[machine_id] = max(self._longest[machine_id], session.duration or 0)
+        self._by_date[session_date(session)].add(session.session_id)
+
+    def _unindex(self, session_id: int) -> Optional[SESSION]:
+        session = self._by_id.pop(session_id, None)
+        if session is None:
+            return None
+        for machine_id in session.machine_id:
+            entries = self._by_machine[machine_id]
+            i = bisect_left(entries, (session.start_time, session_id))
+            if i < len(entries) and entries[i] == (session.start_time, session_id):
+                del entries[i]
+        self._by_date[session_date(session)].discard(session_id)
+        return session
+
+    # === Public API ===
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, session_id: int) -> bool:
+        return session_id in self._by_id
+
+    def add(self, session: SESSION):
+        """Insert or replace a session."""
+        self.add_many([session])
+
+    def add_many(self, sessions: List[SESSION]):
+        """Insert or replace several sessions with a single write to the log."""
+        with self._lock:
+            for session in sessions:
+                self._index(session)
+            self._append([{"op": "put", "session": session.model_dump(mode="json")} for session in sessions])
+
+    def remove(self, session_id: int) -> Optional[SESSION]:
+        """Remove a session, returning it if it existed."""
+        with self._lock:
+            session = self._unindex(session_id)
+            if session is not None:
+                self._append([{"op": "delete", "session_id": session_id}])
+            return session
+
+    def get(self, session_id: int) -> Optional[SESSION]:
+        return self._by_id.get(session_id)
+
+    def for_date(self, date: str) -> List[SESSION]:
+        """Sessions starting on the date, in start order."""
+        with self._lock:
+            sessions = [self._by_id[sid] for sid in self._by_date.get(date, ())]
+        return sorted(sessions, key=lambda s: s.start_time)
+
+    def for_machine(self, machine_id: int, start_time: float, end_time: float) -> List[SESSION]:
+        """Sessions on the machine that overlap [start_time, end_time), in start order."""
+        with self._lock:
+            entries = self._by_machine.get(machine_id, [])
+            # No session that starts before start_time - longest can still be running at start_time
+            i = bisect_left(entries, (start_time - self._longest[machine_id], -1))
+            sessions = []
+            while i < len(entries) and entries[i][0] < end_time:
+                session = self._by_id[entries[i][1]]
+                if session_end(session) > start_time or session.start_time >= start_time:
+                    sessions.append(session)
+                i += 1
+        return sessions
+
+    def sync(self):
+        """Force every change appended so far onto the disk."""
+        with self._lock:
+            if self._dirty:
+                os.fsync(self._log.fileno())
+                self._dirty = False
+
+    def close(self):
+        with self._lock:
+            if self._dirty:
+                os.fsync(self._log.fileno())
+            self._log.close()
+
+
+_store: Optional[SessionStore] = None
+_store_lock = threading.Lock()
+
+def sync_session_store():
+    """Sync the shared store, if it has been opened."""
+    if _store is not None:
+        _store.sync()
+
+def get_session_store() -> SessionStore:
+    """Shared store, opened on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore()
+        return _store
@@ -0,0 +1,108 @@
+# schedule/slot_search.py
+
+from typing import Iterator, List, NamedTuple, Optional
+
+from schedule.availability_index import AvailabilityIndex
+
+
+class SlotOption(NamedTuple):
+    '''A feasible reservation: a start bucket and an adjacent group of machines'''
+    start_bucket: int
+    machine_ids: List[int]
+
+
+def _runs_of_ones(mask: int, length: int) -> int:
+    """
+    Returns a mask where bit s is set when bits [s, s + length) of the input are all set.
+    Equivalent to a sliding-window sum over the free buckets compared against the window
+    length, done with log2(length) shift-and-AND steps.
+    """
+    result = mask
+    covered = 1
+    while covered * 2 <= length:
+        result &= result >> covered
+        covered *= 2
+    if covered < length:
+        result &= result >> (length - covered)
+    return result
+
+
+def feasible_starts(free_mask: int, num_buckets: int, duration_buckets: int, buffer_size: int) -> int:
+    """
+    Returns a mask of the start buckets where a reservation of duration_buckets fits inside the day
+    with buffer_size free buckets on either side. Buffers past the edges of the day count as free.
+    """
+    if duration_buckets > num_buckets:
+        return 0
+
+    # Pad the mask with free buckets on both ends so buffers are clipped at the edges of the day
+    edge = (1 << buffer_size) - 1
+    padded = edge | (free_mask << buffer_size) | (edge << (num_buckets + buffer_size))
+
+    # Bit s of the padded mask lines up with the first buffer bucket of a reservation starting at s
+    starts = _runs_of_ones(padded, duration_buckets + 2 * buffer_size)
+    return starts & ((1 << (num_buckets - duration_buckets + 1)) - 1)
+
+
+def machine_groups(layout: List[List[int]], group_size: int, index: AvailabilityIndex) -> List[List[int]]:
+    """Every run of group_size consecutive machines in a layout row that exists in the index."""
+    groups = []
+    for row in layout:
+        for start_pos in range(len(row) - group_size + 1):
+            group = row[start_pos:start_pos + group_size]
+            if all(index.has_machine(mid) for mid in group):
+                groups.append(group)
+    return groups
+
+
+def search_slots(
+    index: AvailabilityIndex,
+    layout: List[List[int]],
+    group_size: int,
+    duration_buckets: int,
+    buffer_size: int,
+    preferred_bucket: Optional[int] = None,
+) -> Iterator[SlotOption]:
+    """
+    Lazily yield every feasible (start bucket, adjacent machine group) for the requested group size
+    and duration, ordered by distance from preferred_bucket (earlier first on ties), or in time order
+    if no preference is given.
+    """
+    if group_size < 1:
+        return
+
+    # Feasible start buckets per machine, then AND them along each layout row for every group
+    machine_starts = {}
+    group_starts = []
+    for group in machine_groups(layout, group_size, index):
+        starts = -1
+        for machine_id in group:
+            if machine_id not in machine_starts:
+                machine_starts[machine_id] = feasible_starts(index.free_mask(machine_id), index.num_buckets, duration_buckets, buffer_size)
+            starts &= machine_starts[machine_id]
+        if starts:
+            group_starts.append((group, starts))
+
+    # Start buckets that are feasible for at least one group
+    any_start = 0
+    for _, starts in group_starts:
+        any_start |= starts
+    if not any_start:
+        return
+
+    if preferred_bucket is None:
+        preferred_bucket = 0
+    preferred_bucket = min(max(preferred_bucket, 0), index.num_buckets - 1)
+
+    # Walk outwards from the preferred bucket, only stopping on buckets some group can start at
+    for distance in range(index.num_buckets):
+        before = preferred_bucket - distance
+        after = preferred_bucket + distance
+        if before < 0 and after >= index.num_buckets:
+            break
+        for bucket in (before,) if distance == 0 else (before, after):
+            if bucket < 0 or not any_start >> bucket & 1:
+                continue
+            for group, starts in group_starts:
+                if starts >> bucket & 1:
+                    yield SlotOption(bucket, list(group))
@@ -0,0 +1,57 @@
+# schedule/time_index.py
+
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple, Union
+
+from config import TIME_BUCKET_SIZE
+
+DATE_FORMAT = "%Y-%m-%d"
+
+TimeValue = Union[datetime, float, int]
+
+
+class TimeSlot(NamedTuple):
+    date: str  # Local date of the day schedule holding the time
+    bucket: int  # Index of the time bucket within that day
+
+
+def to_epoch(value: TimeValue) -> float:
+    """Epoch seconds for an epoch number or a datetime. Naive datetimes are taken as local time."""
+    return value.timestamp() if isinstance(value, datetime) else float(value)
+
+def date_of(value: TimeValue) -> str:
+    """Local date that a time falls on."""
+    return datetime.fromtimestamp(to_epoch(value)).strftime(DATE_FORMAT)
+
+@lru_cache(maxsize=64)
+def day_bounds(date: str) -> Tuple[int, int]:
+    """
+    Epoch times of local midnight at the start and end of the date. Measuring midnight to midnight
+    makes daylight saving days 23 or 25 hours long instead of assuming 24.
+    """
+    start = datetime.strptime(date, DATE_FORMAT)
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+def buckets_in_day(date: str, bucket_size: int = TIME_BUCKET_SIZE) -> int:
+    start, end = day_bounds(date)
+    return -(-(end - start) // bucket_size)
+
+def duration_buckets(duration: Optional[float], bucket_size: int = TIME_BUCKET_SIZE) -> int:
+    """Number of buckets a duration in seconds occupies, rounding partial buckets up."""
+    if not duration:
+        return 1  # Default to a single bucket when no duration is given
+    return max(1, -(-int(duration) // bucket_size))
+
+def bucket_of(value: TimeValue, day_start: float, bucket_size: int = TIME_BUCKET_SIZE) -> int:
+    """Index of the bucket containing a time, counted from day_start. May fall outside the day."""
+    return int((to_epoch(value) - day_start) // bucket_size)
+
+def locate(value: TimeValue, bucket_size: int = TIME_BUCKET_SIZE) -> TimeSlot:
+    """Day schedule and bucket holding a time."""
+    date = date_of(value)
+    return TimeSlot(date, bucket_of(value, day_bounds(date)[0], bucket_size))
+
+def bucket_time(date: str, bucket: int, bucket_size: int = TIME_BUCKET_SIZE) -> int:
+    """Epoch time at the start of a bucket."""
+    return day_bounds(date)[0] + bucket * bucket_size
@@ -0,0 +1,141 @@
+# schedule/wire_format.py
+
+from itertools import groupby
+from typing import Iterable, List, Optional, Tuple
+
+from schedule.schedule_grid import ScheduleGrid, STATUS_CODES, AVAILABLE_CODE, NO_SESSION, NOT_SCHEDULED
+from utils.enums import Encoding, Status
+from utils.messages import SCHEDULE, SCHEDULE_DELTA
+
+# Run-length encoding of schedules
+#
+# A day is mostly long stretches of AVAILABLE, or of one session on one machine, so instead of a
+# MACHINE per cell each machine is sent as runs of identical cells:
+#
+#     [machine_id, start_bucket, length, status, session_id, scheduled_until]
+#
+# Full schedules leave out AVAILABLE runs without a session, since decoding starts from a blank day.
+# Deltas keep every run they cover, because a cell going back to AVAILABLE is a change too.
+
+SUPPORTED_ENCODINGS = (Encoding.RLE, Encoding.ROWS)
+
+
+def negotiate_encoding(accepted: Optional[List[Encoding]]) -> Encoding:
+    """First encoding the requester accepts that we can send. Requesters that do not say get rows."""
+    for encoding in accepted or ():
+        if encoding in SUPPORTED_ENCODINGS:
+            return encoding
+    return Encoding.ROWS
+
+
+def _cell_key(grid: ScheduleGrid, offset: int) -> Tuple[int, int, float]:
+    return grid.status[offset], grid.session_ids[offset], grid.scheduled_until[offset]
+
+def _run(machine_id: int, start: int, length: int, key: Tuple[int, int, float]) -> list:
+    status, session_id, scheduled_until = key
+    return [
+        machine_id, start, length, STATUS_CODES[status].value,
+        None if session_id == NO_SESSION else session_id,
+        None if scheduled_until == NOT_SCHEDULED else scheduled_until,
+    ]
+
+def encode_runs(grid: ScheduleGrid, cells: Optional[Iterable[Tuple[int, int]]] = None) -> List[list]:
+    """
+    Run-length encode the whole grid, leaving out free cells, or only the given (bucket, machine_id)
+    cells, keeping free ones.
+    """
+    runs = []
+    if cells is None:
+        for i, machine_id in enumerate(grid.machine_ids):
+            base = i * grid.num_buckets
+            bucket = 0
+            for key, group in groupby(range(base, base + grid.num_buckets), key=lambda offset: _cell_key(grid, offset)):
+                length = sum(1 for _ in group)
+                if key != (AVAILABLE_CODE, NO_SESSION, NOT_SCHEDULED):
+                    runs.append(_run(machine_id, bucket, length, key))
+                bucket += length
+        return runs
+
+    # Consecutive changed buckets of a machine with the same contents become one run
+    machine_index = {machine_id: i for i, machine_id in enumerate(grid.machine_ids)}
+    by_machine = {}
+    for bucket, machine_id in cells:
+        by_machine.setdefault(machine_id, []).append(bucket)
+    for machine_id in sorted(by_machine):
+        base = machine_index[machine_id] * grid.num_buckets
+        start = length = None
+        key = None
+        for bucket in sorted(by_machine[machine_id]):
+            cell = _cell_key(grid, base + bucket)
+            if start is not None and bucket == start + length and cell == key:
+                length += 1
+                continue
+            if start is not None:
+                runs.append(_run(machine_id, start, length, key))
+            start, length, key = bucket, 1, cell
+        if start is not None:
+            runs.append(_run(machine_id, start, length, key))
+    return runs
+
+def apply_runs(grid: ScheduleGrid, runs: List[list]) -> ScheduleGrid:
+    """Write run-length encoded cells into a mutable grid."""
+    for machine_id, start, length, status, session_id, scheduled_until in runs:
+        grid.set_cells(machine_id, start, start + length, Status(status), session_id, scheduled_until)
+    return grid
+
+
+def schedule_message(grid: ScheduleGrid, encoding: Encoding = Encoding.ROWS, **fields) -> SCHEDULE:
+    """Build a SCHEDULE message for the grid in the given encoding."""
+    if encoding == Encoding.RLE:
+        return SCHEDULE(
+            date=grid.date,
+            schedule=encode_runs(grid),
+            version=grid.version,
+            generation=grid.generation,
+            encoding=Encoding.RLE,
+            day_start=grid.day_start,
+            bucket_size=grid.bucket_size,
+            num_buckets=grid.num_buckets,
+            machine_ids=grid.machine_ids,
+            **fields
+        )
+    return SCHEDULE(date=grid.date, schedule=grid.to_rows(), version=grid.version, generation=grid.generation, **fields)
+
+def delta_message(grid: ScheduleGrid, base_version: int, cells: List[Tuple[int, int]], encoding: Encoding = Encoding.ROWS, **fields) -> SCHEDULE_DELTA:
+    """Build a SCHEDULE_DELTA carrying the given cells of the grid in the given encoding."""
+    changes = encode_runs(grid, cells) if encoding == Encoding.RLE else grid.cells_to_rows(cells)
+    return SCHEDULE_DELTA(
+        date=grid.date,
+        generation=grid.generation,
+        base_version=base_version,
+        version=grid.version,
+        changes=changes,
+        encoding=encoding,
+        **fields
+    )
+
+def decode_schedule(message: SCHEDULE) -> ScheduleGrid:
+    """Rebuild a grid from a SCHEDULE message in either encoding."""
+    if message.encoding == Encoding.RLE:
+        grid = ScheduleGrid(message.date, message.day_start, message.bucket_size, message.num_buckets, message.machine_ids)
+        apply_runs(grid, message.schedule)
+    else:
+        bucket_size = message.schedule[1][0] - message.schedule[0][0] if len(message.schedule) > 1 else 0
+        grid = ScheduleGrid.from_rows(message.date, message.schedule, bucket_size)
+    grid.version = message.version or 0
+    grid.generation = message.generation or 0
+    return grid
+
+def apply_delta(grid: ScheduleGrid, delta: SCHEDULE_DELTA) -> ScheduleGrid:
+    """Bring a mutable grid from delta.base_version up to delta.version."""
+    if delta.generation != grid.generation or delta.base_version != grid.version:
+        raise ValueError(f"Delta for {delta.date} applies to v{delta.base_version} of generation {delta.generation}, grid is v{grid.version} of generation {grid.generation}")
+    if delta.encoding == Encoding.RLE:
+        apply_runs(grid, delta.changes)
+    else:
+        for row in delta.changes:
+            bucket = grid.bucket_index(row[0])
+            for machine in row[1:]:
+                grid.set_cells(machine["machine_id"], bucket, bucket + 1, Status(machine["status"]), machine.get("session_id"), machine.get("scheduled_until"))
+    grid.version = delta.version
+    return grid
@@ -0,0 +1,146 @@
+# tests/bench_hub_loopback.py
+#
+# End-to-end load test of the schedule manager and machine handler over the in-process loopback
+# broker, so it runs anywhere with no Mosquitto and no network, and measures the hub alone.
+#
+# Simulated kiosks propose sessions and wait for every acknowledgement, while simulated bays listen
+# for the machine updates the handler sends them. Prints throughput, round-trip latency and the
+# broker's message counts.
+#
+#     python -m tests.bench_hub_loopback [--proposals 2000] [--batch 1] [--updates 2000] [--binary]
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from mqtt import MQTTClient, MQTTConfig
+from mqtt.loopback import default_broker
+from utils import set_level
+from utils.codec import decode, encode
+from utils.enums import Status
+from utils.messages import ACKNOWLEDGE, MACHINE, SESSION, SESSION_BATCH
+
+MQTTConfig.TRANSPORT = "loopback"  # Before the hub modules create their clients
+
+
+class Waiter:
+    """Counts replies and records the round trip of each exchange until all have arrived."""
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.sent_at = {}
+        self.latencies = []
+        self.failed = 0
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def sent(self, exchange_id: int):
+        self.sent_at[exchange_id] = time.perf_counter()
+
+    def received(self, exchange_id: int, success: bool = True):
+        with self._lock:
+            self.failed += not success
+            if exchange_id in self.sent_at:
+                self.latencies.append(time.perf_counter() - self.sent_at[exchange_id])
+            self.expected -= 1
+            if self.expected <= 0:
+                self.done.set()
+
+    def report(self, name: str, started: float, count: int):
+        elapsed = time.perf_counter() - started
+        latencies = sorted(self.latencies)
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0.0
+        p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000 if latencies else 0.0
+        print(f"{name:<12}{count:>8}{elapsed:>10.2f}{count / elapsed:>12.0f}{p50:>10.2f}{p99:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the hub end to end over the in-process loopback broker.")
+    parser.add_argument("--proposals", type=int, default=2000, help="Session proposals to send")
+    parser.add_argument("--batch", type=int, default=1, help="Sessions per proposal; more than one sends SESSION_BATCHes")
+    parser.add_argument("--updates", type=int, default=2000, help="Machine updates to send through the machine handler")
+    parser.add_argument("--days", type=int, default=7, help="Days the proposals are spread over")
+    parser.add_argument("--binary", action="store_true", help="Send machine updates in the binary layout instead of JSON")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    set_level("ERROR")
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+
+        # Imported here so their schedules live in the temporary directory
+        from config.topics import Topics
+        from schedule import manager
+        from machine import machine_handler
+        manager.init_schedule_manager()
+        machine_handler.init_machine_handler()
+
+        print(f"{'':<12}{'messages':>8}{'seconds':>10}{'per second':>12}{'p50 ms':>10}{'p99 ms':>10}")
+
+        # === Session proposals ===
+        kiosk = MQTTClient("", 0, "SimulatedKiosk")
+        kiosk.connect()
+        proposals = Waiter(args.proposals)
+        def acknowledged(topic, payload):
+            ack = decode(payload, ACKNOWLEDGE)
+            proposals.received(ack.exchange_id, ack.success)
+        kiosk.subscribe(Topics.TEST_SESSION_RESPONSE, acknowledged, max_queue=args.proposals)
+
+        day_start = (int(time.time()) // 86400 + 30) * 86400  # A month out, clear of today's pinned days
+        session_id = 0
+        started = time.perf_counter()
+        for exchange_id in range(args.proposals):
+            sessions = []
+            for _ in range(args.batch):
+                session_id += 1
+                sessions.append(SESSION(
+                    machine_id=[session_id % 10 + 1],
+                    session_id=session_id,
+                    status=Status.RESERVED,
+                    start_time=day_start + (session_id % args.days) * 86400 + (session_id // 10 % 96) * 900,
+                    duration=600,
+                    exchange_id=exchange_id,
+                ))
+            message = sessions[0] if args.batch == 1 else SESSION_BATCH(sessions=sessions, exchange_id=exchange_id)
+            proposals.sent(exchange_id)
+            kiosk.publish(Topics.MANAGER_PROPOSE_SESSION, encode(message, args.binary))
+        if not proposals.done.wait(args.timeout):
+            print(f"{proposals.expected} of {args.proposals} proposals were not answered")
+        proposals.report("proposals", started, args.proposals)
+        print(f"{'':<12}{proposals.failed} refused, as booked or with the manager busy")
+
+        # === Machine updates ===
+        bays = MQTTClient("", 0, "SimulatedBays")
+        bays.connect()
+        updates = Waiter(args.updates)
+        bays.subscribe(Topics.MACHINE_UPDATE_BASE, lambda topic, payload, machine_id: updates.received(decode(payload, MACHINE).exchange_id), max_queue=args.updates)
+
+        started = time.perf_counter()
+        for exchange_id in range(args.updates):
+            update = MACHINE(machine_id=exchange_id % 10 + 1, status=Status.ACTIVE, exchange_id=exchange_id)
+            updates.sent(exchange_id)
+            kiosk.publish(Topics.MACHINE_UPDATE_INTERNAL, encode(update, args.binary))
+        # An update to a bay whose previous one is still queued replaces it, so fewer than were sent
+        # arrive: wait for the handler to take them all and for the bays to go quiet
+        deadline = time.monotonic() + args.timeout
+        while machine_handler.dispatcher.stats()["received"] < args.updates and time.monotonic() < deadline:
+            time.sleep(0.01)
+        machine_handler.mqtt_client.flush(args.timeout)
+        while any(stats["depth"] or stats["busy"] for stats in bays.stats()["subscriptions"].values()):
+            time.sleep(0.01)
+        updates.report("updates", started, args.updates)
+        print(f"{'':<12}{len(updates.latencies)} reached the bays after coalescing")
+
+        print(f"\nBroker: {default_broker.stats()}")
+        print(f"Manager: {manager.mqtt_client.stats()['subscriptions'][Topics.MANAGER_PROPOSE_SESSION]}")
+
+        for client in (kiosk, bays, manager.mqtt_client, machine_handler.mqtt_client):
+            client.disconnect()
+        from schedule.master_schedule import flush_schedules
+        flush_schedules()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# tests/bench_schedule_build.py
+#
+# Micro-benchmark for building schedules and their MACHINE cells.
+# Compares the validated construction every cell used to go through (full pydantic validation plus
+# a time.time() call per cell) with the trusted path the grid uses now.
+#
+#     python -m tests.bench_schedule_build [--machines 10] [--repeat 20]
+
+import argparse
+import os
+import tempfile
+import time
+
+from utils.messages import MACHINE
+from schedule import file_io
+from schedule.schedule_grid import ScheduleGrid, STATUS_CODES, NO_SESSION, NOT_SCHEDULED
+
+DATE = "2030-01-15"
+
+
+def validated_rows(grid: ScheduleGrid) -> list:
+    """Rows built the way they were before: a validated MACHINE per cell, then dumped."""
+    rows = []
+    for bucket in range(grid.num_buckets):
+        row = [grid.timestamp(bucket)]
+        for machine_id in grid.machine_ids:
+            offset = grid._offset(bucket, machine_id)
+            session_id = grid.session_ids[offset]
+            scheduled_until = grid.scheduled_until[offset]
+            row.append(MACHINE(
+                machine_id=machine_id,
+                session_id=None if session_id == NO_SESSION else session_id,
+                status=STATUS_CODES[grid.status[offset]],
+                scheduled_until=None if scheduled_until == NOT_SCHEDULED else scheduled_until,
+            ).model_dump())
+        rows.append(row)
+    return rows
+
+def validated_cells(grid: ScheduleGrid) -> list:
+    """Every cell as a validated MACHINE, as iterating a grid did before."""
+    return [MACHINE(**grid._cell_fields(bucket, mid, time.time())) for bucket in range(grid.num_buckets) for mid in grid.machine_ids]
+
+def trusted_cells(grid: ScheduleGrid) -> list:
+    return [cell for row in grid for cell in row[1:]]
+
+
+def best_of(repeat: int, func, *args) -> float:
+    """Fastest of repeat runs in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def generate(machines: list) -> ScheduleGrid:
+    return file_io.generate_blank_schedule(DATE, machines)
+
+def load() -> ScheduleGrid:
+    file_io.release_day_file(DATE)
+    return file_io.load_schedule_from_disk(DATE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time schedule generation and loading with validated and trusted MACHINE cells.")
+    parser.add_argument("--machines", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    machines = list(range(1, args.machines + 1))
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        file_io.machine_id_list = machines
+        file_io.save_schedule_to_disk(DATE, generate(machines))
+        grid = load()
+
+        results = [
+            ("generate + rows", best_of(args.repeat, lambda: validated_rows(generate(machines))), best_of(args.repeat, lambda: generate(machines).to_rows())),
+            ("load + rows", best_of(args.repeat, lambda: validated_rows(load())), best_of(args.repeat, lambda: load().to_rows())),
+            ("rows", best_of(args.repeat, validated_rows, grid), best_of(args.repeat, grid.to_rows)),
+            ("cells", best_of(args.repeat, validated_cells, grid), best_of(args.repeat, trusted_cells, grid)),
+        ]
+        file_io.release_day_file(DATE)
+
+    cells = grid.num_buckets * len(machines)
+    print(f"{grid.num_buckets} buckets x {len(machines)} machines = {cells} cells, best of {args.repeat}")
+    print(f"{'':<18}{'validated ms':>14}{'trusted ms':>14}{'speedup':>10}")
+    for name, before, after in results:
+        print(f"{name:<18}{before:>14.2f}{after:>14.2f}{before / after:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+# tests/bench_scheduler.py
+#
+# Reproducible benchmark suite for the scheduler, day files and message codec, on synthetic days.
+# Needs no broker: everything runs in-process against a temporary schedules directory.
+#
+# Each workload fixes the bay count, floor layout, share of the day already booked, machines per
+# session, session length and number of days held in memory. Operations are timed one call at a
+# time and reported as p50/p99 microseconds. Results can be written as JSON, and compared against a
+# stored baseline so a slower build fails before it reaches the range:
+#
+#     python -m tests.bench_scheduler                                   # every workload
+#     python -m tests.bench_scheduler --workload busy --ops 500
+#     python -m tests.bench_scheduler --bays 24 --floors 3 --fill 0.6   # custom workload
+#     python -m tests.bench_scheduler --json results.json
+#     python -m tests.bench_scheduler --update-baseline                 # record on the target machine
+#     python -m tests.bench_scheduler --baseline tests/bench_baseline.json --tolerance 0.25
+#
+# The exit status is 1 when any p50 is more than tolerance slower than its baseline. Baselines only
+# compare on the machine they were recorded on, so record them on the Pi, not a laptop.
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from utils import set_level
+from utils.codec import decode, encode
+from utils.enums import Encoding, Status
+from utils.messages import MACHINE, MACHINE_BATCH, SESSION, SCHEDULE
+from schedule import file_io, scheduler
+from schedule.journal import add_record
+from schedule.master_schedule import apply_mutations, flush_schedules, get_master_schedule
+from schedule.schedule_grid import ScheduleGrid
+from schedule.time_index import duration_buckets
+from schedule.wire_format import decode_schedule, schedule_message
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+FIRST_DATE = date(2030, 1, 7)  # Far enough ahead that nothing is pinned or cleared as past
+
+
+class Workload(NamedTuple):
+    bays: int = 10  # Machines on the range
+    floors: int = 2  # Rows of adjacent bays the machines are laid out in
+    fill: float = 0.3  # Share of each held day already booked
+    group: int = 2  # Adjacent machines per session
+    duration: int = 3600  # Session length in seconds
+    days: int = 1  # Days held in memory at once
+
+    def layout(self) -> List[List[int]]:
+        per_floor = -(-self.bays // self.floors)
+        machines = list(range(1, self.bays + 1))
+        return [machines[i:i + per_floor] for i in range(0, self.bays, per_floor)]
+
+
+WORKLOADS: Dict[str, Workload] = {
+    "quiet": Workload(bays=10, floors=2, fill=0.1, group=1, duration=3600, days=1),
+    "default": Workload(bays=10, floors=2, fill=0.3, group=2, duration=3600, days=1),
+    "busy": Workload(bays=15, floors=3, fill=0.7, group=3, duration=5400, days=7),
+    "large": Workload(bays=60, floors=4, fill=0.5, group=4, duration=3600, days=14),
+}
+
+
+class Bench:
+    """State shared by the operations of one workload: its days, layout and random source."""
+
+    def __init__(self, name: str, workload: Workload, index: int, seed: int):
+        self.name = name
+        self.workload = workload
+        self.random = random.Random(seed)
+        self.layout = workload.layout()
+        self.machines = [machine for floor in self.layout for machine in floor]
+        self.dates = [(FIRST_DATE + timedelta(days=index * 32 + day)).isoformat() for day in range(workload.days)]
+        self.scratch = (FIRST_DATE + timedelta(days=index * 32 + 31)).isoformat()  # Day file for file_io runs
+        self.session_ids = iter(range((index + 1) * 10_000_000, (index + 2) * 10_000_000))
+
+        if workload.group > max(len(floor) for floor in self.layout):
+            raise ValueError(f"{name}: groups of {workload.group} do not fit on floors of {len(self.layout[0])} bays")
+
+        # Everything reads the layout and machine list from these module globals
+        scheduler.MACHINE_LAYOUT = self.layout
+        file_io.machine_id_list = self.machines
+
+    def fill(self):
+        """Book each held day to the workload's fill ratio with sessions of random length."""
+        for day in self.dates:
+            grid = get_master_schedule(day)
+            length = max(duration_buckets(self.workload.duration, grid.bucket_size), 1)
+            records = []
+            for machine in self.machines:
+                bucket = 0
+                while bucket < grid.num_buckets:
+                    run = min(self.random.randint(max(length // 2, 1), length * 2), grid.num_buckets - bucket)
+                    if self.random.random() < self.workload.fill:
+                        records.append(add_record([machine], bucket, bucket + run, next(self.session_ids)))
+                    bucket += run
+            apply_mutations(day, records)
+        flush_schedules()
+
+    def group(self) -> List[int]:
+        floor = self.random.choice([floor for floor in self.layout if len(floor) >= self.workload.group])
+        start = self.random.randrange(len(floor) - self.workload.group + 1)
+        return floor[start:start + self.workload.group]
+
+    def start_time(self, grid: ScheduleGrid) -> int:
+        return grid.timestamp(self.random.randrange(grid.num_buckets))
+
+    def session(self, grid: ScheduleGrid) -> SESSION:
+        return SESSION(
+            machine_id=self.group(),
+            session_id=next(self.session_ids),
+            status=Status.RESERVED,
+            start_time=self.start_time(grid),
+            duration=self.workload.duration,
+        )
+
+
+# === Operations ===
+# Each takes the bench and returns the operation to time, with any setup already done
+
+def op_check_availability(bench: Bench) -> Callable[[], object]:
+    grid = get_master_schedule(bench.dates[0])
+    return lambda: scheduler.check_availability(bench.group(), bench.start_time(grid), bench.workload.duration, grid)
+
+def op_get_availability(bench: Bench) -> Callable[[], object]:
+    grid = get_master_schedule(bench.dates[0])
+    return lambda: scheduler.get_availability(bench.dates[0], bench.workload.group, bench.start_time(grid), bench.workload.duration, limit=10)
+
+def op_add_session(bench: Bench) -> Callable[[], object]:
+    # Booked across the held days; some land on booked machines and time the rejection path instead
+    grids = [get_master_schedule(day) for day in bench.dates]
+    return lambda: scheduler.add_session(bench.session(bench.random.choice(grids)))
+
+def op_save_full(bench: Bench) -> Callable[[], object]:
+    grid = get_master_schedule(bench.dates[0])
+    def save():
+        file_io.release_day_file(bench.scratch)
+        file_io.save_schedule_to_disk(bench.scratch, grid)
+    return save
+
+def op_save_changes(bench: Bench) -> Callable[[], object]:
+    grid = get_master_schedule(bench.dates[0]).copy()
+    file_io.release_day_file(bench.scratch)
+    file_io.save_schedule_to_disk(bench.scratch, grid)
+    def save():
+        bucket = bench.random.randrange(grid.num_buckets - 12)
+        grid.set_cells(bench.group(), bucket, bucket + 12, Status.RESERVED, next(bench.session_ids))
+        file_io.save_schedule_to_disk(bench.scratch, grid)
+    return save
+
+def op_load(bench: Bench) -> Callable[[], object]:
+    file_io.save_schedule_to_disk(bench.scratch, get_master_schedule(bench.dates[0]))
+    def load():
+        file_io.release_day_file(bench.scratch)
+        return file_io.load_schedule_from_disk(bench.scratch)
+    return load
+
+def op_encode_session(bench: Bench) -> Callable[[], object]:
+    grid = get_master_schedule(bench.dates[0])
+    session = bench.session(grid)
+    return lambda: encode(session)
+
+def op_decode_session(bench: Bench) -> Callable[[], object]:
+    payload = encode(bench.session(get_master_schedule(bench.dates[0])))
+    return lambda: decode(payload, SESSION)
+
+def machine_batch(bench: Bench) -> MACHINE_BATCH:
+    # Every bay changing at once, as at a time bucket boundary
+    return MACHINE_BATCH(machines=[
+        MACHINE(machine_id=machine_id, session_id=next(bench.session_ids), status=Status.ACTIVE, scheduled_until=time.time() + 900)
+        for machine_id in bench.machines
+    ])
+
+def op_encode_machine_batch(bench: Bench, binary: bool) -> Callable[[], object]:
+    batch = machine_batch(bench)
+    return lambda: encode(batch, binary)
+
+def op_decode_machine_batch(bench: Bench, binary: bool) -> Callable[[], object]:
+    payload = encode(machine_batch(bench), binary)
+    return lambda: decode(payload, MACHINE_BATCH)
+
+def op_encode_schedule(bench: Bench, encoding: Encoding) -> Callable[[], object]:
+    grid = get_master_schedule(bench.dates[0])
+    return lambda: encode(schedule_message(grid, encoding))
+
+def op_decode_schedule(bench: Bench, encoding: Encoding) -> Callable[[], object]:
+    payload = encode(schedule_message(get_master_schedule(bench.dates[0]), encoding))
+    return lambda: decode_schedule(decode(payload, SCHEDULE))
+
+
+# name -> (operation, share of --ops to run; slow operations run fewer times)
+OPERATIONS: Dict[str, Tuple[Callable[[Bench], Callable[[], object]], float]] = {
+    "check_availability": (op_check_availability, 1.0),
+    "get_availability": (op_get_availability, 0.2),
+    "add_session": (op_add_session, 0.2),
+    "save_full": (op_save_full, 0.1),
+    "save_changes": (op_save_changes, 0.2),
+    "load": (op_load, 0.2),
+    "session_encode": (op_encode_session, 1.0),
+    "session_decode": (op_decode_session, 1.0),
+    "machine_batch_encode_json": (lambda bench: op_encode_machine_batch(bench, False), 1.0),
+    "machine_batch_encode_binary": (lambda bench: op_encode_machine_batch(bench, True), 1.0),
+    "machine_batch_decode_json": (lambda bench: op_decode_machine_batch(bench, False), 1.0),
+    "machine_batch_decode_binary": (lambda bench: op_decode_machine_batch(bench, True), 1.0),
+    "schedule_encode_rows": (lambda bench: op_encode_schedule(bench, Encoding.ROWS), 0.05),
+    "schedule_encode_rle": (lambda bench: op_encode_schedule(bench, Encoding.RLE), 0.2),
+    "schedule_decode_rows": (lambda bench: op_decode_schedule(bench, Encoding.ROWS), 0.05),
+    "schedule_decode_rle": (lambda bench: op_decode_schedule(bench, Encoding.RLE), 0.2),
+}
+
+
+def measure(operation: Callable[[], object], ops: int) -> Dict[str, float]:
+    """Time ops calls one at a time, after a few warm-up calls. Times are in microseconds."""
+    for _ in range(min(ops, 5)):
+        operation()
+    times = []
+    for _ in range(ops):
+        start = time.perf_counter()
+        operation()
+        times.append((time.perf_counter() - start) * 1e6)
+    times.sort()
+    return {
+        "ops": ops,
+        "mean_us": round(sum(times) / ops, 2),
+        "p50_us": round(times[ops // 2], 2),
+        "p99_us": round(times[min(int(ops * 0.99), ops - 1)], 2),
+    }
+
+def run_workload(name: str, workload: Workload, index: int, ops: int, seed: int, only: Optional[List[str]]) -> Dict[str, Dict[str, float]]:
+    bench = Bench(name, workload, index, seed)
+    bench.fill()
+    results = {}
+    for operation_name, (make, share) in OPERATIONS.items():
+        if only and operation_name not in only:
+            continue
+        results[operation_name] = measure(make(bench), max(int(ops * share), 10))
+    flush_schedules()
+    return results
+
+
+# === Baselines ===
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Print each p50 against the baseline's and return the operations more than tolerance slower."""
+    regressions = []
+    print(f"\n{'':<34}{'baseline p50':>14}{'p50':>12}{'change':>10}")
+    for name, workload in results["workloads"].items():
+        previous = baseline.get("workloads", {}).get(name)
+        if previous is None or previous["parameters"] != workload["parameters"]:
+            print(f"{name}: no baseline with the same parameters")
+            continue
+        for operation, stats in workload["operations"].items():
+            before = previous["operations"].get(operation)
+            if before is None:
+                continue
+            change = stats["p50_us"] / before["p50_us"] - 1 if before["p50_us"] else 0.0
+            slower = change > tolerance
+            if slower:
+                regressions.append(f"{name}/{operation}")
+            print(f"{name + '/' + operation:<34}{before['p50_us']:>14.1f}{stats['p50_us']:>12.1f}{change:>+9.0%}{'  SLOWER' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scheduler, day files and message codec on synthetic workloads.")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS), help="Workload to run; repeat for several (default: all)")
+    for field, default in Workload._field_defaults.items():
+        parser.add_argument(f"--{field}", type=type(default), help=f"Run one custom workload with this {field} (default {default})")
+    parser.add_argument("--operation", action="append", choices=sorted(OPERATIONS), help="Operation to run; repeat for several (default: all)")
+    parser.add_argument("--ops", type=int, default=1000, help="Calls timed for the fastest operations; slower ones run a share of this")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the synthetic days and requests")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help=f"Compare against this results file (default {os.path.relpath(DEFAULT_BASELINE)}, if it exists)")
+    parser.add_argument("--update-baseline", action="store_true", help="Save the results as the baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown of a p50 counted as a regression")
+    args = parser.parse_args()
+
+    custom = {field: getattr(args, field) for field in Workload._fields if getattr(args, field) is not None}
+    if custom:
+        workloads = {"custom": WORKLOADS["default"]._replace(**custom)}
+    else:
+        workloads = {name: WORKLOADS[name] for name in (args.workload or WORKLOADS)}
+
+    set_level("ERROR")  # Rejected bookings would otherwise log a warning each
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "seed": args.seed,
+        "workloads": {},
+    }
+    # Paths are resolved before leaving the working directory for the scratch one
+    baseline_path = os.path.abspath(args.baseline or DEFAULT_BASELINE)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        for index, (name, workload) in enumerate(workloads.items()):
+            operations = run_workload(name, workload, index, args.ops, args.seed, args.operation)
+            results["workloads"][name] = {"parameters": workload._asdict(), "operations": operations}
+
+            print(f"\n{name}: {workload.bays} bays on {workload.floors} floors, {workload.fill:.0%} booked, "
+                  f"groups of {workload.group}, {workload.duration} s sessions, {workload.days} days held")
+            print(f"{'':<30}{'ops':>8}{'mean us':>12}{'p50 us':>12}{'p99 us':>12}")
+            for operation, stats in operations.items():
+                print(f"{operation:<30}{stats['ops']:>8}{stats['mean_us']:>12.1f}{stats['p50_us']:>12.1f}{stats['p99_us']:>12.1f}")
+        for day in list(file_io._day_files):
+            file_io.release_day_file(day)
+
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.update_baseline:
+        with open(baseline_path, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"\nBaseline saved to {baseline_path}")
+        return
+
+    if not os.path.exists(baseline_path):
+        if args.baseline:
+            sys.exit(f"No baseline at {baseline_path}")
+        return
+    with open(baseline_path) as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} operations more than {args.tolerance:.0%} slower than the baseline: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# tests/test_cancel_session.py
+#
+# Run with: python -m pytest tests/test_cancel_session.py
+
+import os
+
+import pytest
+
+from schedule import scheduler, session_store
+from schedule.master_schedule import flush_schedules, get_master_schedule
+from schedule.time_index import day_bounds
+from utils import Status
+from utils.messages import SESSION
+
+DATE = "2030-03-04"
+OTHER_DATE = "2030-03-05"
+
+
+@pytest.fixture
+def booked(tmp_path, monkeypatch):
+    """A session booked on DATE, with schedules and the session store kept in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    store = session_store.SessionStore(os.path.join("schedules", "sessions.jsonl"))
+    monkeypatch.setattr(session_store, "_store", store)
+
+    session = SESSION(
+        machine_id=[1],
+        session_id=777,
+        status=Status.RESERVED,
+        start_time=day_bounds(DATE)[0] + 10 * 3600,
+        duration=3600,
+    )
+    assert scheduler.add_session(session)
+    yield session
+    # The master schedule is shared by the whole process, so leave the day as it was found
+    if scheduler.get_session(session.session_id) is not None:
+        scheduler.cancel_session(DATE, session.session_id)
+    flush_schedules()
+    store.close()
+
+
+def test_cancel_on_wrong_date_is_rejected(booked):
+    assert not scheduler.cancel_session(OTHER_DATE, booked.session_id)
+
+    # The booking and the stored session are untouched, so the id cannot be booked twice
+    schedule = get_master_schedule(DATE)
+    assert schedule.session_at(schedule.bucket_index(booked.start_time), 1) == booked.session_id
+    assert scheduler.get_session(booked.session_id) is not None
+    assert not scheduler.add_session(booked)
+
+
+def test_cancel_on_booked_date(booked):
+    assert scheduler.cancel_session(DATE, booked.session_id)
+
+    schedule = get_master_schedule(DATE)
+    assert schedule.status_at(schedule.bucket_index(booked.start_time), 1) == Status.AVAILABLE
+    assert scheduler.get_session(booked.session_id) is None
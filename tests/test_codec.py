@@ -0,0 +1,37 @@
+# tests/test_codec.py
+#
+# Run with: python -m pytest tests/test_codec.py
+
+import pytest
+
+from utils.codec import CodecError, decode, encode
+from utils.dispatch import MessageDispatcher
+from utils.enums import BallLevel, Node, Status
+from utils.messages import MACHINE, MACHINE_BATCH
+
+
+def test_binary_round_trip():
+    machine = MACHINE(machine_id=4, session_id=12345, status=Status.ACTIVE, ball_level=BallLevel.LOW, origin_node=Node.MACHINE)
+    idle = MACHINE(machine_id=5, status=Status.IDLE)
+    batch = MACHINE_BATCH(machines=[machine, idle], exchange_id=7)
+
+    assert decode(encode(machine, binary=True)) == machine
+    assert decode(encode(idle, binary=True)) == idle
+    assert decode(encode(batch, binary=True)) == batch
+
+
+def test_truncated_binary_is_rejected():
+    payload = encode(MACHINE(machine_id=4, status=Status.ACTIVE), binary=True)
+    with pytest.raises(CodecError):
+        decode(payload[:-1])
+
+
+def test_deeply_nested_json_is_rejected():
+    payload = "[" * 100_000
+    with pytest.raises(CodecError):
+        decode(payload, MACHINE)
+
+    dispatcher = MessageDispatcher("test", legacy_model=MACHINE, max_payload=len(payload))
+    dispatcher.register(MACHINE, lambda topic, message, binary: None)
+    assert not dispatcher.dispatch("test/topic", payload)
+    assert dispatcher.stats()["rejected"] == 1
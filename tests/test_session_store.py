@@ -0,0 +1,39 @@
+# tests/test_session_store.py
+#
+# Run with: python -m pytest tests/test_session_store.py
+
+from schedule.session_store import SessionStore
+from utils import Status
+from utils.messages import SESSION
+
+
+def make_session(session_id: int) -> SESSION:
+    return SESSION(
+        machine_id=[1],
+        session_id=session_id,
+        status=Status.RESERVED,
+        start_time=1900000000 + session_id * 3600,
+        duration=3600,
+    )
+
+
+def test_torn_record_is_truncated(tmp_path):
+    path = str(tmp_path / "sessions.jsonl")
+    store = SessionStore(path)
+    store.add_many([make_session(1)])
+    store.close()
+
+    # A crash mid-append leaves the last record without its newline
+    with open(path, "a") as file:
+        file.write('{"op":"put","session":{"machine_id":[1],"sess')
+
+    store = SessionStore(path)
+    assert store.get(1) is not None
+    store.add_many([make_session(2)])
+    store.close()
+
+    # The record appended after recovery starts on a clean line, so it survives the next restart
+    store = SessionStore(path)
+    assert store.get(1) is not None
+    assert store.get(2) is not None
+    store.close()
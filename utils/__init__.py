@@ -1,5 +1,5 @@
 #utils/__init__.py
 
-from .messages import REQUEST, SESSION, SCHEDULE, CONFIRMATION, MACHINE
-from .enums import Status, BallLevel, Request, Node
-from .logger import get_logger
\ No newline at end of file
+from .messages import REQUEST, SESSION, SESSION_BATCH, SCHEDULE, SCHEDULE_DELTA, ACKNOWLEDGE, MACHINE, MACHINE_BATCH, PROFILE, PROFILE_REPORT
+from .enums import Status, BallLevel, Request, Node, Encoding, Overflow, ProfileMode
+from .logger import get_logger, set_level
\ No newline at end of file
@@ -0,0 +1,97 @@
+# utils/dispatch.py
+
+from typing import Callable, Dict, Optional, Type
+
+from pydantic import BaseModel, ValidationError
+
+from utils.codec import CodecError, JsonModel, Payload, binary_type, build, is_binary, read_envelope
+from utils.logger import get_logger
+from utils.metrics import Histogram, metrics, stats_collector
+from utils.profiling import profiled
+
+MAX_PAYLOAD_BYTES = 256 * 1024  # Larger payloads are rejected unread
+
+# handler(topic, message, binary, **params): binary tells the handler which format to answer in, and
+# params are the {name} levels of the subscription's topic pattern
+Handler = Callable[..., None]
+
+
+class MessageDispatcher:
+    """
+    Routes incoming MQTT payloads to a handler per message type.
+
+    The type comes from the binary header or the JSON envelope, so a payload nobody handles is turned
+    away before its model is built, and a malformed one costs a failed parse rather than a failed
+    validation of every candidate model. Rejected payloads are logged and counted, never answered,
+    so bad traffic cannot generate more traffic.
+    """
+
+    def __init__(self, name: str, legacy_model: Optional[JsonModel] = None, max_payload: int = MAX_PAYLOAD_BYTES):
+        self.name = name
+        self.legacy_model = legacy_model  # Model for bare JSON objects without an envelope
+        self.max_payload = max_payload
+        self.logger = get_logger(name)
+        self._handlers: Dict[Type[BaseModel], Handler] = {}
+        self._latency: Dict[Type[BaseModel], Histogram] = {}  # Time spent in each handler
+
+        # Counters
+        self.received = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.failed = 0
+        metrics.collect_from("dispatch", stats_collector(self.stats, {"dispatcher": name}), "Messages received, dispatched, rejected and failed")
+
+    def register(self, model: Type[BaseModel], handler: Handler):
+        self._handlers[model] = handler
+        self._latency[model] = metrics.histogram(
+            "handler_seconds", "Time spent handling a message", {"dispatcher": self.name, "message": model.__name__}
+        )
+
+    def _reject(self, topic: str, reason: str) -> bool:
+        self.rejected += 1
+        self.logger.warning(f"Rejected message on {topic}: {reason}")
+        return False
+
+    def dispatch(self, topic: str, payload: Payload, **params: str) -> bool:
+        """Route a payload to its handler. Returns False if it was rejected or the handler failed."""
+        self.received += 1
+        if len(payload) > self.max_payload:
+            return self._reject(topic, f"{len(payload)} bytes is over the {self.max_payload} byte limit")
+
+        # Binary headers name the type before the body is read
+        model = binary_type(payload)
+        if model is not None and model not in self._handlers:
+            return self._reject(topic, f"no handler for {model.__name__}")
+
+        try:
+            model, body = read_envelope(payload, self.legacy_model)
+            handler = self._handlers.get(model)
+            if handler is None:
+                return self._reject(topic, f"no handler for {model.__name__}")
+            message = build(model, body)
+        except ValidationError as e:
+            # One line per rejection; the full error report is only worth it when debugging a client
+            self.logger.debug(f"Validation errors on {topic}: {e}")
+            return self._reject(topic, f"{e.error_count()} validation errors for {e.title}")
+        except (CodecError, TypeError) as e:
+            return self._reject(topic, f"invalid message: {e}")
+
+        try:
+            with self._latency[model].time():
+                profiled(handler, topic, message, is_binary(payload), **params)
+            self.dispatched += 1
+            return True
+        except Exception as e:
+            self.failed += 1
+            self.logger.exception(f"Error handling {model.__name__} on {topic}: {e}")
+            return False
+
+    __call__ = dispatch  # So a dispatcher can be passed straight to MQTTClient.subscribe
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "dispatched": self.dispatched,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
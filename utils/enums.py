@@ -28,4 +28,18 @@ class Node(str, Enum):
     ADMIN = "admin_portal"
     KIOSK = "kiosk_interface"
     RESERVATION = "reservation_interface"
-    MACHINE = "machine"
\ No newline at end of file
+    MACHINE = "machine"
+
+class Encoding(str, Enum):
+    ROWS = "rows"  # [timestamp, MACHINE, ...] row per time bucket
+    RLE = "rle"  # [machine_id, start_bucket, length, status, session_id, scheduled_until] run per block of identical cells
+
+class ProfileMode(str, Enum):
+    CPU = "cpu"  # cProfile of every message handled while profiling
+    SAMPLE = "sample"  # Stacks of threads handling messages, sampled at intervals; much lower overhead than cpu
+    MEMORY = "memory"  # tracemalloc comparison of allocations at the start and end of profiling
+
+class Overflow(str, Enum):
+    DROP_OLDEST = "drop_oldest"  # Make room by discarding the longest-waiting message
+    BLOCK = "block"  # Hold up the network thread until there is room, for a bounded time, then reject
+    REJECT = "reject"  # Turn the new message away and tell the subscriber so it can answer with a failure
\ No newline at end of file
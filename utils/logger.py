@@ -1,8 +1,139 @@
+import atexit
+import itertools
 import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Union
+
+# Settings come from the environment, since config imports utils
+LOG_LEVEL = os.getenv("HUB_LOG_LEVEL", "INFO").upper()  # Level of every hub logger until set_level changes it
+LOG_QUEUE_SIZE = int(os.getenv("HUB_LOG_QUEUE_SIZE", 10000))  # Records waiting for the writer; more are dropped
+LOG_RATE_LIMIT = float(os.getenv("HUB_LOG_RATE_LIMIT", 50))  # Records per second each logger may emit below ERROR...
+LOG_RATE_BURST = int(os.getenv("HUB_LOG_RATE_BURST", 200))  # ...after a burst of this many
+LOG_PAYLOAD_CHARS = int(os.getenv("HUB_LOG_PAYLOAD_CHARS", 200))  # Characters of a message payload shown in logs
+LOG_PAYLOAD_SAMPLE = int(os.getenv("HUB_LOG_PAYLOAD_SAMPLE", 1))  # Log the payload of one in this many messages
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread without blocking or formatting them.
+
+    The message is only built from its arguments in the writer thread, and only if the record is
+    written at all. Exceptions are rendered here though, so the record does not keep the stack alive.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # Bounded here rather than by the queue, which must always take the writer's stop sentinel
+        if self.queue.qsize() >= LOG_QUEUE_SIZE:
+            self.dropped += 1  # The writer has fallen behind; losing a log line beats stalling the caller
+            return
+        self.queue.put_nowait(record)
+
+
+class _RateLimit(logging.Filter):
+    """Token bucket per logger. Records at ERROR and above always pass."""
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.suppressed = 0
+        self.total_suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                self.total_suppressed += 1
+                return False
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed and isinstance(record.msg, str):
+            record.msg = f"[{suppressed} earlier messages suppressed] {record.msg}"
+        return True
+
+
+class Payload:
+    """
+    Lazy, truncated view of a message payload for log arguments:
+
+        logger.debug("Received on %s: %s", topic, Payload(payload))
+
+    Nothing is decoded or copied unless the record is actually written.
+    """
+
+    __slots__ = ("payload", "limit")
+
+    def __init__(self, payload: Union[str, bytes, bytearray], limit: int = LOG_PAYLOAD_CHARS):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self) -> str:
+        payload = self.payload
+        if isinstance(payload, (bytes, bytearray)):
+            text = payload[:self.limit // 2].hex(" ")
+            return text + (f" ... ({len(payload)} bytes)" if len(payload) > self.limit // 2 else "")
+        if len(payload) <= self.limit:
+            return payload
+        return f"{payload[:self.limit]} ... ({len(payload)} chars)"
+
+
+_queue: queue.Queue = queue.Queue()
+_handler = _DroppingQueueHandler(_queue)
+_listener: Optional[QueueListener] = None
+_listener_lock = threading.Lock()
+_loggers: Dict[str, logging.Logger] = {}
+_rate_limits: Dict[str, _RateLimit] = {}
+_samples: Dict[str, itertools.count] = {}
+
+def _parse_level(level: Union[int, str]) -> int:
+    if isinstance(level, int):
+        return level
+    parsed = logging.getLevelName(level.upper())
+    if not isinstance(parsed, int):
+        raise ValueError(f"Unknown log level {level}")
+    return parsed
+
+_level = _parse_level(LOG_LEVEL)
+
+def _start_writer():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(FORMAT))
+        _listener = QueueListener(_queue, console_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
 
 def get_logger(name: str) -> logging.Logger:
     """
     Creates and configures a logger with the specified name.
+    Records go through a queue to a background writer thread, so logging never waits on the console.
 
     Args:
         name (str): The name of the logger (usually the module name).
@@ -11,21 +142,48 @@ def get_logger(name: str) -> logging.Logger:
         logging.Logger: Configured logger instance.
     """
     logger = logging.getLogger(name)
-    if not logger.hasHandlers():
-        # Set the log level
-        logger.setLevel(logging.DEBUG)
+    if name not in _loggers:
+        _start_writer()
+        logger.setLevel(_level)
+        logger.propagate = False
+        if not logger.hasHandlers():
+            logger.addHandler(_handler)
+        rate_limit = _RateLimit(LOG_RATE_LIMIT, LOG_RATE_BURST)
+        logger.addFilter(rate_limit)
+        _rate_limits[name] = rate_limit
+        _loggers[name] = logger
 
-        # Create a console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG)
+    return logger
 
-        # Create a formatter
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
-        console_handler.setFormatter(formatter)
+def set_level(level: Union[int, str], name: Optional[str] = None):
+    """Change the level of one logger, or of every logger when no name is given, while running."""
+    global _level
+    level = _parse_level(level)
+    if name is not None:
+        get_logger(name).setLevel(level)
+        return
+    _level = level
+    for logger in _loggers.values():
+        logger.setLevel(level)
 
-        # Add the handler to the logger
-        logger.addHandler(console_handler)
+def sample(key: str, every: int = LOG_PAYLOAD_SAMPLE) -> bool:
+    """True for one in every calls with the same key, to log only a sample of frequent events."""
+    counter = _samples.get(key)
+    if counter is None:
+        counter = _samples.setdefault(key, itertools.count())
+    return every <= 1 or next(counter) % every == 0
 
-    return logger
+def stop_logging():
+    """Write out the queued records and stop the writer thread."""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+def logging_stats() -> Dict[str, int]:
+    return {
+        "queued": _queue.qsize(),
+        "dropped": _handler.dropped,
+        "rate_limited": sum(rate_limit.total_suppressed for rate_limit in _rate_limits.values()),
+    }
@@ -1,8 +1,8 @@
 from pydantic import BaseModel, Field, validator
-from typing import Optional, Union, List
+from typing import Optional, Union, List, Type, TypeVar
 import time
 
-from utils.enums import Status, BallLevel, Request, Node
+from utils.enums import Status, BallLevel, Request, Node, Encoding, ProfileMode
 
 class REQUEST(BaseModel):
     '''Generic request to receive the specified information from a node'''
@@ -10,6 +10,9 @@ class REQUEST(BaseModel):
     date: Optional[str] = None  # The date for which the schedule is being requested (optional)
     machine_id: Optional[int] = None  # The ID of the machine being requested (if applicable)
     session_id: Optional[int] = None  # The ID of the session being requested (if applicable)
+    since_version: Optional[int] = None  # Schedule version the requester already holds, to receive only the changes since (if applicable)
+    generation: Optional[int] = None  # Generation of the schedule the requester holds (if applicable)
+    accept_encodings: Optional[List[Encoding]] = None  # Schedule encodings the requester can decode, preferred first (defaults to rows)
 
     exchange_id: Optional[int] = None  # Unique ID for tracking the request/response exchange
     timestamp: float = Field(default_factory=lambda: time.time())  # Time when the request was created
@@ -24,6 +27,7 @@ class ACKNOWLEDGE(BaseModel):
     machine_id: Optional[int] = None  # The ID of the machine related to the confirmation (if applicable)
     session_id: Optional[int] = None  # The ID of the session related to the confirmation (if applicable)
     status: Optional[Status] = None  # The status of the machine or session being confirmed
+    results: Optional[List["ACKNOWLEDGE"]] = None  # Per-item results when acknowledging a batch
 
     exchange_id: Optional[int] = None  # Unique ID for tracking the confirmation exchange
     timestamp: float = Field(default_factory=lambda: time.time())  # Time when the confirmation was created
@@ -51,10 +55,27 @@ class SESSION(BaseModel):
         return v if isinstance(v, list) else [v]
 
 
+class SESSION_BATCH(BaseModel):
+    '''Group of session proposals that are booked together or not at all, such as a league night across several bays'''
+    sessions: List[SESSION]  # The sessions to book
+
+    exchange_id: Optional[int] = None  # Unique ID for tracking the batch exchange
+    timestamp: float = Field(default_factory=lambda: time.time())  # Time when the batch was created
+    origin_node: Optional[Node] = None  # The node that proposed the batch
+    destination_node: Optional[Node] = None  # The node that should handle the batch
+
+
 class SCHEDULE(BaseModel):
     '''Schedule which gets sent to booking nodes to check availability and current statuses'''
     date: str = time.time()  # The date of the schedule (in epoch time)
-    schedule: list  # A list representing the schedule (format to be defined in the future)
+    schedule: list  # A list representing the schedule, laid out as given by encoding
+    version: Optional[int] = None  # Version of the schedule, increasing with every change
+    generation: Optional[int] = None  # Changes whenever the schedule is reloaded; versions only compare within one generation
+    encoding: Encoding = Encoding.ROWS  # Layout of schedule
+    day_start: Optional[float] = None  # Epoch time of the first time bucket (rle only)
+    bucket_size: Optional[int] = None  # Length of a time bucket in seconds (rle only)
+    num_buckets: Optional[int] = None  # Number of time buckets in the day (rle only)
+    machine_ids: Optional[List[int]] = None  # Machines in the schedule; machines without runs are available all day (rle only)
 
     exchange_id: Optional[int] = None  # Unique ID for tracking the schedule exchange
     timestamp: float = Field(default_factory=lambda: time.time())  # Time when the schedule message was created
@@ -62,6 +83,21 @@ class SCHEDULE(BaseModel):
     destination_node: Optional[Node] = None  # The node that should handle the schedule
 
 
+class SCHEDULE_DELTA(BaseModel):
+    '''Cells of a schedule that changed since a version the receiver already holds'''
+    date: str  # The date of the schedule
+    generation: int  # Generation of the schedule the changes belong to
+    base_version: int  # Version the changes apply on top of
+    version: int  # Version of the schedule once the changes are applied
+    changes: list  # Only the cells that changed, laid out as given by encoding
+    encoding: Encoding = Encoding.ROWS  # Layout of changes
+
+    exchange_id: Optional[int] = None  # Unique ID for tracking the schedule exchange
+    timestamp: float = Field(default_factory=lambda: time.time())  # Time when the delta was created
+    origin_node: Optional[Node] = None  # The node that created the delta
+    destination_node: Optional[Node] = None  # The node that should handle the delta
+
+
 class MACHINE(BaseModel):
     '''Represents the status of a machine'''
     machine_id: int  # The unique ID of the machine
@@ -75,3 +111,56 @@ class MACHINE(BaseModel):
     timestamp: float = Field(default_factory=lambda: time.time())  # Time when the machine message was created
     origin_node: Optional[Node] = None  # The node that sent the machine status
     destination_node: Optional[Node] = None  # The node that should handle the machine status
+
+
+class MACHINE_BATCH(BaseModel):
+    '''Updates for several machines sent as one message, such as every bay changing at a time bucket boundary'''
+
+    machines: List[MACHINE]  # One update per machine
+
+    exchange_id: Optional[int] = None  # Unique ID for tracking the batch exchange
+    timestamp: float = Field(default_factory=lambda: time.time())  # Time when the batch was created
+    origin_node: Optional[Node] = None  # The node that sent the batch
+    destination_node: Optional[Node] = None  # The node that should handle the batch
+
+class PROFILE(BaseModel):
+    '''Command from the admin portal to profile a node for a while, answered with a PROFILE_REPORT'''
+    mode: ProfileMode = ProfileMode.SAMPLE  # What to profile
+    duration: Optional[float] = None  # Seconds to profile for (optional; defaults to the node's limit if messages is not given either)
+    messages: Optional[int] = None  # Stop after this many messages have been handled (optional)
+    top: int = 20  # Number of entries in the report
+
+    exchange_id: Optional[int] = None  # Unique ID for tracking the profiling exchange
+    timestamp: float = Field(default_factory=lambda: time.time())  # Time when the command was created
+    origin_node: Optional[Node] = None  # The node that sent the command
+    destination_node: Optional[Node] = None  # The node to profile
+
+
+class PROFILE_REPORT(BaseModel):
+    '''Hottest functions, or largest allocation growth, found by a profiling run'''
+    mode: ProfileMode  # What was profiled
+    elapsed: float  # Seconds spent profiling
+    messages: int  # Messages handled while profiling
+    path: Optional[str] = None  # Full results on the node's disk
+    top: List[dict] = []  # Entries by self time, samples or allocated bytes, largest first
+
+    exchange_id: Optional[int] = None  # Unique ID for tracking the profiling exchange
+    timestamp: float = Field(default_factory=lambda: time.time())  # Time when the report was created
+    origin_node: Optional[Node] = None  # The node that was profiled
+    destination_node: Optional[Node] = None  # The node that should receive the report
+
+Model = TypeVar("Model", bound=BaseModel)
+
+def trusted(model: Type[Model], fields: dict) -> Model:
+    """
+    Build a message from values the hub produced itself, skipping validation and default factories.
+    fields must hold every field of the model with values of the right types. Anything that arrived
+    over MQTT goes through the model's constructor instead. Unlike model_construct, which is slower
+    than validating in pydantic 2, this only sets the instance state.
+    """
+    message = model.__new__(model)
+    object.__setattr__(message, "__dict__", fields)
+    object.__setattr__(message, "__pydantic_fields_set__", set(fields))
+    object.__setattr__(message, "__pydantic_extra__", None)
+    object.__setattr__(message, "__pydantic_private__", None)
+    return message
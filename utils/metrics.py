@@ -0,0 +1,321 @@
+# utils/metrics.py
+
+import functools
+import json
+import math
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from utils.logger import logging_stats
+
+# Metric values an external collector reports at collection time: (name, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+Labels = Optional[Dict[str, str]]
+
+QUANTILES = (0.5, 0.9, 0.99)  # Reported for every histogram
+
+_NAME = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+def _key(name: str, labels: Labels) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    return name, tuple(sorted((labels or {}).items()))
+
+def _format_labels(labels: Iterable[Tuple[str, str]], extra: str = "") -> str:
+    parts = [f'{key}="{str(value)}"'.replace("\n", " ") for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    '''Value that only goes up, such as messages handled'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    '''Value that goes up and down, such as a queue depth'''
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    '''
+    Distribution of measurements with HDR-style log-linear buckets.
+
+    Each power of two is split into 2^(precision-1) equal buckets, so a bucket is 1/32 to 1/16 of
+    the values it holds wide at the default precision of 5 bits, from one unit up to any size, in
+    constant memory per magnitude. Quantiles report the upper bound of their bucket, so they read
+    high by at most about 6% however skewed the distribution is.
+    Measurements in seconds are stored in microseconds.
+    '''
+
+    def __init__(self, unit: float = 1e-6, precision: int = 5):
+        self.unit = unit  # Smallest value told apart
+        self.precision = precision
+        self._half = 1 << (precision - 1)
+        self._lock = threading.Lock()
+        self._buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _index(self, units: int) -> int:
+        # Values below 2^precision get a bucket each; above, each power of two is split into 2^(precision-1)
+        exponent = max(units.bit_length() - self.precision, 0)
+        return exponent * self._half + (units >> exponent)
+
+    def _upper(self, index: int) -> float:
+        # Largest value counted in a bucket, in units
+        if index < 2 * self._half:
+            return index
+        exponent = index // self._half - 1
+        mantissa = index - exponent * self._half
+        return ((mantissa + 1) << exponent) - 1
+
+    def observe(self, value: float):
+        units = max(int(value / self.unit), 0)
+        index = self._index(units)
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Value below which the fraction q of measurements fall, rounded up to the end of its bucket."""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    return min(self._upper(index) * self.unit, self.max)
+            return self.max
+
+    def time(self) -> "_Timer":
+        """Context manager observing how long its block takes, in seconds."""
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class MetricsRegistry:
+    """
+    Named counters, gauges and histograms for the whole process, optionally with labels.
+    Collectors are functions called at collection time for values other modules already keep, like
+    the schedule cache and MQTT queue statistics, so nothing is counted twice.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[Tuple[str, tuple], Union[Counter, Gauge, Histogram]] = {}
+        self._help: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._collectors: List[Tuple[str, str, Callable[[], Iterable[Sample]]]] = []
+
+    def _get(self, kind: type, type_name: str, name: str, help: str, labels: Labels):
+        key = _key(name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = kind()
+                    self._help.setdefault(name, (type_name, help))
+        return metric
+
+    def counter(self, name: str, help: str = "", labels: Labels = None) -> Counter:
+        return self._get(Counter, "counter", name, help, labels)
+
+    def gauge(self, name: str, help: str = "", labels: Labels = None) -> Gauge:
+        return self._get(Gauge, "gauge", name, help, labels)
+
+    def histogram(self, name: str, help: str = "", labels: Labels = None) -> Histogram:
+        return self._get(Histogram, "summary", name, help, labels)
+
+    def collect_from(self, prefix: str, collector: Callable[[], Iterable[Sample]], help: str = ""):
+        """Register a function returning (name, labels, value) gauges; names are prefixed with prefix."""
+        with self._lock:
+            self._collectors.append((prefix, help, collector))
+
+    def _collected(self) -> List[Tuple[str, str, Sample]]:
+        samples = []
+        for prefix, help, collector in list(self._collectors):
+            try:
+                for name, labels, value in collector():
+                    samples.append((help, "gauge", (_NAME.sub("_", f"{prefix}_{name}"), labels, float(value))))
+            except Exception:
+                continue  # A failing collector must not take the other metrics with it
+        return samples
+
+    def snapshot(self) -> Dict[str, dict]:
+        """Every metric's current values, keyed by name and then by label set."""
+        result: Dict[str, dict] = {}
+        with self._lock:
+            metrics = list(self._metrics.items())
+        for (name, labels), metric in metrics:
+            label_text = _format_labels(labels) or "{}"
+            if isinstance(metric, Histogram):
+                value = {"count": metric.count, "sum": metric.sum, "max": metric.max}
+                value.update({f"p{round(q * 100)}": metric.quantile(q) for q in QUANTILES})
+            else:
+                value = metric.value
+            result.setdefault(name, {})[label_text] = value
+        for _, _, (name, labels, value) in self._collected():
+            result.setdefault(name, {})[_format_labels(sorted(labels.items())) or "{}"] = value
+        return result
+
+    def prometheus(self) -> str:
+        """Every metric in the Prometheus text exposition format. Histograms are written as summaries."""
+        lines: List[str] = []
+        by_name: Dict[str, List[Tuple[tuple, Union[Counter, Gauge, Histogram]]]] = {}
+        with self._lock:
+            for (name, labels), metric in self._metrics.items():
+                by_name.setdefault(name, []).append((labels, metric))
+            types = dict(self._help)
+
+        for name in sorted(by_name):
+            kind, help = types[name]
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in by_name[name]:
+                if isinstance(metric, Histogram):
+                    for q in QUANTILES:
+                        quantile = 'quantile="%s"' % q
+                        lines.append(f"{name}{_format_labels(labels, quantile)} {metric.quantile(q):.6g}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {metric.sum:.6g}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value:.6g}")
+
+        # Samples of one metric must be written together, and collectors report them per label set
+        collected: Dict[str, List[Tuple[str, str, Sample]]] = {}
+        for help, kind, sample in self._collected():
+            collected.setdefault(sample[0], []).append((help, kind, sample))
+        for name, samples in collected.items():
+            help, kind, _ = samples[0]
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for _, _, (_, labels, value) in samples:
+                lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value:.6g}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Write the Prometheus text to a file, replacing it atomically for scrapers reading it."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
+
+
+def timed(name: str, help: str = "", labels: Labels = None):
+    """Decorator recording how long each call takes, in seconds, in a histogram."""
+    def decorate(func):
+        histogram = metrics.histogram(name, help, labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+def stats_collector(stats: Callable[[], dict], labels: Labels = None, group: Optional[str] = None) -> Callable[[], List[Sample]]:
+    """
+    Turn a stats() function returning {name: number} into a collector whose samples carry labels.
+    With group, stats() returns {group value: {name: number}} instead, e.g. MQTT statistics per topic.
+    """
+    labels = labels or {}
+
+    def collect() -> List[Sample]:
+        values = stats()
+        groups = {None: values} if group is None else values
+        return [
+            (name, labels if key is None else {**labels, group: key}, value)
+            for key, group_values in groups.items()
+            for name, value in group_values.items() if isinstance(value, (int, float))
+        ]
+    return collect
+
+
+# The logger's own counters
+metrics.collect_from("logging", stats_collector(logging_stats), "Log records queued, dropped and rate limited")
+
+
+class MetricsReporter:
+    """
+    Background thread that periodically writes the Prometheus text file and publishes a JSON
+    snapshot over MQTT, so latency percentiles can be read on the Pi without attaching a debugger.
+    """
+
+    def __init__(self, publish: Optional[Callable[[str, str], None]], topic: str, path: Optional[str], interval: float, registry: MetricsRegistry = metrics):
+        self.publish = publish
+        self.topic = topic
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def report(self):
+        if self.path:
+            self.registry.write_prometheus(self.path)
+        if self.publish is not None:
+            self.publish(self.topic, json.dumps({"timestamp": time.time(), "metrics": self.registry.snapshot()}))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception:
+                continue  # Reporting must never bring the hub down; try again next interval
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.report()
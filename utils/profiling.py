@@ -0,0 +1,270 @@
+# utils/profiling.py
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, List, Optional, Set, Tuple
+
+from utils.enums import ProfileMode
+from utils.logger import get_logger
+from utils.messages import PROFILE, PROFILE_REPORT
+
+logger = get_logger("profiling")
+
+TRACE_FRAMES = 10  # Frames kept per allocation in memory profiles
+
+# (filename, first line, function name) of a frame
+Location = Tuple[str, int, str]
+
+
+def _label(location: Location) -> str:
+    filename, line, name = location
+    return f"{filename}:{line}({name})"
+
+
+class ProfileSession:
+    """
+    One bounded profiling run, over the message handlers run through profiled().
+
+    Only handlers are profiled: the cpu mode runs each one under its own cProfile profiler, since one
+    cannot follow several worker threads, and merges the results, while the sample mode reads the
+    stacks of the threads currently inside a handler, leaving idle workers and the network thread
+    out of the picture. The memory mode compares tracemalloc snapshots of the whole process. The
+    run ends after duration seconds, or once messages handlers have finished, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        command: PROFILE,
+        path: str,
+        max_duration: float,
+        sample_interval: float,
+        on_done: Callable[[PROFILE_REPORT], None],
+    ):
+        self.mode = ProfileMode(command.mode)
+        self.command = command
+        self.path = path  # Results are written here, with an extension for the mode
+        self.duration = min(command.duration or max_duration, max_duration)
+        self.sample_interval = sample_interval
+        self.on_done = on_done
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._stats: Optional[pstats.Stats] = None
+        self._handling: Set[int] = set()  # Threads inside a handler, for the sampler
+        self._samples = 0
+        self._self_samples: Counter = Counter()
+        self._cumulative_samples: Counter = Counter()
+        self._stacks: Counter = Counter()
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        self._started_tracing = False
+        self.messages = 0
+        self.started = 0.0
+
+    def start(self):
+        self.started = time.monotonic()
+        if self.mode == ProfileMode.MEMORY:
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start(TRACE_FRAMES)
+            self._baseline = tracemalloc.take_snapshot()
+        elif self.mode == ProfileMode.SAMPLE:
+            threading.Thread(target=self._sample, name="profiler-sampler", daemon=True).start()
+        timer = threading.Timer(self.duration, self.finish)
+        timer.daemon = True
+        timer.start()
+
+    # === Handler threads ===
+
+    def run(self, func: Callable, *args, **kwargs):
+        if self._done.is_set():
+            return func(*args, **kwargs)
+        thread = threading.get_ident()
+        try:
+            if self.mode == ProfileMode.CPU:
+                profiler = cProfile.Profile()
+                try:
+                    return profiler.runcall(func, *args, **kwargs)
+                finally:
+                    with self._lock:
+                        if self._done.is_set():
+                            pass  # Finished while this handler ran; the results are already written
+                        elif self._stats is None:
+                            self._stats = pstats.Stats(profiler)
+                        else:
+                            self._stats.add(profiler)
+            with self._lock:
+                self._handling.add(thread)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._handling.discard(thread)
+        finally:
+            with self._lock:
+                self.messages += not self._done.is_set()
+                finished = self.command.messages is not None and self.messages >= self.command.messages
+            if finished:
+                self.finish()
+
+    # === Sampler thread ===
+
+    def _sample(self):
+        while not self._done.wait(self.sample_interval):
+            with self._lock:
+                threads = set(self._handling)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread in threads:
+                    frame = frames.get(thread)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    if not stack:
+                        continue
+                    self._samples += 1
+                    self._self_samples[stack[0]] += 1
+                    self._cumulative_samples.update(set(stack))
+                    self._stacks[";".join(location[2] for location in reversed(stack))] += 1
+
+    # === Results ===
+
+    def finish(self):
+        """End the run, write the results to disk and hand the report to on_done. Only the first call counts."""
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._done.set()
+        elapsed = time.monotonic() - self.started
+
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            if self.mode == ProfileMode.CPU:
+                path, top = self._cpu_results()
+            elif self.mode == ProfileMode.SAMPLE:
+                path, top = self._sample_results()
+            else:
+                path, top = self._memory_results()
+        except Exception as e:
+            logger.exception(f"Failed to write {self.mode.value} profile: {e}")
+            path, top = None, []
+        finally:
+            if self._started_tracing:
+                tracemalloc.stop()
+
+        logger.info(f"Finished {self.mode.value} profile of {self.messages} messages over {elapsed:.1f} s, written to {path}.")
+        self.on_done(PROFILE_REPORT(
+            mode=self.mode,
+            elapsed=elapsed,
+            messages=self.messages,
+            path=path,
+            top=top,
+            exchange_id=self.command.exchange_id,
+            destination_node=self.command.origin_node,
+        ))
+
+    def _cpu_results(self) -> Tuple[Optional[str], List[dict]]:
+        with self._lock:
+            stats = self._stats
+        if stats is None:
+            return None, []
+        path = self.path + ".pstats"  # Open with python -m pstats or snakeviz
+        stats.dump_stats(path)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.command.top]
+        return path, [
+            {
+                "function": _label(location),
+                "calls": calls,
+                "self_time": round(self_time, 6),
+                "cumulative_time": round(cumulative_time, 6),
+            }
+            for location, (_, calls, self_time, cumulative_time, _) in rows
+        ]
+
+    def _sample_results(self) -> Tuple[Optional[str], List[dict]]:
+        with self._lock:
+            samples = self._samples
+            stacks = list(self._stacks.items())
+            hottest = self._self_samples.most_common(self.command.top)
+            cumulative = dict(self._cumulative_samples)
+        if not samples:
+            return None, []
+        path = self.path + ".folded"  # Collapsed stacks, as read by flamegraph.pl and speedscope
+        with open(path, "w") as file:
+            for stack, count in stacks:
+                file.write(f"{stack} {count}\n")
+        return path, [
+            {
+                "function": _label(location),
+                "samples": count,
+                "cumulative_samples": cumulative[location],
+                "share": round(count / samples, 4),
+            }
+            for location, count in hottest
+        ]
+
+    def _memory_results(self) -> Tuple[Optional[str], List[dict]]:
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        path = self.path + ".tracemalloc"  # Load with tracemalloc.Snapshot.load
+        snapshot.dump(path)
+        growth = snapshot.compare_to(self._baseline, "lineno")[:self.command.top]
+        return path, [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_diff": stat.size_diff,
+                "count_diff": stat.count_diff,
+                "size": stat.size,
+            }
+            for stat in growth
+        ]
+
+
+_session: Optional[ProfileSession] = None
+_session_lock = threading.Lock()
+
+def start_profile(
+    command: PROFILE,
+    directory: str,
+    on_done: Callable[[PROFILE_REPORT], None],
+    max_duration: float,
+    sample_interval: float,
+) -> bool:
+    """
+    Start profiling this process as the command asks. Results go to a timestamped file in directory,
+    and on_done gets the report when the run ends. Returns False if a profile is already running.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            return False
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{ProfileMode(command.mode).value}")
+
+        def done(report: PROFILE_REPORT):
+            global _session
+            with _session_lock:
+                _session = None
+            on_done(report)
+
+        session = _session = ProfileSession(command, path, max_duration, sample_interval, done)
+        logger.info(f"Started {session.mode.value} profile for up to {session.duration:.0f} s.")
+        session.start()
+    return True
+
+def profiled(func: Callable, *args, **kwargs):
+    """Call a message handler, under the running profile if there is one."""
+    session = _session
+    if session is None:
+        return func(*args, **kwargs)
+    return session.run(func, *args, **kwargs)